@@ -0,0 +1,79 @@
+# buffer_pool.py
+import threading
+from contextlib import contextmanager
+import torch
+
+
+class BufferPool:
+    """
+    Size-keyed pool of reusable tensor buffers for the merge kernels.
+
+    Merged outputs and scratch tensors are drawn from the pool; once a merged tensor has been
+    written to disk it is released and the next key of the same size and dtype reuses its memory
+    instead of allocating a new tensor. Buffers are only recycled inside a session, which keeps
+    track of the buffers it handed out and drops them all when it ends.
+
+    The allocations counter is the number of new buffers created: merged outputs, upcast inputs,
+    stacks, norms and the sign consensus chunks and masks all count, so a merge loop over keys of
+    repeated sizes should not increase it beyond its first keys. Only per-key scalars, such as
+    adaptive weights, are left to torch's allocator.
+    """
+
+    def __init__(self):
+        self.allocations = 0
+        self._lock = threading.Lock()
+        self._free = {}    # (numel, dtype) -> list of flat buffers ready for reuse
+        self._in_use = {}  # data pointer -> flat buffer handed out during the session
+        self._sessions = 0
+
+    def acquire(self, shape, dtype):
+        """Returns an uninitialized tensor of the given shape and dtype, reusing a released buffer when one fits."""
+        shape = tuple(shape)
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        with self._lock:
+            free = self._free.get((numel, dtype))
+            buffer = free.pop() if free else None
+            if buffer is None:
+                self.allocations += 1
+        if buffer is None:
+            buffer = torch.empty(numel, dtype=dtype)
+        with self._lock:
+            if self._sessions and numel > 0:
+                self._in_use[buffer.data_ptr()] = buffer
+        return buffer.view(shape)
+
+    def release(self, *tensors):
+        """
+        Returns buffers to the pool once their contents are no longer needed.
+
+        Tensors are matched by data pointer to the buffers handed out, so a view starting at the
+        beginning of a buffer releases the whole buffer; any other tensor (such as an input tensor
+        passed through unchanged) is ignored, as is a buffer released twice.
+        """
+        with self._lock:
+            for tensor in tensors:
+                if tensor is None:
+                    continue
+                buffer = self._in_use.pop(tensor.data_ptr(), None)
+                if buffer is not None:
+                    self._free.setdefault((buffer.numel(), buffer.dtype), []).append(buffer)
+
+    @contextmanager
+    def session(self):
+        """Enables buffer reuse for the duration of one merge and frees the pooled memory at the end."""
+        with self._lock:
+            self._sessions += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._sessions -= 1
+                if not self._sessions:
+                    self._free.clear()
+                    self._in_use.clear()
+
+
+# Pool shared by all merge kernels of this process
+MERGE_BUFFERS = BufferPool()
@@ -0,0 +1,65 @@
+# config.py
+
+# Maximum size in bytes of the same-shape tensors stacked together by the batched merge engine, shared by all merge workers
+MERGE_BATCH_BYTES = 64 * 1024 * 1024
+
+# Number of worker threads merging keys in parallel (0 uses one worker per CPU core)
+MERGE_WORKERS = 0
+
+# Torch intra-op threads per merge worker (0 splits the CPU cores evenly across the workers)
+MERGE_INTRA_OP_THREADS = 0
+
+# Maximum bytes of tensors God Mode keeps in memory at once (0 uses GOD_MODE_RAM_FRACTION of the available memory)
+GOD_MODE_RAM_BUDGET = 0
+
+# Fraction of the available memory God Mode may use when GOD_MODE_RAM_BUDGET is 0
+GOD_MODE_RAM_FRACTION = 0.5
+
+# Number of worker processes God Mode shards the layers across (1 merges in-process, 0 uses up to one per CPU core)
+GOD_MODE_PROCESSES = 1
+
+# With GOD_MODE_PROCESSES = 0, minimum input bytes per worker process (256 MB), so small folders are merged in-process
+GOD_MODE_SHARD_BYTES = 256 * 1024 * 1024
+
+# Save God Mode's running sums next to its output so new LoRAs can be added without re-merging the folder
+GOD_MODE_SAVE_STATE = True
+
+# Fraction of each model's largest-magnitude values kept by God Mode's TIES strategy before the sign election
+# (estimated from a sample on large layers). TIES and DARE build every model's full layer updates, so they run several times slower than adaptive
+GOD_MODE_TIES_DENSITY = 0.2
+
+# Fraction of each model's values randomly dropped (the rest rescaled) by God Mode's DARE strategy, rounded to a multiple of 1/256
+GOD_MODE_DARE_DROP_RATE = 0.5
+
+# Maximum rank of the LoRA layers God Mode's TIES and DARE strategies write (0 keeps the largest input rank of each layer)
+GOD_MODE_LAYER_RANK = 0
+
+# Output precision of merges: 'auto' keeps the input dtypes; 'fp16', 'bf16' or 'fp32' computes in fp32 and writes that dtype
+MERGE_PRECISION = 'auto'
+
+# Also write a quantized variant of merged LoRAs and God Mode outputs: None, 'int8' or 'fp8' (per-output-channel scales)
+MERGE_QUANTIZE = None
+
+# Also write a sparse variant of merged LoRAs and God Mode outputs, storing mostly-zero layers as positions and values
+MERGE_SPARSE = False
+
+# Layers with a smaller share of non-zero entries than this are stored sparse in sparse variants
+MERGE_SPARSE_DENSITY = 0.25
+
+# Entries at most this large in magnitude are dropped from sparse layers (0 keeps every non-zero entry, lossless)
+MERGE_SPARSE_TOLERANCE = 0.0
+
+# Fold identical rank blocks in rank-concatenation merges so shared factors do not double the rank
+MERGE_CONCAT_FOLD = True
+
+# Maximum rank of the layers written by SVD merges (0 keeps the full merged rank)
+MERGE_SVD_RANK = 32
+
+# Fraction of each layer's energy SVD merges retain, e.g. 0.99 (0 keeps MERGE_SVD_RANK singular values)
+MERGE_SVD_ENERGY = 0
+
+# Disk budget in bytes of cached pairwise merge results; least recently used results are deleted beyond it (0 never deletes)
+MERGE_CACHE_BYTES = 0
+
+# Values at most this fraction of a layer's max absolute value count as zeros in the LoRA analysis sparsity statistic
+ANALYSIS_SPARSITY_TOLERANCE = 1e-3
@@ -0,0 +1,85 @@
+# god_mode_state.py
+import os
+import json
+import torch
+from safetensors_io import read_header, DTYPE_TO_TORCH, TORCH_TO_DTYPE
+
+# God Mode keeps, for every key, the running sums that its merge strategies decompose into:
+#   sum.<key>    = sum of weight_i * tensor_i (fp32, padded to the output shape)
+#   weight.<key> = sum of weight_i (fp64; the L2 norms for adaptive, 1 per model for additive)
+#   count.<key>  = number of models contributing to the key
+# The merged tensor is sum / weight, so models can be added or subtracted without re-reading the others.
+STATE_VERSION = 1
+SUM_PREFIX = "sum."
+WEIGHT_PREFIX = "weight."
+COUNT_PREFIX = "count."
+STATE_SUFFIX = ".state.safetensors"
+
+
+def state_file_path(merged_file_path):
+    """Returns the path of the accumulator state saved next to a God Mode output."""
+    return os.path.splitext(merged_file_path)[0] + STATE_SUFFIX
+
+
+def is_god_mode_file(file_name):
+    """True for God Mode outputs and their state files, which must never be merged back as inputs."""
+    return file_name.startswith("mrg_final_merged_") or file_name.endswith(STATE_SUFFIX)
+
+
+def file_signature(file_path):
+    """Returns the size and mtime used to detect whether a contributing model has changed."""
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def state_specs(output_specs, counts=None):
+    """Returns the (dtype, shape) of every state tensor for the given output specs, skipping keys with no contributors."""
+    specs = {}
+    for key, (_, shape) in output_specs.items():
+        if counts is not None and counts.get(key, 0) <= 0:
+            continue
+        specs[SUM_PREFIX + key] = (torch.float32, shape)
+        specs[WEIGHT_PREFIX + key] = (torch.float64, ())
+        specs[COUNT_PREFIX + key] = (torch.int64, ())
+    return specs
+
+
+def state_metadata(merge_strategy, contributors, output_specs, precision):
+    """Builds the string metadata stored in the state file; precision is the precision setting the output was written with."""
+    return {
+        'god_mode_state_version': STATE_VERSION,
+        'merge_strategy': merge_strategy,
+        'precision': precision,
+        'contributors': json.dumps(contributors),
+        'output_dtypes': json.dumps({key: TORCH_TO_DTYPE[dtype] for key, (dtype, _) in output_specs.items()}),
+    }
+
+
+def read_state(state_path):
+    """
+    Reads the header of a God Mode state file.
+
+    Returns:
+    - A dict with 'merge_strategy', 'precision', 'contributors' (file name -> signature) and 'output_specs'
+      (key -> (output dtype, shape)), or None if the file is missing or from another version.
+    """
+    if not os.path.exists(state_path):
+        return None
+    try:
+        header, metadata, _ = read_header(state_path)
+        if int(metadata.get('god_mode_state_version', 0)) != STATE_VERSION:
+            return None
+        output_dtypes = json.loads(metadata['output_dtypes'])
+        output_specs = {
+            key: (DTYPE_TO_TORCH[output_dtypes[key]], tuple(header[SUM_PREFIX + key]['shape']))
+            for key in output_dtypes if SUM_PREFIX + key in header
+        }
+        return {
+            'merge_strategy': metadata['merge_strategy'],
+            'precision': metadata.get('precision'),
+            'contributors': json.loads(metadata['contributors']),
+            'output_specs': output_specs,
+        }
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning: Could not read God Mode state {state_path}: {e}")
+        return None
@@ -4,11 +4,13 @@ import os
 import sys
 import glob
 from rich.console import Console
-from rich.prompt import Prompt
+from rich.prompt import Prompt, IntPrompt
 from rich.panel import Panel
-from tqdm import tqdm
-from safetensors.torch import load_file as safe_load
 from tabulate import tabulate
+from model_inventory import scan_folder, format_params, format_dtypes
+from quantization import is_quantized_file
+from sparse_delta import is_sparse_file
+from config import MERGE_SVD_RANK
 
 # Initialize the Rich console
 console = Console()
@@ -28,15 +30,21 @@ def main_input():
         "\n[bold yellow]Would you like to merge:[/bold yellow]\n"
         "[1] Two LoRA models\n"
         "[2] A LoRA model into a main checkpoint\n"
-        "[3] God Mode"
+        "[3] God Mode\n"
+        "[4] Analyze LoRA models\n"
+        "[5] Compare LoRA models (similarity and conflicts)"
     )
-    choice = Prompt.ask("[bold green]Choose an option (1-3)[/bold green]")
+    choice = Prompt.ask("[bold green]Choose an option (1-5)[/bold green]")
 
     # Call the respective merge function based on the user's choice
     if choice == "1":
         settings = option_5_merge_lora()  # For merging two LoRA models
     elif choice == "2":
         settings = option_6_merge_lora_checkpoint()  # For merging a LoRA model into a checkpoint
+    elif choice == "4":
+        settings = option_lora_analysis()  # For profiling the LoRAs of 06-lora-analysis/input
+    elif choice == "5":
+        settings = option_lora_similarity()  # For finding conflicting LoRAs before God Mode
     else:
         settings = option_god_mode()  # For going mad shit crazy
 
@@ -314,7 +322,8 @@ def option_5_merge_lora():
 
     # Step 1: Scan the folder and make an inventory of all LoRA (.safetensor) files
     lora_folder = "05a-lora_merging"
-    lora_files = [f for f in os.listdir(lora_folder) if f.endswith('.safetensors') or f.endswith('.pt')]
+    # Quantized variants are deploy artifacts and cannot be merged directly
+    lora_files = [f for f in os.listdir(lora_folder) if (f.endswith('.safetensors') and not is_quantized_file(f) and not is_sparse_file(f)) or f.endswith('.pt')]
 
     if not lora_files:
         console.print(
@@ -330,25 +339,16 @@ def option_5_merge_lora():
         )
         return None
 
-    # Load LoRA details once
-    lora_details = []
-    with tqdm(total=len(lora_files), desc="Loading LoRA models", unit="file", dynamic_ncols=True) as progress_bar:
-        for i, lora_file in enumerate(lora_files, 1):
-            lora_path = os.path.join(lora_folder, lora_file)
-            lora_model = load_lora_model(lora_path)
-            num_layers = len(lora_model.keys())
-            file_size = get_file_size(lora_path)
-            lora_filename = lora_file.replace('.safetensors', '').replace('.pt', '')
-            lora_details.append([i, lora_filename, num_layers, f"{file_size:.2f} MB"])
-            progress_bar.update(1)
+    # Scan LoRA details once (served from the folder index when unchanged)
+    lora_details = scan_model_details(lora_folder, lora_files, "Scanning LoRA models")
 
     while True:
         # Display the table with LoRA details
         formatted_table = tabulate(
             lora_details,
-            headers=["Index", "LoRA Model", "Number of Layers", "File Size"],
+            headers=["Index", "LoRA Model", "Number of Layers", "Rank", "Parameters", "Dtype", "File Size"],
             tablefmt="pretty",
-            maxcolwidths=[None, 30, None, None]
+            maxcolwidths=[None, 30, None, None, None, None, None]
         )
 
         console.print(f"\n{formatted_table}")
@@ -391,21 +391,34 @@ def option_5_merge_lora():
             "[bold yellow]Choose the merging strategy:[/bold yellow]\n"
             "[1] Adaptive Merge (uses tensor norms and weight)\n"
             "[2] Manual Merge (uses fixed weights you specify)\n"
-            "[3] Additive Merge (uses 100% of the first and adds a percentage of the second)"
+            "[3] Additive Merge (uses 100% of the first and adds a percentage of the second)\n"
+            "[4] Exact Weighted Merge (concatenates the ranks of both LoRAs instead of blending them)\n"
+            "[5] Exact Additive Merge (concatenates the ranks; 100% of the first plus a percentage of the second)\n"
+            "[6] Compressed Merge (exact weighted merge re-factorized to a target rank with SVD)"
         )
-        strategy_choice = Prompt.ask("[bold green]Choose a strategy (1-3)[/bold green]", choices=["1", "2", "3"])
+        strategy_choice = Prompt.ask("[bold green]Choose a strategy (1-6)[/bold green]", choices=["1", "2", "3", "4", "5", "6"])
         if strategy_choice == "1":
             merge_type = "adaptive"
             console.print("[bold cyan]Selected Adaptive Merge strategy.[/bold cyan]")
         elif strategy_choice == "2":
             merge_type = "manual"
             console.print("[bold cyan]Selected Manual Merge strategy.[/bold cyan]")
-        else:
+        elif strategy_choice == "3":
             merge_type = "additive"
             console.print("[bold cyan]Selected Additive Merge strategy.[/bold cyan]")
+        elif strategy_choice == "4":
+            merge_type = "concat"
+            console.print("[bold cyan]Selected Exact Weighted Merge strategy.[/bold cyan]")
+        elif strategy_choice == "5":
+            merge_type = "concat_additive"
+            console.print("[bold cyan]Selected Exact Additive Merge strategy.[/bold cyan]")
+        else:
+            merge_type = "svd"
+            settings["svd_rank"] = IntPrompt.ask("[bold green]Enter the target rank of the merged LoRA[/bold green]", default=MERGE_SVD_RANK)
+            console.print(f"[bold cyan]Selected Compressed Merge strategy (rank {settings['svd_rank']}).[/bold cyan]")
 
         # Handle Additive Merge specific input
-        if merge_type == "additive":
+        if merge_type in ("additive", "concat_additive"):
             add_weight = float(Prompt.ask("[bold green]Enter the percentage of the second LoRA to add (e.g., 40 for 40%)[/bold green]"))
             settings["merge_strategy"] = "Additive"
             settings["add_weight"] = add_weight
@@ -414,7 +427,8 @@ def option_5_merge_lora():
         else:
             # Prompt for merge weight percentage
             weight_input = Prompt.ask(
-                "Enter the percentage to keep from the main model (0-100)\nYou can also type 'mix' for 25%, 50%, 75% versions"
+                "Enter the percentage to keep from the main model (0-100)\nYou can also type 'mix' for 25%, 50%, 75% versions, "
+                "or 'sweep' for a range of weights"
             )
 
             if weight_input.lower() == 'mix':
@@ -422,6 +436,18 @@ def option_5_merge_lora():
                 settings["weight_percentages"] = [25, 50, 75]
                 settings["merge_type"] = merge_type  # Apply the selected merge strategy to the mix
                 console.print(f"[bold cyan]You've chosen to create three versions with weights: 25%, 50%, and 75% using {merge_type} merge strategy.[/bold cyan]")
+            elif weight_input.lower() == 'sweep':
+                sweep_start = IntPrompt.ask("[bold green]First percentage of the sweep[/bold green]", default=10)
+                sweep_stop = IntPrompt.ask("[bold green]Last percentage of the sweep[/bold green]", default=90)
+                sweep_step = IntPrompt.ask("[bold green]Step between percentages[/bold green]", default=10)
+                percentages = sweep_percentages(sweep_start, sweep_stop, sweep_step)
+                if not percentages:
+                    console.print("[bold red]Invalid sweep. Use percentages between 0 and 100 and a positive step.[/bold red]")
+                    continue
+                settings["merge_strategy"] = "Sweep"
+                settings["weight_percentages"] = percentages
+                settings["merge_type"] = merge_type
+                console.print(f"[bold cyan]You've chosen to sweep {len(percentages)} versions from {percentages[0]}% to {percentages[-1]}% using {merge_type} merge strategy.[/bold cyan]")
             else:
                 try:
                     weight_percentage = float(weight_input)
@@ -446,8 +472,8 @@ def option_5_merge_lora():
             f"Merge Strategy: {settings['merge_strategy']}\n"
             f"Merge Type: {settings['merge_type']}"
         )
-        if settings["merge_strategy"] == "Mix":
-            console.print(f"Weight Percentages: 25%, 50%, 75% using {settings['merge_type']} strategy")
+        if settings["merge_strategy"] in ("Mix", "Sweep"):
+            console.print(f"Weight Percentages: {', '.join(f'{weight}%' for weight in settings['weight_percentages'])} using {settings['merge_type']} strategy")
         else:
             if "weight_percentage" in settings:
                 console.print(f"Weight Percentage: {settings['weight_percentage']}% using {settings['merge_type']} strategy")
@@ -470,6 +496,12 @@ def option_5_merge_lora():
 
     return settings
 
+def sweep_percentages(start, stop, step):
+    """Returns the weight percentages of a sweep from start to stop (inclusive), or an empty list if the range is invalid."""
+    if step <= 0 or not 0 <= start <= stop <= 100:
+        return []
+    return list(range(start, stop + 1, step))
+
 def option_6_merge_lora_checkpoint():
     """Handle input for merging a LoRA model into a main checkpoint."""
     console.print("----\n")  # Visual separator for entering the new section
@@ -481,7 +513,8 @@ def option_6_merge_lora_checkpoint():
     # Step 1: Scan the folder for LoRA models
     lora_folder = "05a-lora_merging"
     checkpoint_folder = "05b-checkpoint/input"  # Updated folder for input checkpoints
-    lora_files = [f for f in os.listdir(lora_folder) if f.endswith('.safetensors') or f.endswith('.pt')]
+    # Quantized variants are deploy artifacts and cannot be merged directly
+    lora_files = [f for f in os.listdir(lora_folder) if (f.endswith('.safetensors') and not is_quantized_file(f) and not is_sparse_file(f)) or f.endswith('.pt')]
     checkpoint_files = [f for f in os.listdir(checkpoint_folder) if f.endswith('.safetensors') or f.endswith('.pt')]
 
     if not lora_files or not checkpoint_files:
@@ -491,45 +524,26 @@ def option_6_merge_lora_checkpoint():
         )
         return None
 
-    # Display available models
-    lora_details = []
-    with tqdm(total=len(lora_files), desc="Loading LoRA models", unit="file", dynamic_ncols=True) as progress_bar:
-        for i, lora_file in enumerate(lora_files, 1):
-            lora_path = os.path.join(lora_folder, lora_file)
-            model = load_lora_model(lora_path)
-            num_layers = len(model.keys())
-            file_size = get_file_size(lora_path)
-            lora_filename = lora_file.replace('.safetensors', '').replace('.pt', '')
-            lora_details.append([i, lora_filename, num_layers, f"{file_size:.2f} MB"])
-            progress_bar.update(1)
-
-    checkpoint_details = []
-    with tqdm(total=len(checkpoint_files), desc="Loading Checkpoints", unit="file", dynamic_ncols=True) as progress_bar:
-        for i, checkpoint_file in enumerate(checkpoint_files, 1):
-            checkpoint_path = os.path.join(checkpoint_folder, checkpoint_file)
-            model = load_lora_model(checkpoint_path)
-            num_layers = len(model.keys())
-            file_size = get_file_size(checkpoint_path)
-            checkpoint_filename = checkpoint_file.replace('.safetensors', '').replace('.pt', '')
-            checkpoint_details.append([i, checkpoint_filename, num_layers, f"{file_size:.2f} MB"])
-            progress_bar.update(1)
+    # Display available models (served from the folder indexes when unchanged)
+    lora_details = scan_model_details(lora_folder, lora_files, "Scanning LoRA models")
+    checkpoint_details = scan_model_details(checkpoint_folder, checkpoint_files, "Scanning Checkpoints")
 
     while True:
         # Display the table with LoRA details
         formatted_lora_table = tabulate(
             lora_details,
-            headers=["Index", "LoRA Model", "Number of Layers", "File Size"],
+            headers=["Index", "LoRA Model", "Number of Layers", "Rank", "Parameters", "Dtype", "File Size"],
             tablefmt="pretty",
-            maxcolwidths=[None, 30, None, None]
+            maxcolwidths=[None, 30, None, None, None, None, None]
         )
         console.print(f"\n{formatted_lora_table}")
 
         # Display the table with checkpoint details
         formatted_checkpoint_table = tabulate(
             checkpoint_details,
-            headers=["Index", "Checkpoint Model", "Number of Layers", "File Size"],
+            headers=["Index", "Checkpoint Model", "Number of Layers", "Rank", "Parameters", "Dtype", "File Size"],
             tablefmt="pretty",
-            maxcolwidths=[None, 30, None, None]
+            maxcolwidths=[None, 30, None, None, None, None, None]
         )
         console.print(f"\n{formatted_checkpoint_table}")
 
@@ -621,10 +635,12 @@ def option_god_mode():
     console.print(
         "[bold yellow]Choose the merging strategy for God Mode:[/bold yellow]\n"
         "[1] Adaptive Merge (balances tensor weights)\n"
-        "[2] Additive Merge (adds tensor layers)"
+        "[2] Additive Merge (adds tensor layers)\n"
+        "[3] TIES Merge (keeps each LoRA's strongest values and averages those agreeing in sign)\n"
+        "[4] DARE Merge (randomly drops and rescales values, then averages all models)"
     )
-    strategy_choice = Prompt.ask("[bold green]Choose a strategy (1-2)[/bold green]", choices=["1", "2"])
-    merge_strategy = 'adaptive' if strategy_choice == "1" else 'additive'
+    strategy_choice = Prompt.ask("[bold green]Choose a strategy (1-4)[/bold green]", choices=["1", "2", "3", "4"])
+    merge_strategy = {"1": 'adaptive', "2": 'additive', "3": 'ties', "4": 'dare'}[strategy_choice]
 
     settings = {
         'utility': 'God Mode',
@@ -634,27 +650,76 @@ def option_god_mode():
 
     return settings
 
+def option_lora_analysis():
+    """Handle input for analyzing the LoRA models of 06-lora-analysis/input."""
+    console.print("----\n")  # Visual separator for entering the new section
+    console.print(
+        "[bold green]LoRA analysis reports per-layer norms, max values, sparsity, effective ranks and anomalies "
+        "of every model in 06-lora-analysis/input.[/bold green]\n"
+    )
+
+    input_folder = "06-lora-analysis/input"
+    model_files = [f for f in os.listdir(input_folder) if f.endswith('.safetensors')] if os.path.exists(input_folder) else []
+    if not model_files:
+        console.print(
+            "[bold red]Error: No .safetensors models found in 06-lora-analysis/input.[/bold red]\n"
+            "Please copy the LoRA models to analyze into this folder before proceeding."
+        )
+        return None
+
+    settings = {
+        'utility': 'Analyze LoRA',
+        'input_folder': input_folder,
+        'output_folder': "06-lora-analysis/output"
+    }
+
+    return settings
+
+def option_lora_similarity():
+    """Handle input for comparing the LoRA models of 05a-lora_merging with each other."""
+    console.print("----\n")  # Visual separator for entering the new section
+    console.print(
+        "[bold green]Compares every pair of LoRA models in 05a-lora_merging, block by block, to show which ones "
+        "reinforce or cancel each other before merging them in God Mode.[/bold green]\n"
+    )
+
+    lora_folder = "05a-lora_merging"
+    if not os.path.exists(lora_folder):
+        console.print(
+            "[bold red]Error: No LoRA folder found at 05a-lora_merging.[/bold red]\n"
+            "Please ensure that the folder contains LoRA models before proceeding."
+        )
+        return None
+
+    settings = {
+        'utility': 'Compare LoRA',
+        'lora_folder': lora_folder,
+        'output_folder': "06-lora-analysis/output"
+    }
+
+    return settings
+
 def get_file_size(file_path):
     """Returns the size of the file in MB."""
     return os.path.getsize(file_path) / (1024 * 1024)
 
-def load_lora_model(file_path):
-    file_size = get_file_size(file_path)
-    buffer = bytearray(os.path.getsize(file_path))
-    view = memoryview(buffer)
-
-    with open(file_path, "rb") as f:
-        while len(view):
-            bytes_read = f.readinto(view)
-            if bytes_read == 0:
-                break
-            view = view[bytes_read:]
-
-    if file_path.endswith('.safetensors'):
-        lora_model = safe_load(file_path)
-    else:
-        lora_model = torch.load(file_path)
-    return lora_model
+def scan_model_details(folder, files, desc, with_stats=False):
+    """Builds the table rows for a list of model files, served from the folder index when unchanged."""
+    inventories = scan_folder(folder, files, with_stats=with_stats, desc=desc)
+    details = []
+    for i, model_file in enumerate(files, 1):
+        inventory = inventories[model_file]
+        model_filename = model_file.replace('.safetensors', '').replace('.pt', '')
+        details.append([
+            i,
+            model_filename,
+            inventory['num_layers'],
+            inventory['rank'] if inventory['rank'] is not None else "-",
+            format_params(inventory['total_params']),
+            format_dtypes(inventory['dtypes']),
+            f"{inventory['size'] / (1024 * 1024):.2f} MB"
+        ])
+    return details
 
 def confirm_settings(settings):
     """Automatically confirm the settings without user input."""
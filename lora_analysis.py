@@ -0,0 +1,282 @@
+# lora_analysis.py
+import os
+import json
+import math
+from collections import Counter
+from contextlib import ExitStack
+import torch
+from safetensors import safe_open
+from tabulate import tabulate
+from tqdm import tqdm
+from safetensors_io import read_header, header_specs, num_elements, TORCH_TO_DTYPE
+from lora_key_map import parse_lora_modules, LORA_SUFFIXES
+from tensor_hashes import load_sidecar, save_sidecar
+from parallel_merge import run_parallel, resolve_workers, chunk_keys, worker_batch_bytes
+from config import ANALYSIS_SPARSITY_TOLERANCE
+
+# Version of the per-file analysis cached in each model's .tensors.json sidecar
+ANALYSIS_VERSION = 1
+
+# Name of the folder report written to the output folder
+REPORT_FILENAME = "lora_analysis.json"
+
+# Columns of the report, one value per layer
+REPORT_COLUMNS = ('layer', 'kind', 'dtype', 'shape', 'rank', 'alpha', 'norm', 'max_abs', 'sparsity', 'effective_rank', 'anomalies')
+
+
+def start(settings):
+    print(f"\n###################################\nAnalyzing LoRA models with settings: {settings}")
+
+    input_folder = settings.get('input_folder', "06-lora-analysis/input")
+    output_folder = settings.get('output_folder', "06-lora-analysis/output")
+    model_files = sorted(f for f in os.listdir(input_folder) if f.endswith('.safetensors'))
+    if not model_files:
+        print(f"No .safetensors models found in {input_folder}.")
+        return None
+
+    report_path = analyze_folder(input_folder, model_files, output_folder, settings.get('tolerance'))
+    print(f"Analysis report saved as: {report_path}")
+    print("Analysis completed! ✅")
+    return report_path
+
+
+def analyze_folder(input_folder, model_files, output_folder, tolerance=None, workers=None):
+    """
+    Analyzes every model file of a folder and writes a columnar report of all their layers.
+
+    Each file's analysis is cached in its .tensors.json sidecar (see tensor_hashes.py), so files
+    unchanged since their last analysis are not read again.
+
+    Returns:
+    - The path of the report: a JSON file with the list of analyzed files and one list per column
+      (see REPORT_COLUMNS), plus a 'file' column indexing that list.
+    """
+    tolerance = ANALYSIS_SPARSITY_TOLERANCE if tolerance is None else tolerance
+    columns = {'file': []}
+    columns.update((name, []) for name in REPORT_COLUMNS)
+    summary = []
+    for file_index, model_file in enumerate(model_files):
+        model_path = os.path.join(input_folder, model_file)
+        sidecar = load_sidecar(model_path)
+        analysis = sidecar.get('analysis')
+        if analysis is None or analysis.get('version') != ANALYSIS_VERSION or analysis.get('tolerance') != tolerance:
+            analysis = {'version': ANALYSIS_VERSION, 'tolerance': tolerance,
+                        'columns': analyze_model(model_path, tolerance, workers)}
+            sidecar['analysis'] = analysis
+            save_sidecar(model_path, sidecar)
+        else:
+            print(f"Unchanged since its last analysis: {model_file}")
+
+        file_columns = analysis['columns']
+        columns['file'].extend([file_index] * len(file_columns['layer']))
+        for name in REPORT_COLUMNS:
+            columns[name].extend(file_columns[name])
+        summary.append(summarize_model(model_file, file_columns))
+
+    os.makedirs(output_folder, exist_ok=True)
+    report_path = os.path.join(output_folder, REPORT_FILENAME)
+    with open(report_path + ".tmp", "w") as f:
+        json.dump({'version': ANALYSIS_VERSION, 'tolerance': tolerance, 'files': model_files, 'columns': columns}, f)
+    os.replace(report_path + ".tmp", report_path)
+
+    print(tabulate(summary, headers=["Model", "Layers", "LoRA Layers", "Rank", "Mean Effective Rank", "Total Norm", "Mean Sparsity", "Anomalies"],
+                   tablefmt="pretty"))
+    return report_path
+
+
+def analyze_model(model_path, tolerance, workers=None):
+    """
+    Computes the statistics of every layer of a .safetensors model, streaming one batch of tensors at a time.
+
+    LoRA layers (see lora_key_map.parse_lora_modules) get one row for their up/down/alpha keys:
+    their norm is that of the weight update up @ down * alpha / rank, and their effective rank
+    that of its singular values. The singular values come from a thin QR of each factor and the
+    SVD of the small rank x rank core, batched over layers with the same factor shapes. Every
+    other tensor gets a row of its own.
+
+    Returns:
+    - A dict mapping each column of REPORT_COLUMNS to its list of values, one per layer.
+    """
+    header, _, _ = read_header(model_path)
+    specs = header_specs(header)
+    modules, other_keys = parse_lora_modules(specs)
+
+    # Layers whose factors have the same shapes are decomposed in one batch
+    groups = {}
+    for name, parts in modules.items():
+        down_shape = specs[parts['down']][1]
+        up_shape = specs[parts['up']][1]
+        groups.setdefault((tuple(down_shape), tuple(up_shape)), []).append(name)
+    batches = []
+    for (down_shape, up_shape), names in groups.items():
+        layer_bytes = 4 * (num_elements(down_shape) + num_elements(up_shape))
+        batch_size = max(1, worker_batch_bytes(workers) // max(1, layer_bytes))
+        batches.extend(names[i:i + batch_size] for i in range(0, len(names), batch_size))
+
+    rows = {}
+    with ExitStack() as stack:
+        handle = stack.enter_context(safe_open(model_path, framework="pt", device="cpu"))
+
+        def module_task(names):
+            downs = []
+            ups = []
+            for name in names:
+                parts = modules[name]
+                down = handle.get_tensor(parts['down'])
+                up = handle.get_tensor(parts['up'])
+                stats = [tensor_stats(down, tolerance), tensor_stats(up, tolerance)]
+                rank = down.shape[0]
+                alpha = handle.get_tensor(parts['alpha']).item() if 'alpha' in parts else None
+                rows[name] = {
+                    'layer': name, 'kind': 'lora', 'dtype': TORCH_TO_DTYPE[down.dtype],
+                    'shape': f"{up.shape[0]}x{num_elements(down.shape[1:])}", 'rank': rank, 'alpha': alpha,
+                    'max_abs': max(stat['max_abs'] for stat in stats),
+                    'sparsity': sum(stat['zeros'] for stat in stats) / max(1, down.numel() + up.numel()),
+                    'finite': all(stat['finite'] for stat in stats),
+                    'up_dtype': TORCH_TO_DTYPE[up.dtype],
+                }
+                downs.append(down.float().reshape(rank, -1))
+                ups.append(up.float().reshape(up.shape[0], -1))
+                del down, up
+
+            if ups[0].shape[1] == downs[0].shape[0]:
+                singular_values = low_rank_singular_values(torch.stack(ups), torch.stack(downs))
+            else:
+                singular_values = None
+            for index, name in enumerate(names):
+                row = rows[name]
+                if singular_values is None:
+                    row['norm'] = None
+                    row['effective_rank'] = None
+                    continue
+                scale = (row['alpha'] if row['alpha'] is not None else row['rank']) / row['rank']
+                values = singular_values[index]
+                row['norm'] = abs(scale) * torch.linalg.vector_norm(values).item()
+                row['effective_rank'] = effective_rank(values)
+            pbar.update(len(names))
+
+        def tensor_task(keys):
+            for key in keys:
+                tensor = handle.get_tensor(key)
+                stats = tensor_stats(tensor, tolerance)
+                rows[key] = {
+                    'layer': key, 'kind': 'tensor', 'dtype': TORCH_TO_DTYPE[tensor.dtype],
+                    'shape': "x".join(str(dim) for dim in tensor.shape), 'rank': None, 'alpha': None,
+                    'norm': stats['norm'], 'max_abs': stats['max_abs'],
+                    'sparsity': stats['zeros'] / max(1, tensor.numel()), 'effective_rank': None,
+                    'finite': stats['finite'], 'up_dtype': None,
+                }
+                del tensor
+            pbar.update(len(keys))
+
+        with tqdm(total=len(modules) + len(other_keys), desc=f"Analyzing {os.path.basename(model_path)}", unit="layer") as pbar:
+            run_parallel(batches, module_task, workers)
+            run_parallel(chunk_keys(sorted(other_keys), resolve_workers(workers)), tensor_task, workers)
+
+    rows = [rows[name] for name in sorted(rows)]
+    for row, anomalies in zip(rows, layer_anomalies(rows)):
+        row['anomalies'] = "; ".join(anomalies)
+    return {name: [row[name] for row in rows] for name in REPORT_COLUMNS}
+
+
+def tensor_stats(tensor, tolerance):
+    """
+    Returns the L2 norm, max absolute value, near-zero count and finiteness of a tensor.
+
+    Values whose magnitude is at most tolerance times the tensor's max absolute value count as zeros.
+    """
+    if tensor.numel() == 0 or not (tensor.dtype.is_floating_point or tensor.dtype == torch.int8):
+        return {'norm': 0.0, 'max_abs': 0.0, 'zeros': 0, 'finite': True}
+    magnitudes = tensor.float().abs()
+    finite = bool(torch.isfinite(magnitudes).all())
+    if not finite:
+        magnitudes = torch.nan_to_num(magnitudes, nan=0.0, posinf=0.0)
+    max_abs = magnitudes.max().item()
+    stats = {
+        'norm': torch.linalg.vector_norm(magnitudes).item(),
+        'max_abs': max_abs,
+        'zeros': int((magnitudes <= tolerance * max_abs).sum()),
+        'finite': finite,
+    }
+    del magnitudes
+    return stats
+
+
+def low_rank_singular_values(ups, downs):
+    """
+    Batched singular values of the products ups @ downs without forming them.
+
+    With ups = Qu Ru and downs^T = Qd Rd (thin QR), ups @ downs and the small core Ru Rd^T have
+    the same singular values.
+    """
+    ups = torch.nan_to_num(ups, nan=0.0, posinf=0.0, neginf=0.0)
+    downs = torch.nan_to_num(downs, nan=0.0, posinf=0.0, neginf=0.0)
+    _, r_up = torch.linalg.qr(ups)
+    _, r_down = torch.linalg.qr(downs.transpose(1, 2))
+    return torch.linalg.svdvals(r_up @ r_down.transpose(1, 2))
+
+
+def effective_rank(singular_values):
+    """Effective rank of a layer: the exponential of the entropy of its normalized singular values (0 for a zero layer)."""
+    total = singular_values.sum().item()
+    if total <= 0:
+        return 0.0
+    p = singular_values[singular_values > 0] / total
+    return math.exp(-(p * p.log()).sum().item())
+
+
+def layer_anomalies(rows):
+    """
+    Flags the layers of one model that look inconsistent with the rest of it.
+
+    Returns:
+    - One list of anomaly descriptions per row: non-finite values, dtypes or LoRA ranks differing from
+      the model's most common one, mismatched factors, all-zero layers, missing alphas when other layers
+      have one, and LoRA factors left without their counterpart.
+    """
+    dtypes = Counter(row['dtype'] for row in rows if row['dtype'] in ('F16', 'BF16', 'F32', 'F64'))
+    ranks = Counter(row['rank'] for row in rows if row['kind'] == 'lora')
+    common_dtype = dtypes.most_common(1)[0][0] if dtypes else None
+    common_rank = ranks.most_common(1)[0][0] if ranks else None
+    has_alphas = any(row['alpha'] is not None for row in rows if row['kind'] == 'lora')
+
+    anomalies = []
+    for row in rows:
+        found = []
+        if not row['finite']:
+            found.append("non-finite values")
+        if common_dtype and row['dtype'] in dtypes and row['dtype'] != common_dtype:
+            found.append(f"dtype {row['dtype']} (model is mostly {common_dtype})")
+        if row['kind'] == 'lora':
+            if row['up_dtype'] != row['dtype']:
+                found.append(f"up factor is {row['up_dtype']}, down factor is {row['dtype']}")
+            if row['norm'] is None:
+                found.append("up and down factors have mismatched ranks")
+            if row['rank'] != common_rank:
+                found.append(f"rank {row['rank']} (model is mostly rank {common_rank})")
+            if has_alphas and row['alpha'] is None:
+                found.append("missing alpha")
+        elif row['layer'].endswith(tuple(suffix for suffix, part in LORA_SUFFIXES if part != 'alpha')):
+            found.append("LoRA factor without its counterpart")
+        if row['max_abs'] == 0 and row['dtype'].startswith(('F', 'BF')):
+            found.append("all zeros")
+        anomalies.append(found)
+    return anomalies
+
+
+def summarize_model(model_file, columns):
+    """Builds the summary table row of one analyzed model."""
+    lora_rows = [index for index, kind in enumerate(columns['kind']) if kind == 'lora']
+    ranks = sorted({columns['rank'][index] for index in lora_rows})
+    effective_ranks = [columns['effective_rank'][index] for index in lora_rows if columns['effective_rank'][index] is not None]
+    norms = [norm for norm in columns['norm'] if norm is not None]
+    return [
+        model_file.replace('.safetensors', ''),
+        len(columns['layer']),
+        len(lora_rows),
+        ", ".join(str(rank) for rank in ranks) if ranks else "-",
+        f"{sum(effective_ranks) / len(effective_ranks):.2f}" if effective_ranks else "-",
+        f"{math.sqrt(sum(norm * norm for norm in norms)):.4g}",
+        f"{sum(columns['sparsity']) / max(1, len(columns['sparsity'])):.2%}",
+        sum(1 for anomalies in columns['anomalies'] if anomalies),
+    ]
@@ -0,0 +1,216 @@
+# lora_key_map.py
+import re
+
+# Key suffixes of the factors of a LoRA layer, for each naming convention
+LORA_SUFFIXES = (
+    (".lora_down.weight", 'down'), (".lora_up.weight", 'up'), (".alpha", 'alpha'),  # kohya
+    (".lora_A.weight", 'down'), (".lora_B.weight", 'up'),                           # peft
+    (".lora.down.weight", 'down'), (".lora.up.weight", 'up'),                       # diffusers
+)
+
+# Module prefixes of peft and diffusers LoRAs, and the kohya prefix they correspond to
+LORA_MODULE_PREFIXES = (
+    ("unet.", "lora_unet_"),
+    ("text_encoder_2.", "lora_te2_"),
+    ("text_encoder.", "lora_te_"),
+)
+
+# Weight prefixes of checkpoint formats, and the kohya prefixes of the LoRA modules targeting them. The first text
+# encoder of SDXL is lora_te1_ in kohya LoRAs but lora_te_ in diffusers ones, so its weights are registered under both.
+CHECKPOINT_PREFIXES = (
+    ("model.diffusion_model.", ("lora_unet_",)),
+    ("cond_stage_model.transformer.", ("lora_te_",)),
+    ("conditioner.embedders.0.transformer.", ("lora_te1_", "lora_te_")),
+    ("conditioner.embedders.1.model.", ("lora_te2_",)),
+    ("unet.", ("lora_unet_",)),
+    ("text_encoder_2.", ("lora_te2_",)),
+    ("text_encoder.", ("lora_te_", "lora_te1_")),
+    ("", ("lora_unet_",)),
+)
+
+# Renames between the layers of the OpenCLIP text encoder of original SDXL checkpoints and the CLIP layers LoRAs name
+OPENCLIP_RENAMES = {
+    "attn.out_proj": "self_attn.out_proj", "mlp.c_fc": "mlp.fc1", "mlp.c_proj": "mlp.fc2",
+    "ln_1": "layer_norm1", "ln_2": "layer_norm2",
+}
+
+# OpenCLIP stores the q, k and v projections stacked in one in_proj_weight, in this order along its rows
+OPENCLIP_IN_PROJ = ("self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj")
+
+# Renames between the resnet layers of original (LDM) UNet checkpoints and diffusers
+RESNET_RENAMES = {
+    "in_layers.0": "norm1", "in_layers.2": "conv1", "emb_layers.1": "time_emb_proj",
+    "out_layers.0": "norm2", "out_layers.3": "conv2", "skip_connection": "conv_shortcut",
+}
+UNET_RENAMES = {
+    "time_embed.0": "time_embedding.linear_1", "time_embed.2": "time_embedding.linear_2",
+    "out.0": "conv_norm_out", "out.2": "conv_out",
+}
+
+
+def kohya_module_name(module):
+    """Converts a peft or diffusers LoRA module path to the flat kohya module name (e.g. lora_unet_down_blocks_0_...)."""
+    if module.startswith("base_model.model."):
+        module = module[len("base_model.model."):]
+    if module.startswith("lora_"):
+        return module
+    for prefix, kohya_prefix in LORA_MODULE_PREFIXES:
+        if module.startswith(prefix):
+            return kohya_prefix + module[len(prefix):].replace(".", "_")
+    return "lora_unet_" + module.replace(".", "_")
+
+
+def parse_lora_modules(keys):
+    """
+    Groups the keys of a LoRA file by layer.
+
+    Returns:
+    - modules: Dict mapping each kohya module name to its {'down', 'up', 'alpha'} keys (alpha may be missing).
+    - other_keys: Keys that are not low-rank factors (full tensors or unsupported layer types).
+    """
+    modules = {}
+    other_keys = []
+    for key in keys:
+        for suffix, part in LORA_SUFFIXES:
+            if key.endswith(suffix):
+                modules.setdefault(kohya_module_name(key[:-len(suffix)]), {})[part] = key
+                break
+        else:
+            other_keys.append(key)
+
+    # A layer needs both factors; alpha alone or a lone factor cannot be baked
+    for name in [name for name, parts in modules.items() if 'down' not in parts or 'up' not in parts]:
+        other_keys.extend(modules.pop(name).values())
+    return modules, other_keys
+
+
+def ldm_unet_to_diffusers(path):
+    """Converts an original (LDM) UNet module path to its diffusers equivalent, or None if it has none."""
+    for ldm_name, diffusers_name in UNET_RENAMES.items():
+        if path == ldm_name:
+            return diffusers_name
+
+    match = re.match(r"(input_blocks|middle_block|output_blocks)\.(\d+)\.?(\d+)?\.?(.*)", path)
+    if not match:
+        return None
+    block, first, second, rest = match.group(1), int(match.group(2)), match.group(3), match.group(4)
+
+    if block == "middle_block":
+        # middle_block.N.rest has no second index
+        rest = ".".join(part for part in (second, rest) if part)
+        if first == 1:
+            return f"mid_block.attentions.0.{rest}"
+        return f"mid_block.resnets.{first // 2}.{resnet_rename(rest)}"
+
+    if second is None:
+        return None
+    second = int(second)
+    if block == "input_blocks":
+        if first == 0:
+            return f"conv_in{'.' + rest if rest else ''}" if second == 0 else None
+        level, index = divmod(first - 1, 3)
+        if index == 2:
+            return f"down_blocks.{level}.downsamplers.0.conv" if rest == "op" else None
+        if second == 0:
+            return f"down_blocks.{level}.resnets.{index}.{resnet_rename(rest)}"
+        return f"down_blocks.{level}.attentions.{index}.{rest}"
+
+    level, index = divmod(first, 3)
+    if second == 0:
+        return f"up_blocks.{level}.resnets.{index}.{resnet_rename(rest)}"
+    if rest == "conv":
+        return f"up_blocks.{level}.upsamplers.0.conv"
+    return f"up_blocks.{level}.attentions.{index}.{rest}"
+
+
+def resnet_rename(path):
+    """Renames the layers inside an LDM resnet block to their diffusers names."""
+    for ldm_name, diffusers_name in RESNET_RENAMES.items():
+        if path == ldm_name or path.startswith(ldm_name + "."):
+            return diffusers_name + path[len(ldm_name):]
+    return path
+
+
+def openclip_to_clip(path):
+    """
+    Converts a weight path of the OpenCLIP text encoder of original SDXL checkpoints to the CLIP layers it holds.
+
+    Returns:
+    - A list of (CLIP module path, row block) pairs: in_proj_weight holds the q, k and v projections
+      as row blocks (index, 3), other weights a single module (block None). Empty if it has no equivalent.
+    """
+    match = re.match(r"transformer\.resblocks\.(\d+)\.(.*)", path)
+    if not match:
+        return []
+    layer = f"text_model.encoder.layers.{match.group(1)}"
+    if match.group(2) == "attn.in_proj_weight":
+        return [(f"{layer}.{name}", (index, len(OPENCLIP_IN_PROJ))) for index, name in enumerate(OPENCLIP_IN_PROJ)]
+    if match.group(2).endswith(".weight") and match.group(2)[:-len(".weight")] in OPENCLIP_RENAMES:
+        return [(f"{layer}.{OPENCLIP_RENAMES[match.group(2)[:-len('.weight')]]}", None)]
+    return []
+
+
+def checkpoint_module_table(checkpoint_keys):
+    """
+    Precomputes the table mapping kohya LoRA module names to the checkpoint weights they modify.
+
+    Every checkpoint weight is registered under the name a LoRA would give it, both with the
+    checkpoint's own layer names and, for original (LDM) UNet checkpoints, with the diffusers
+    layer names used by most SD 1.x LoRAs. The OpenCLIP text encoder of original SDXL checkpoints
+    is registered under the CLIP layer names of SDXL LoRAs, its stacked q/k/v projections as row blocks.
+
+    Returns:
+    - A dict mapping module names to (checkpoint key, row block); the row block (index, count) of a
+      module stored stacked with others is the index-th of count equal row blocks, None for whole weights.
+    """
+    table = {}
+    for key in checkpoint_keys:
+        for prefix, kohya_prefixes in CHECKPOINT_PREFIXES:
+            if not key.startswith(prefix):
+                continue
+            if prefix == "conditioner.embedders.1.model.":
+                module_paths = openclip_to_clip(key[len(prefix):])
+            elif key.endswith(".weight"):
+                module_path = key[len(prefix):-len(".weight")]
+                module_paths = [(module_path, None)]
+                if prefix == "model.diffusion_model.":
+                    diffusers_path = ldm_unet_to_diffusers(module_path)
+                    if diffusers_path:
+                        module_paths.append((diffusers_path, None))
+            else:
+                module_paths = []
+            for module_path, row_block in module_paths:
+                for kohya_prefix in kohya_prefixes:
+                    table.setdefault(kohya_prefix + module_path.replace(".", "_"), (key, row_block))
+            break
+    return table
+
+
+def plan_lora_bake(lora_keys, checkpoint_keys):
+    """
+    Maps every layer of a LoRA to the checkpoint weight it modifies.
+
+    Returns:
+    - plan: Dict mapping checkpoint keys to the list of LoRA modules ({'down', 'up', 'alpha'} keys)
+      or full tensors ({'tensor'} key, for LoRA keys named exactly like a checkpoint weight) added to them.
+      A module targeting one row block of a stacked weight also has a 'rows' entry (index, count).
+    - unmatched: LoRA keys with no matching checkpoint weight; they are not written to the output.
+    """
+    checkpoint_keys = set(checkpoint_keys)
+    modules, other_keys = parse_lora_modules(lora_keys)
+    table = checkpoint_module_table(checkpoint_keys)
+
+    plan = {}
+    unmatched = []
+    for name, parts in modules.items():
+        if name in table:
+            key, row_block = table[name]
+            plan.setdefault(key, []).append(dict(parts, rows=row_block) if row_block else parts)
+        else:
+            unmatched.extend(parts.values())
+    for key in other_keys:
+        if key in checkpoint_keys:
+            plan.setdefault(key, []).append({'tensor': key})
+        else:
+            unmatched.append(key)
+    return plan, sorted(unmatched)
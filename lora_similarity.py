@@ -0,0 +1,201 @@
+# lora_similarity.py
+import os
+import re
+import json
+from collections import Counter
+from contextlib import ExitStack
+import torch
+from safetensors import safe_open
+from tabulate import tabulate
+from tqdm import tqdm
+from safetensors_io import read_header, header_specs, num_elements
+from lora_key_map import parse_lora_modules
+from parallel_merge import run_parallel, resolve_workers, chunk_keys
+from god_mode_state import is_god_mode_file
+from quantization import is_quantized_file
+from sparse_delta import is_sparse_file
+from config import MERGE_BATCH_BYTES
+
+# Name of the similarity report written to the output folder
+SIMILARITY_FILENAME = "lora_similarity.json"
+
+# Number of most similar and most conflicting pairs printed after a comparison
+SIMILARITY_TOP_PAIRS = 10
+
+
+def start(settings):
+    print(f"\n###################################\nComparing LoRA models with settings: {settings}")
+
+    lora_folder = settings.get('lora_folder', "05a-lora_merging")
+    output_folder = settings.get('output_folder', "06-lora-analysis/output")
+    # The same LoRAs God Mode would merge, leaving out its outputs and quantized variants
+    lora_files = sorted(f for f in os.listdir(lora_folder)
+                        if f.endswith('.safetensors') and not is_god_mode_file(f)
+                        and not is_quantized_file(f) and not is_sparse_file(f))
+    if len(lora_files) < 2:
+        print(f"At least two .safetensors LoRA models are needed in {lora_folder} to compare them.")
+        return None
+
+    report = similarity_report([os.path.join(lora_folder, f) for f in lora_files])
+    print_similarity_summary(report)
+
+    os.makedirs(output_folder, exist_ok=True)
+    report_path = os.path.join(output_folder, SIMILARITY_FILENAME)
+    with open(report_path + ".tmp", "w") as f:
+        json.dump(report, f)
+    os.replace(report_path + ".tmp", report_path)
+    print(f"Similarity report saved as: {report_path}")
+    print("Comparison completed! ✅")
+    return report_path
+
+
+def similarity_report(model_paths, workers=None):
+    """
+    Computes the pairwise cosine similarity and conflict of N LoRA files, per block and overall, reading each file once.
+
+    Each layer shared by at least two files is read once from every file that has it, and the N x N
+    Gram matrix of the layer's weight updates (all their pairwise dot products) is computed in one
+    vectorized operation: for LoRA layers straight from the low-rank factors, as
+    <U_a D_a, U_b D_b> = sum((U_a^T U_b) * (D_a D_b^T)), without forming the dense updates.
+    Per block (e.g. lora_unet_down_blocks_0) and overall:
+    - cosine[a][b] is the cosine similarity of the two LoRAs' concatenated weight updates. A layer
+      only one of them changes lowers their similarity.
+    - conflict[a][b] is the share of the pair's magnitude (sum over layers of |dW_a| |dW_b|) found in
+      layers where their updates point in opposite directions (negative dot products), i.e. how much of
+      the pair cancels out when merged.
+
+    Returns:
+    - A JSON-serializable report: the file names, the 'overall' and per-block matrices, and for each
+      file its mean similarity and conflict with the others.
+    """
+    count = len(model_paths)
+    layers = {}
+    for file_index, model_path in enumerate(model_paths):
+        specs = header_specs(read_header(model_path)[0])
+        modules, other_keys = parse_lora_modules(specs)
+        for name, parts in modules.items():
+            update_shape = (specs[parts['up']][1][0], num_elements(specs[parts['down']][1][1:]))
+            layers.setdefault(name, []).append((file_index, parts, update_shape))
+        for key in other_keys:
+            layers.setdefault(key, []).append((file_index, {'tensor': key}, (num_elements(specs[key][1]),)))
+
+    # Files whose update shape differs from the most common one for a layer are left out of that layer
+    shared = {}
+    for name, entries in layers.items():
+        common_shape = Counter(entry[2] for entry in entries).most_common(1)[0][0]
+        entries = [entry for entry in entries if entry[2] == common_shape]
+        if len(entries) > 1:
+            shared[name] = entries
+    names = sorted(shared)
+
+    with ExitStack() as stack:
+        handles = [stack.enter_context(safe_open(model_path, framework="pt", device="cpu")) for model_path in model_paths]
+
+        def gram_task(chunk_names):
+            grams = [layer_gram([handles[entry[0]] for entry in shared[name]], [entry[1] for entry in shared[name]])
+                     for name in chunk_names]
+            pbar.update(len(chunk_names))
+            return grams
+
+        with tqdm(total=len(names), desc=f"Comparing {count} LoRA models", unit="layer") as pbar:
+            chunk_grams = run_parallel(chunk_keys(names, resolve_workers(workers)), gram_task, workers)
+
+    # Layers are summed in name order, so the report does not depend on the worker count
+    blocks = {}
+    for name, gram in zip(names, (gram for grams in chunk_grams for gram in grams)):
+        indices = torch.tensor([entry[0] for entry in shared[name]])
+        norms = gram.diagonal().clamp(min=0).sqrt()
+        block = blocks.setdefault(layer_block(name), {
+            'gram': torch.zeros(count, count, dtype=torch.float64),
+            'negative': torch.zeros(count, count, dtype=torch.float64),
+            'magnitude': torch.zeros(count, count, dtype=torch.float64),
+        })
+        pair = (indices[:, None], indices[None, :])
+        block['gram'][pair] += gram
+        block['negative'][pair] += (-gram).clamp(min=0)
+        block['magnitude'][pair] += norms[:, None] * norms[None, :]
+    overall = {name: sum((block[name] for block in blocks.values()), torch.zeros(count, count, dtype=torch.float64))
+               for name in ('gram', 'negative', 'magnitude')}
+
+    overall_matrices = similarity_matrices(overall)
+    off_diagonal = ~torch.eye(count, dtype=torch.bool)
+    cosine = torch.tensor(overall_matrices['cosine'])
+    conflict = torch.tensor(overall_matrices['conflict'])
+    return {
+        'files': [os.path.basename(path) for path in model_paths],
+        'shared_layers': len(names),
+        'overall': overall_matrices,
+        'blocks': {block_name: similarity_matrices(blocks[block_name]) for block_name in sorted(blocks)},
+        'mean_similarity': (cosine * off_diagonal).sum(dim=1).div(max(1, count - 1)).tolist(),
+        'mean_conflict': (conflict * off_diagonal).sum(dim=1).div(max(1, count - 1)).tolist(),
+    }
+
+
+def layer_gram(handles, parts_list):
+    """
+    Gram matrix (all pairwise dot products) of the weight updates one layer has in several files.
+
+    LoRA factors are zero-padded to the largest rank (which leaves up @ down unchanged) and stacked,
+    so the whole matrix comes from batched fp32 products of rank x rank matrices (summed in fp64),
+    computed a few rows at a time to keep them within MERGE_BATCH_BYTES.
+    """
+    if 'tensor' in parts_list[0]:
+        flat = torch.stack([handle.get_tensor(parts['tensor']).double().flatten() for handle, parts in zip(handles, parts_list)])
+        return flat @ flat.T
+
+    downs = []
+    ups = []
+    for handle, parts in zip(handles, parts_list):
+        down = handle.get_tensor(parts['down']).float()
+        up = handle.get_tensor(parts['up']).float()
+        rank = down.shape[0]
+        alpha = handle.get_tensor(parts['alpha']).item() if 'alpha' in parts else rank
+        downs.append(down.reshape(rank, -1))
+        ups.append(up.reshape(up.shape[0], -1) * (alpha / rank))
+    max_rank = max(down.shape[0] for down in downs)
+    stacked_downs = torch.zeros((len(downs), max_rank, downs[0].shape[1]))
+    stacked_ups = torch.zeros((len(ups), ups[0].shape[0], max_rank))
+    for index, (down, up) in enumerate(zip(downs, ups)):
+        stacked_downs[index, :down.shape[0]] = down
+        stacked_ups[index, :, :up.shape[1]] = up
+    count = len(parts_list)
+    gram = torch.empty((count, count), dtype=torch.float64)
+    rows = max(1, MERGE_BATCH_BYTES // (8 * count * max_rank * max_rank))
+    for start in range(0, count, rows):
+        up_products = torch.einsum('aor,bos->abrs', stacked_ups[start:start + rows], stacked_ups)
+        down_products = torch.einsum('ari,bsi->abrs', stacked_downs[start:start + rows], stacked_downs)
+        gram[start:start + rows] = (up_products * down_products).sum(dim=(2, 3), dtype=torch.float64)
+    return gram
+
+
+def layer_block(name):
+    """Returns the block a layer belongs to, e.g. lora_unet_down_blocks_0 or lora_te1_text_model_encoder_layers_3."""
+    match = re.match(r"(.*?_(?:blocks?|layers)_\d+)", name)
+    if match:
+        return match.group(1)
+    return "_".join(name.split("_")[:2]) if name.startswith("lora_") else "other"
+
+
+def similarity_matrices(sums):
+    """Derives the cosine similarity and conflict matrices from summed Gram, negative and magnitude matrices."""
+    norms = sums['gram'].diagonal().clamp(min=0).sqrt()
+    scale = norms[:, None] * norms[None, :]
+    cosine = torch.where(scale > 0, sums['gram'] / scale.clamp(min=1e-300), torch.zeros_like(scale))
+    conflict = torch.where(sums['magnitude'] > 0, sums['negative'] / sums['magnitude'].clamp(min=1e-300), torch.zeros_like(scale))
+    return {'cosine': cosine.clamp(-1, 1).tolist(), 'conflict': conflict.tolist()}
+
+
+def print_similarity_summary(report):
+    """Prints the most similar and most conflicting pairs of a similarity report."""
+    files = [name.replace('.safetensors', '') for name in report['files']]
+    cosine = report['overall']['cosine']
+    conflict = report['overall']['conflict']
+    pairs = [(a, b) for a in range(len(files)) for b in range(a + 1, len(files))]
+
+    print(f"Compared {len(files)} LoRA models over {report['shared_layers']} shared layers.")
+    for title, key in (("Most conflicting pairs", lambda pair: -conflict[pair[0]][pair[1]]),
+                       ("Most similar pairs", lambda pair: -cosine[pair[0]][pair[1]])):
+        rows = [[files[a], files[b], f"{cosine[a][b]:.3f}", f"{conflict[a][b]:.1%}"]
+                for a, b in sorted(pairs, key=key)[:SIMILARITY_TOP_PAIRS]]
+        print(title)
+        print(tabulate(rows, headers=["LoRA", "LoRA", "Cosine Similarity", "Conflict"], tablefmt="pretty"))
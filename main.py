@@ -7,6 +7,8 @@ import generate_prompt
 import generate_style
 import merge_lora
 import merge_lora_checkpoint  # Add this import
+import lora_analysis
+import lora_similarity
 
 def main():
     # Invoke boot routine
@@ -35,7 +37,11 @@ def dispatch_utility(settings):
     elif utility == "Merge LoRA Checkpoint":  # Add this new condition
         merge_lora_checkpoint.start(settings)
     elif utility == "God Mode":
-        merge_lora.god_mode(settings['lora_folder'], settings['merge_strategy'])
+        merge_lora.god_mode(settings['lora_folder'], settings['merge_strategy'], precision=settings.get('precision'), quantize=settings.get('quantize'))
+    elif utility == "Analyze LoRA":
+        lora_analysis.start(settings)
+    elif utility == "Compare LoRA":
+        lora_similarity.start(settings)
     else:
         print(f"Unknown utility: {utility}")
 
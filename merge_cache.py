@@ -0,0 +1,135 @@
+# merge_cache.py
+import os
+import json
+import time
+import hashlib
+from safetensors_io import read_header
+from tensor_hashes import content_hash
+
+# Name of the per-folder index of input hashes and cached merge results
+CACHE_INDEX_FILENAME = ".merge_cache.json"
+CACHE_VERSION = 1
+
+# Metadata entry of a merged file holding the cache key it was produced for
+CACHE_KEY_METADATA = "merge_cache_key"
+
+# Bytes hashed at a time when fingerprinting an input file
+HASH_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def load_cache_index(folder):
+    """Loads the merge cache index of a folder, or an empty index if missing or unreadable."""
+    index_path = os.path.join(folder, CACHE_INDEX_FILENAME)
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        if index.get('version') == CACHE_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {'version': CACHE_VERSION, 'hashes': {}, 'results': {}}
+
+
+def save_cache_index(folder, index):
+    """Writes the merge cache index of a folder atomically."""
+    index_path = os.path.join(folder, CACHE_INDEX_FILENAME)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def file_hash(file_path, index):
+    """
+    Returns the content hash of a file, reusing a stored hash while its size and mtime are unchanged.
+
+    A .safetensors file is fingerprinted from the per-tensor hashes of its sidecar (see
+    tensor_hashes.content_hash), which the layer reuse of the merge needs too, so each input is only
+    read once for hashing. Other files are hashed with BLAKE2b in large sequential chunks, the hash
+    being stored in the index.
+    """
+    if file_path.endswith(".safetensors"):
+        return content_hash(file_path)
+    stat = os.stat(file_path)
+    entry = index['hashes'].get(os.path.abspath(file_path))
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['hash']
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    index['hashes'][os.path.abspath(file_path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def result_key(input_paths, parameters, index):
+    """Returns the cache key of a merge: a hash of its ordered input contents and its parameters (strategy, weight, dtype...)."""
+    payload = {
+        'version': CACHE_VERSION,
+        'inputs': [file_hash(path, index) for path in input_paths],
+        'parameters': parameters,
+    }
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def stored_key(file_path):
+    """Returns the cache key embedded in a merged file's metadata, or None."""
+    try:
+        _, metadata, _ = read_header(file_path)
+    except (OSError, ValueError):
+        return None
+    return metadata.get(CACHE_KEY_METADATA)
+
+
+def cached_result(index, key, output_path):
+    """
+    Returns the path of an existing merge result for a cache key, or None.
+
+    The indexed result is checked first, then the requested output path, so results are still
+    found if the index was lost. A file only counts if the key embedded in its metadata matches.
+    """
+    entry = index['results'].get(key)
+    for path in ([entry['path']] if entry else []) + [output_path]:
+        if os.path.exists(path) and stored_key(path) == key:
+            record_result(index, key, path)
+            return path
+    return None
+
+
+def record_result(index, key, file_path):
+    """Registers a merge result under its cache key and marks it as the most recently used."""
+    index['results'][key] = {'path': file_path, 'size': os.path.getsize(file_path), 'last_used': time.time()}
+
+
+def evict_results(index, max_bytes, keep=()):
+    """
+    Deletes the least recently used cached results until the cache fits in max_bytes.
+
+    Only files registered as merge results are ever deleted, and never those in keep (the results
+    of the current request). A max_bytes of 0 disables eviction.
+
+    Returns:
+    - The list of deleted file paths.
+    """
+    for key, entry in list(index['results'].items()):
+        if not os.path.exists(entry['path']) or stored_key(entry['path']) != key:
+            del index['results'][key]
+    for path in [path for path in index['hashes'] if not os.path.exists(path)]:
+        del index['hashes'][path]
+    if max_bytes <= 0:
+        return []
+
+    keep = {os.path.abspath(path) for path in keep}
+    total = sum(entry['size'] for entry in index['results'].values())
+    evicted = []
+    for key, entry in sorted(index['results'].items(), key=lambda item: item[1]['last_used']):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(entry['path']) in keep:
+            continue
+        os.remove(entry['path'])
+        total -= entry['size']
+        evicted.append(entry['path'])
+        del index['results'][key]
+    return evicted
@@ -1,38 +1,114 @@
 # merge_lora.py
 import os
+import json
 import time
+import math
+import hashlib
 import sys
+import queue
+import multiprocessing
 import torch
+from contextlib import ExitStack, suppress
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from safetensors.torch import load_file, save_file
+from safetensors import safe_open
+from safetensors_io import read_header, header_specs, SafetensorsWriter, save_tensors, prepare_safetensors, DTYPE_SIZES, TORCH_TO_DTYPE, num_elements
+from parallel_merge import run_parallel, resolve_workers, chunk_keys, worker_batch_bytes
+from buffer_pool import MERGE_BUFFERS
+from quantization import write_quantized_variant, is_quantized_file, quantized_path
+from sparse_delta import write_sparse_variant, is_sparse_file, sparse_path
+from merge_cache import load_cache_index, save_cache_index, result_key, cached_result, record_result, evict_results, CACHE_KEY_METADATA
+from lora_key_map import parse_lora_modules
+from tensor_hashes import tensor_hashes, input_digest, record_output_inputs, PreviousOutputs
+from god_mode_state import state_file_path, is_god_mode_file, file_signature, state_specs, state_metadata, read_state, SUM_PREFIX, WEIGHT_PREFIX, COUNT_PREFIX
+from config import MERGE_BATCH_BYTES, MERGE_INTRA_OP_THREADS, MERGE_PRECISION, MERGE_QUANTIZE, MERGE_SPARSE, MERGE_CONCAT_FOLD, MERGE_SVD_RANK, MERGE_SVD_ENERGY, MERGE_CACHE_BYTES, GOD_MODE_RAM_BUDGET, GOD_MODE_RAM_FRACTION, GOD_MODE_PROCESSES, GOD_MODE_SHARD_BYTES, GOD_MODE_SAVE_STATE, GOD_MODE_TIES_DENSITY, GOD_MODE_DARE_DROP_RATE, GOD_MODE_LAYER_RANK
 from input import option_5_merge_lora
 import psutil
 
+# Number of elements reduced by a single thread in tensor_norms (torch's internal parallel grain size)
+NORM_CHUNK_SIZE = 32768
+
+# Output dtypes selectable with the precision option; merges are then computed in fp32
+PRECISION_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16, 'fp32': torch.float32}
+
+# Merge types computed by concat_merge_variants: weighted and additive merges concatenating the ranks
+CONCAT_MERGE_TYPES = ('concat', 'concat_additive')
+
+# Version of the adaptive merge formula, part of the cache parameters so results of older formulas are recomputed
+ADAPTIVE_MERGE_VERSION = 2
+
+# Version of God Mode's DARE strategy, part of the layer input digests so layers merged by older versions are merged again
+DARE_MERGE_VERSION = 2
+
+# God Mode strategies whose merge is a ratio of running sums, which its state file can update incrementally
+RUNNING_SUM_STRATEGIES = ('adaptive', 'additive')
+
+# God Mode strategies merging each LoRA layer's weight update up @ down * alpha / rank, then re-factorizing it
+UPDATE_STRATEGIES = ('ties', 'dare')
+
+# Power iterations of the randomized SVD re-factorizing TIES and DARE layers
+RANDOMIZED_SVD_ITERATIONS = 4
+
+# Bytes of stacked model updates TIES and DARE layer merges build and merge at once, small enough to stay in the CPU cache
+UPDATE_TILE_BYTES = 512 * 1024
+
+# Preferred number of rows of those tiles, so their batched matmuls are not matrix-vector products
+UPDATE_TILE_ROWS = 16
+
+# Update entries sampled per model to estimate the magnitude threshold of a TIES layer
+TIES_SAMPLE_SIZE = 2048
+
 def start(settings):
     print(f"\n###################################\nMerging LoRA with settings: {settings}")
 
-    # Load the LoRA models
+    # Locate the LoRA models
     lora_folder = "05a-lora_merging"
     main_lora_path = os.path.join(lora_folder, settings['main_lora'])
     merge_lora_path = os.path.join(lora_folder, settings['merge_lora'])
 
-    main_lora_model = load_file(main_lora_path)
-    merge_lora_model = load_file(merge_lora_path)
-
-    # Choose the merging strategy based on the settings
-    if settings['merge_strategy'] == 'Mix':
-        merged_models = merge_loras_mix(main_lora_model, merge_lora_model, settings['weight_percentages'], settings['merge_type'])
+    if settings['merge_strategy'] in ('Mix', 'Sweep'):
+        # A sweep is a Mix over any list of weights, all merged in one streamed pass
+        weights = [weight / 100 for weight in settings['weight_percentages']]
     elif settings['merge_strategy'] == 'Additive':
-        merged_model = additive_merge(main_lora_model, merge_lora_model, settings['add_weight'] / 100)
-        merged_models = [(settings['add_weight'] / 100, merged_model)]
+        weights = [settings['add_weight'] / 100]
     else:  # Weighted
-        merge_type = settings.get('merge_type', 'adaptive')
-        merged_model = merge_loras_weighted(main_lora_model, merge_lora_model, settings['weight_percentage'] / 100, merge_type)
-        merged_models = [(settings['weight_percentage'] / 100, merged_model)]
+        weights = [settings['weight_percentage'] / 100]
+    weights = list(dict.fromkeys(weights))
+    merged_lora_names = [merged_lora_filename(settings['main_lora'], settings['merge_lora'], weight, settings['merge_type']) for weight in weights]
+    output_paths = [os.path.join(lora_folder, name) for name in merged_lora_names]
+    if len(set(output_paths)) < len(output_paths):
+        duplicates = sorted({name for name in merged_lora_names if merged_lora_names.count(name) > 1})
+        print(f"Error: several weights would be saved under the same name ({', '.join(duplicates)}); use whole percentages.")
+        return None
 
-    # Save the merged models
-    for weight, merged_model in merged_models:
-        save_merged_lora(merged_model, lora_folder, settings['main_lora'], settings['merge_lora'], weight, settings['merge_type'])
+    # Variants already merged from identical inputs and parameters are served from the merge cache
+    cache_index = load_cache_index(lora_folder)
+    cache_keys = [result_key([main_lora_path, merge_lora_path], merge_cache_parameters(settings, weight), cache_index) for weight in weights]
+    pending = []
+    for index, (output_path, cache_key) in enumerate(zip(output_paths, cache_keys)):
+        cached_path = cached_result(cache_index, cache_key, output_path)
+        if cached_path is None:
+            pending.append(index)
+        else:
+            output_paths[index] = cached_path
+            print(f"Identical merge found in cache: {os.path.basename(cached_path)}")
+
+    if pending:
+        merge_lora_variants(settings, main_lora_path, merge_lora_path, [weights[index] for index in pending],
+                            [output_paths[index] for index in pending], [{CACHE_KEY_METADATA: cache_keys[index]} for index in pending])
+    quantize = settings.get('quantize', MERGE_QUANTIZE)
+    sparse = settings.get('sparse', MERGE_SPARSE)
+    for index, output_path in enumerate(output_paths):
+        if index in pending:
+            record_result(cache_index, cache_keys[index], output_path)
+            print(f"Merged LoRA saved as: {os.path.basename(output_path)}")
+        if quantize and (index in pending or not os.path.exists(quantized_path(output_path, quantize))):
+            write_quantized_variant(output_path, quantize)
+        if sparse and (index in pending or not os.path.exists(sparse_path(output_path))):
+            write_sparse_variant(output_path)
+    for evicted_path in evict_results(cache_index, settings.get('cache_bytes', MERGE_CACHE_BYTES), keep=output_paths):
+        print(f"Evicted least recently used merge from cache: {os.path.basename(evicted_path)}")
+    save_cache_index(lora_folder, cache_index)
 
     print("Merging completed! ✅")
     print(" ")
@@ -41,101 +117,822 @@ def start(settings):
     completed(settings)
 
 
+def merge_lora_variants(settings, main_lora_path, merge_lora_path, weights, output_paths, output_metadata=None):
+    """Merges two LoRA files at several weights with the strategy and merge type of the settings, one output file per weight."""
+    merge_type = settings.get('merge_type', 'adaptive')
+    if merge_type in CONCAT_MERGE_TYPES:
+        # Exact merges concatenate the low-rank factors instead of blending them element-wise
+        if settings['merge_strategy'] == 'Additive':
+            weight_pairs = [(1.0, weight) for weight in weights]
+        else:
+            weight_pairs = [(weight, 1 - weight) for weight in weights]
+        concat_merge_variants(main_lora_path, merge_lora_path, output_paths, weight_pairs, fold=settings.get('fold'),
+                              precision=settings.get('precision'), output_metadata=output_metadata)
+        return
+    if merge_type == 'svd':
+        svd_merge_variants(main_lora_path, merge_lora_path, output_paths, [(weight, 1 - weight) for weight in weights],
+                           rank=settings.get('svd_rank'), energy=settings.get('svd_energy'), precision=settings.get('precision'),
+                           output_metadata=output_metadata)
+        return
+
+    # Every other strategy streams one tensor pair at a time straight to the output files, all variants in a single pass
+    if settings['merge_strategy'] == 'Additive':
+        merge_fn = lambda tensor1, tensor2: [additive_merge_key(tensor1, tensor2, weights[0])]
+        batch_fn = lambda stacked1, stacked2: additive_merge_batched(stacked1, stacked2, weights[0])
+        desc = "Additive Merging LoRA models"
+    else:
+        merge_fn = lambda tensor1, tensor2: weighted_merge_variants(tensor1, tensor2, weights, merge_type)
+        batch_fn = lambda stacked1, stacked2: weighted_merge_batched(stacked1, stacked2, weights, merge_type)
+        desc = f"Merging {len(weights)} LoRA variants" if len(weights) > 1 else "Merging LoRA models"
+    stream_merge_variants(main_lora_path, merge_lora_path, output_paths, merge_fn, desc, batch_fn,
+                          precision=settings.get('precision'), output_metadata=output_metadata,
+                          output_parameters=[merge_cache_parameters(settings, weight) for weight in weights])
+
+
+def merge_cache_parameters(settings, weight):
+    """Returns the merge parameters that determine the content of one merged variant, as part of its cache key."""
+    merge_type = settings.get('merge_type', 'adaptive')
+    parameters = {
+        'strategy': 'Additive' if settings['merge_strategy'] == 'Additive' else 'Weighted',
+        'merge_type': merge_type,
+        'weight': weight,
+        'precision': settings.get('precision') or MERGE_PRECISION,
+    }
+    if merge_type == 'adaptive':
+        # Adaptive merges before version 2 ignored the main weight; their cached results are not reused
+        parameters['adaptive_version'] = ADAPTIVE_MERGE_VERSION
+    if merge_type in CONCAT_MERGE_TYPES:
+        parameters['fold'] = MERGE_CONCAT_FOLD if settings.get('fold') is None else settings['fold']
+    if merge_type == 'svd':
+        parameters['svd_rank'] = MERGE_SVD_RANK if settings.get('svd_rank') is None else settings['svd_rank']
+        parameters['svd_energy'] = MERGE_SVD_ENERGY if settings.get('svd_energy') is None else settings['svd_energy']
+    return parameters
+
+
+def stream_merge(main_lora_path, merge_lora_path, output_path, merge_fn, desc="Merging LoRA models"):
+    """
+    Merges two model files one tensor pair at a time and writes each result as soon as it is computed.
+
+    Tensors are read lazily through safe_open, so peak memory stays around the largest single
+    tensor instead of the size of the models.
+
+    Args:
+    - main_lora_path: Path of the main .safetensors file (the LoRA, or the checkpoint for checkpoint merges).
+    - merge_lora_path: Path of the LoRA .safetensors file to merge with.
+    - output_path: Path of the merged .safetensors file to write.
+    - merge_fn: Function (tensor1, tensor2) -> merged tensor, where a missing tensor is None.
+    """
+    stream_merge_variants(main_lora_path, merge_lora_path, [output_path],
+                          lambda tensor1, tensor2: [merge_fn(tensor1, tensor2)], desc)
+
+
+def stream_merge_variants(main_lora_path, merge_lora_path, output_paths, variants_fn, desc="Merging LoRA models", batch_fn=None, workers=None, precision=None, output_metadata=None, output_parameters=None):
+    """
+    Merges two model files into several output files in a single pass over the inputs.
+
+    Each input tensor is read once, and variants_fn yields one merged tensor per output path. Each
+    variant is written and its buffer released before the next one is computed, so a sweep over
+    many weights holds about one merged tensor at a time and the input I/O is that of a single merge.
+
+    With output_parameters, the per-tensor hashes of both inputs are compared with those the
+    previous outputs were merged from (see tensor_hashes.py): only keys whose source tensors or
+    parameters changed are merged again, and the other tensors are copied from the previous outputs.
+
+    Args:
+    - main_lora_path: Path of the main .safetensors file (the LoRA, or the checkpoint for checkpoint merges).
+    - merge_lora_path: Path of the LoRA .safetensors file to merge with.
+    - output_paths: Paths of the merged .safetensors files to write.
+    - variants_fn: Function (tensor1, tensor2) -> iterable of merged tensors (one per output), where a missing tensor is None.
+    - batch_fn: Optional function (stacked1, stacked2) -> iterable of merged stacks (one per output), used on
+      stacks of shared keys with the same shape and dtype (see plan_merge_batches).
+    - workers: Number of merge worker threads (defaults to MERGE_WORKERS in config.py).
+    - precision: Output precision ('auto', 'fp16', 'bf16', 'fp32'; defaults to MERGE_PRECISION in config.py). Except
+      for 'auto', which keeps the input dtypes, tensors are upcast to fp32 one at a time for the merge math.
+    - output_metadata: Optional list of string metadata dicts, one per output path.
+    - output_parameters: Optional list of JSON-serializable merge parameters, one per output path, enabling the
+      reuse of unchanged tensors from the previous outputs.
+    """
+    output_dtype = resolve_precision(precision)
+    load = (lambda handle, key: upcast(handle.get_tensor(key))) if output_dtype is not None else (lambda handle, key: handle.get_tensor(key))
+
+    main_header, main_metadata, _ = read_header(main_lora_path)
+    merge_header, merge_metadata, _ = read_header(merge_lora_path)
+    for path, metadata in ((main_lora_path, main_metadata), (merge_lora_path, merge_metadata)):
+        if metadata.get('quantization'):
+            raise ValueError(f"{os.path.basename(path)} is a quantized model; load it with quantization.load_dequantized instead of merging it directly")
+        if metadata.get('sparse_encoding'):
+            raise ValueError(f"{os.path.basename(path)} is a sparse model; load it with sparse_delta.SparseDeltaReader instead of merging it directly")
+    main_specs = header_specs(main_header)
+    merge_specs = header_specs(merge_header)
+    all_keys = sorted(set(main_specs).union(merge_specs))
+
+    output_specs = with_output_dtype({key: merged_spec(main_specs.get(key), merge_specs.get(key)) for key in all_keys}, output_dtype)
+
+    key_inputs = []
+    if output_parameters is not None:
+        main_hashes = tensor_hashes(main_lora_path, workers=workers)
+        merge_hashes = tensor_hashes(merge_lora_path, workers=workers)
+        key_inputs = [{key: input_digest(parameters, main_hashes.get(key), merge_hashes.get(key)) for key in all_keys}
+                      for parameters in output_parameters]
+
+    with ExitStack() as stack:
+        # The previous outputs are moved aside before the writers replace them
+        previous = stack.enter_context(PreviousOutputs(output_paths if key_inputs else [], key_inputs))
+        reused_keys = previous.reusable_keys([output_specs] * len(output_paths))
+        merge_keys = [key for key in all_keys if key not in reused_keys]
+        if reused_keys:
+            print(f"Reusing {len(reused_keys)} unchanged layers from the previous merge; merging {len(merge_keys)} changed layers")
+        if batch_fn is not None:
+            batches, single_keys = plan_merge_batches(merge_keys, main_specs, merge_specs, worker_batch_bytes(workers))
+        else:
+            batches, single_keys = [], merge_keys
+
+        main_file = stack.enter_context(safe_open(main_lora_path, framework="pt", device="cpu"))
+        merge_file = stack.enter_context(safe_open(merge_lora_path, framework="pt", device="cpu"))
+        writers = [stack.enter_context(SafetensorsWriter(path, output_specs, metadata))
+                   for path, metadata in zip(output_paths, output_metadata or [None] * len(output_paths))]
+        stack.enter_context(MERGE_BUFFERS.session())
+
+        def merge_task(task):
+            batch_keys, kind = task
+            if kind == 'reuse':
+                for key in batch_keys:
+                    previous.copy(writers, key)
+            elif kind == 'batch':
+                tensors1 = [load(main_file, key) for key in batch_keys]
+                tensors2 = [load(merge_file, key) for key in batch_keys]
+                stacked1 = stack_tensors(tensors1)
+                stacked2 = stack_tensors(tensors2)
+                MERGE_BUFFERS.release(*tensors1, *tensors2)
+                del tensors1, tensors2
+                for merged_stack, writer in zip(batch_fn(stacked1, stacked2), writers):
+                    for key, merged_tensor in zip(batch_keys, merged_stack.unbind(0)):
+                        writer.write(key, merged_tensor)
+                    MERGE_BUFFERS.release(merged_stack)
+                MERGE_BUFFERS.release(stacked1, stacked2)
+                del stacked1, stacked2
+            else:
+                for key in batch_keys:
+                    tensor1 = load(main_file, key) if key in main_specs else None
+                    tensor2 = load(merge_file, key) if key in merge_specs else None
+                    for merged_tensor, writer in zip(variants_fn(tensor1, tensor2), writers):
+                        writer.write(key, merged_tensor)
+                        # Variants that pass an input through unchanged are released with the inputs
+                        if merged_tensor is not tensor1 and merged_tensor is not tensor2:
+                            MERGE_BUFFERS.release(merged_tensor)
+                    MERGE_BUFFERS.release(tensor1, tensor2)
+                    del tensor1, tensor2
+            pbar.update(len(batch_keys))
+
+        # Batches and chunks of single keys are merged in parallel, each writing to its own region of the outputs
+        tasks = [(batch_keys, 'batch') for batch_keys in batches]
+        tasks += [(chunk, 'single') for chunk in chunk_keys(single_keys, resolve_workers(workers))]
+        tasks += [(chunk, 'reuse') for chunk in chunk_keys(sorted(reused_keys), resolve_workers(workers))]
+        with tqdm(total=len(all_keys), desc=desc, unit="layer") as pbar:
+            run_parallel(tasks, merge_task, workers)
+
+    for output_path, inputs in zip(output_paths, key_inputs):
+        record_output_inputs(output_path, inputs)
+
+
+def plan_merge_batches(keys, specs1, specs2, max_bytes=MERGE_BATCH_BYTES):
+    """
+    Groups keys present in both models with the same shape and dtype into batches for the batched merge engine.
+
+    Each batch holds at most max_bytes of input tensors per model; callers running batches on several
+    workers pass worker_batch_bytes so the batches in flight together stay within MERGE_BATCH_BYTES. Keys missing from one model,
+    keys whose two tensors differ in shape or dtype, and groups of a single key are returned separately.
+
+    Returns:
+    - batches: List of key lists, each sharing one (dtype, shape).
+    - single_keys: Keys to merge one at a time.
+    """
+    groups = {}
+    single_keys = []
+    for key in keys:
+        spec1 = specs1.get(key)
+        if spec1 is not None and spec1 == specs2.get(key):
+            groups.setdefault(spec1, []).append(key)
+        else:
+            single_keys.append(key)
+
+    batches = []
+    for (dtype, shape), group_keys in groups.items():
+        if len(group_keys) < 2:
+            single_keys.extend(group_keys)
+            continue
+        tensor_bytes = max(1, num_elements(shape) * DTYPE_SIZES[TORCH_TO_DTYPE[dtype]])
+        batch_size = max(1, max_bytes // tensor_bytes)
+        batches.extend(group_keys[i:i + batch_size] for i in range(0, len(group_keys), batch_size))
+    return batches, single_keys
+
+
+def merged_spec(spec1, spec2):
+    """Returns the (dtype, shape) of merging two tensors given their (dtype, shape), either of which may be None."""
+    if spec1 is None:
+        return spec2
+    if spec2 is None:
+        return spec1
+    dtype = torch.promote_types(spec1[0], spec2[0])
+    shape = tuple(max(s1, s2) for s1, s2 in zip(spec1[1], spec2[1]))
+    return dtype, shape
+
+
+def resolve_precision(precision=None):
+    """Returns the output dtype of a precision option, or None for 'auto' (keep the input dtypes)."""
+    precision = MERGE_PRECISION if precision is None else precision
+    if precision == 'auto':
+        return None
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f"Unknown precision: {precision} (expected 'auto', 'fp16', 'bf16' or 'fp32')")
+    return PRECISION_DTYPES[precision]
+
+
+def with_output_dtype(specs, output_dtype):
+    """Replaces the dtype of every floating point spec with the output dtype of the precision option (if any)."""
+    if output_dtype is None:
+        return specs
+    return {key: (output_dtype if dtype.is_floating_point else dtype, shape) for key, (dtype, shape) in specs.items()}
+
+
+def upcast(tensor):
+    """Returns a pooled fp32 copy of a half or lower precision tensor for fp32 compute; other tensors are returned as is."""
+    if not tensor.dtype.is_floating_point or tensor.element_size() >= 4:
+        return tensor
+    return MERGE_BUFFERS.acquire(tensor.shape, torch.float32).copy_(tensor)
+
+
 def merge_loras_mix(main_lora_model, merge_lora_model, weight_percentages, merge_type):
-    """Merges two LoRA models using multiple weight percentages."""
-    merged_models = []
-    for weight in weight_percentages:
-        merged_model = merge_loras_weighted(main_lora_model, merge_lora_model, weight / 100, merge_type)
-        merged_models.append((weight / 100, merged_model))
-    return merged_models
+    """Merges two LoRA models using multiple weight percentages, computing every variant in a single pass over the keys."""
+    weights = [weight / 100 for weight in weight_percentages]
+    merged_variants = merge_loras_batched(main_lora_model, merge_lora_model, weights, merge_type, f"Merging {len(weights)} LoRA variants")
+    return list(zip(weights, merged_variants))
 
 
 def merge_loras_weighted(main_lora_model, merge_lora_model, main_weight, merge_type='adaptive'):
     """Merges two LoRA models using adaptive or manual merge with a specified main weight."""
-    merged_model = {}
+    return merge_loras_batched(main_lora_model, merge_lora_model, [main_weight], merge_type)[0]
+
+
+def merge_loras_batched(main_lora_model, merge_lora_model, main_weights, merge_type='adaptive', desc="Merging LoRA models", workers=None):
+    """Merges two in-memory LoRA models at several main weights, batching same-shape keys together."""
+    merged_models = [{} for _ in main_weights]
     all_keys = set(main_lora_model.keys()).union(set(merge_lora_model.keys()))
+    main_specs = {key: (tensor.dtype, tuple(tensor.shape)) for key, tensor in main_lora_model.items()}
+    merge_specs = {key: (tensor.dtype, tuple(tensor.shape)) for key, tensor in merge_lora_model.items()}
+    batches, single_keys = plan_merge_batches(sorted(all_keys), main_specs, merge_specs, worker_batch_bytes(workers))
+
+    def merge_task(task):
+        batch_keys, is_batch = task
+        if is_batch:
+            stacked1 = stack_tensors([main_lora_model[key] for key in batch_keys])
+            stacked2 = stack_tensors([merge_lora_model[key] for key in batch_keys])
+            for merged_stack, merged_model in zip(weighted_merge_batched(stacked1, stacked2, main_weights, merge_type), merged_models):
+                for key, merged_tensor in zip(batch_keys, merged_stack.unbind(0)):
+                    # Clone so each key owns its storage instead of viewing the stacked batch
+                    merged_model[key] = merged_tensor.clone()
+                MERGE_BUFFERS.release(merged_stack)
+            MERGE_BUFFERS.release(stacked1, stacked2)
+        else:
+            for key in batch_keys:
+                variants = weighted_merge_variants(main_lora_model.get(key), merge_lora_model.get(key), main_weights, merge_type)
+                for merged_model, merged_tensor in zip(merged_models, variants):
+                    merged_model[key] = merged_tensor
+        pbar.update(len(batch_keys))
 
-    with tqdm(total=len(all_keys), desc="Merging LoRA models", unit="layer") as pbar:
-        for key in all_keys:
-            if key in main_lora_model and key in merge_lora_model:
-                if merge_type == 'adaptive':
-                    merged_model[key] = adaptive_merge(main_lora_model[key], merge_lora_model[key], main_weight)
-                else:
-                    merged_model[key] = manual_merge(main_lora_model[key], merge_lora_model[key], main_weight)
-            elif key in main_lora_model:
-                merged_model[key] = main_lora_model[key]
-            else:
-                merged_model[key] = merge_lora_model[key]
-            pbar.update(1)
+    tasks = [(batch_keys, True) for batch_keys in batches]
+    tasks += [(chunk, False) for chunk in chunk_keys(single_keys, resolve_workers(workers))]
+    with tqdm(total=len(all_keys), desc=desc, unit="layer") as pbar, MERGE_BUFFERS.session():
+        run_parallel(tasks, merge_task, workers)
 
-    return merged_model
+    return merged_models
 
 
-def additive_merge(main_lora_model, merge_lora_model, add_weight):
+def additive_merge(main_lora_model, merge_lora_model, add_weight, workers=None):
     """Always use 100% of the first model and add the second model at a specified percentage."""
     merged_model = {}
     all_keys = set(main_lora_model.keys()).union(set(merge_lora_model.keys()))
 
-    with tqdm(total=len(all_keys), desc="Additive Merging LoRA models", unit="layer") as pbar:
-        for key in all_keys:
-            if key in main_lora_model and key in merge_lora_model:
-                tensor1 = main_lora_model[key]
-                tensor2 = merge_lora_model[key]
-                if tensor1.size() != tensor2.size():
-                    tensor1, tensor2 = pad_tensors(tensor1, tensor2)
-                merged_model[key] = tensor1 + (add_weight * tensor2)
-            elif key in main_lora_model:
-                merged_model[key] = main_lora_model[key]
-            else:
-                merged_model[key] = add_weight * merge_lora_model[key]
-            pbar.update(1)
+    def merge_chunk(keys):
+        for key in keys:
+            merged_model[key] = additive_merge_key(main_lora_model.get(key), merge_lora_model.get(key), add_weight)
+        pbar.update(len(keys))
+
+    with tqdm(total=len(all_keys), desc="Additive Merging LoRA models", unit="layer") as pbar, MERGE_BUFFERS.session():
+        run_parallel(chunk_keys(sorted(all_keys), resolve_workers(workers)), merge_chunk, workers)
 
     return merged_model
 
 
+def weighted_merge_key(tensor1, tensor2, main_weight, merge_type='adaptive'):
+    """Merges one key of two LoRA models; a tensor present in only one model is kept as is."""
+    return next(iter(weighted_merge_variants(tensor1, tensor2, [main_weight], merge_type)))
+
+
+def weighted_merge_variants(tensor1, tensor2, main_weights, merge_type='adaptive'):
+    """
+    Merges one key of two LoRA models at several main weights; a tensor present in only one model is kept as is.
+
+    Returns an iterable of merged tensors, one per main weight, computed lazily as it is consumed.
+    """
+    if tensor1 is not None and tensor2 is not None:
+        if merge_type == 'adaptive':
+            return adaptive_merge_variants(tensor1, tensor2, main_weights)
+        return manual_merge_variants(tensor1, tensor2, main_weights)
+    kept = tensor1 if tensor1 is not None else tensor2
+    return [kept for _ in main_weights]
+
+
+def additive_merge_key(tensor1, tensor2, add_weight):
+    """Adds one key of the second model at add_weight to the first; a key only in the second model is scaled."""
+    if tensor1 is not None and tensor2 is not None:
+        return weighted_sum([tensor1, tensor2], [1.0, add_weight])
+    if tensor1 is not None:
+        return tensor1
+    return weighted_sum([tensor2], [add_weight])
+
+
 def adaptive_merge(tensor1, tensor2, main_weight):
     """Merges two tensors using adaptive weights based on their L2 norms."""
-    if tensor1.size() != tensor2.size():
-        tensor1, tensor2 = pad_tensors(tensor1, tensor2)
+    return next(adaptive_merge_variants(tensor1, tensor2, [main_weight]))
+
+
+def adaptive_merge_variants(tensor1, tensor2, main_weights):
+    """
+    Adaptive merge of two tensors at several main weights, computing the norms only once.
+
+    The merged tensors are yielded one main weight at a time: after the norms, each extra weight
+    only costs one fused blend. Tensors of different shapes are merged as if zero-padded to the same size, without padded
+    copies; their norms come from the unpadded originals, which zero padding does not change.
+    """
+    norm1 = tensor_norm(tensor1)
+    norm2 = tensor_norm(tensor2)
+
+    for main_weight in main_weights:
+        yield blend(tensor1, tensor2, adaptive_weight(norm1, norm2, main_weight))
+    MERGE_BUFFERS.release(norm1, norm2)
 
-    norm1 = torch.norm(tensor1)
-    norm2 = torch.norm(tensor2)
 
-    adaptive_weight1 = norm1 / (norm1 + norm2)
-    adaptive_weight2 = norm2 / (norm1 + norm2)
+def adaptive_weight(norm1, norm2, main_weight):
+    """
+    Blend weight of the first tensor in an adaptive merge: the main weight skews the norm-based balance.
+
+    Each tensor's norm is scaled by its share of the main weight, so 50% gives the plain norm ratio
+    norm1 / (norm1 + norm2), while 0% and 100% keep only one tensor. Works on norms of any shape
+    (one per stacked tensor); where both scaled norms are zero the main weight is used as is.
+    """
+    scaled1 = norm1 * main_weight
+    total = scaled1 + norm2 * (1 - main_weight)
+    return torch.where(total > 0, scaled1 / total, torch.full_like(total, main_weight))
 
-    final_weight1 = adaptive_weight1 * main_weight + (1 - adaptive_weight2) * (1 - main_weight)
-    final_weight2 = 1 - final_weight1
 
-    return final_weight1 * tensor1 + final_weight2 * tensor2
+def tensor_norm(tensor):
+    """L2 norm of a tensor whose value does not depend on the torch thread count."""
+    return tensor_norms(tensor.unsqueeze(0))[0]
+
+
+def tensor_norms(stacked):
+    """
+    L2 norm of every tensor in a stack, independent of the torch thread count.
+
+    A plain torch.norm over a large tensor splits the reduction across intra-op threads, so its
+    last bits change with the thread count. Reducing fixed-size chunks (each one always summed by
+    a single thread) and then combining the chunk norms keeps merges byte-identical whatever the
+    number of workers and intra-op threads. The norms and chunk norms are pooled buffers.
+    """
+    batch_size = stacked.size(0)
+    flat = stacked.reshape(batch_size, -1)
+    numel = flat.size(1)
+    norms = MERGE_BUFFERS.acquire((batch_size,), flat.dtype)
+    if numel <= NORM_CHUNK_SIZE:
+        return torch.norm(flat, dim=1, out=norms)
+
+    num_chunks = numel // NORM_CHUNK_SIZE
+    remainder = numel > num_chunks * NORM_CHUNK_SIZE
+    chunk_norms = MERGE_BUFFERS.acquire((batch_size, num_chunks + remainder), flat.dtype)
+    torch.norm(flat[:, :num_chunks * NORM_CHUNK_SIZE].reshape(batch_size, num_chunks, NORM_CHUNK_SIZE), dim=2, out=chunk_norms[:, :num_chunks])
+    if remainder:
+        torch.norm(flat[:, num_chunks * NORM_CHUNK_SIZE:], dim=1, keepdim=True, out=chunk_norms[:, num_chunks:])
+    torch.norm(chunk_norms, dim=1, out=norms)
+    MERGE_BUFFERS.release(chunk_norms)
+    return norms
 
 
 def manual_merge(tensor1, tensor2, main_weight):
     """Merges two tensors using fixed weights based on user input."""
-    if tensor1.size() != tensor2.size():
-        tensor1, tensor2 = pad_tensors(tensor1, tensor2)
+    return next(manual_merge_variants(tensor1, tensor2, [main_weight]))
+
+
+def manual_merge_variants(tensor1, tensor2, main_weights):
+    """Manual merge of two tensors at several fixed main weights, yielded one at a time; tensors of different shapes are merged as if zero-padded."""
+    for main_weight in main_weights:
+        yield blend(tensor1, tensor2, main_weight)
+
+
+def weighted_merge_batched(stacked1, stacked2, main_weights, merge_type='adaptive'):
+    """Batched adaptive or manual merge of two stacks of same-shape, same-dtype tensors; yields one merged stack per main weight."""
+    if merge_type == 'adaptive':
+        yield from adaptive_merge_batched(stacked1, stacked2, main_weights)
+        return
+    for main_weight in main_weights:
+        yield torch.lerp(stacked2, stacked1, main_weight, out=MERGE_BUFFERS.acquire(stacked1.shape, stacked1.dtype))
+
+
+def adaptive_merge_batched(stacked1, stacked2, main_weights):
+    """
+    Adaptive merge of two stacks of same-shape tensors, with the same arithmetic as adaptive_merge.
+
+    All norms and adaptive weights are computed once, with one operation per stack instead of
+    several small calls per key, and each blend is applied to the whole stack at once. The merged
+    stacks are yielded one main weight at a time, so once a stack is written and released the
+    next weight reuses its buffer.
+    """
+    batch_size = stacked1.size(0)
+    norm1 = tensor_norms(stacked1)
+    norm2 = tensor_norms(stacked2)
+
+    broadcast_shape = (batch_size,) + (1,) * (stacked1.dim() - 1)
+    for main_weight in main_weights:
+        yield torch.lerp(stacked2, stacked1, adaptive_weight(norm1, norm2, main_weight).view(broadcast_shape),
+                         out=MERGE_BUFFERS.acquire(stacked1.shape, stacked1.dtype))
+    MERGE_BUFFERS.release(norm1, norm2)
+
+
+def additive_merge_batched(stacked1, stacked2, add_weight):
+    """Batched additive merge of two stacks of same-shape, same-dtype tensors; returns a list with the one merged stack."""
+    return [torch.add(stacked1, stacked2, alpha=add_weight, out=MERGE_BUFFERS.acquire(stacked1.shape, stacked1.dtype))]
+
+
+def concat_merge_variants(main_lora_path, merge_lora_path, output_paths, weight_pairs, desc="Rank-concatenating LoRA models", fold=None, workers=None, precision=None, output_metadata=None):
+    """
+    Exact merge of two LoRAs by concatenating their low-rank factors along the rank dimension.
+
+    For every layer, the merged LoRA applies w1 * delta1 + w2 * delta2 exactly, where delta is
+    up @ down * alpha / rank: the down rows and up columns of each LoRA are scaled by the square
+    root of its coefficient and stacked, so the ranks add up and no dense delta is ever built.
+    The output alpha equals its rank. With fold, layers whose two LoRAs share an identical down
+    (or up) factor keep a single block and sum the other factor instead, so the rank does not grow.
+    Tensors that are not low-rank factors are merged as the weighted sum w1 * tensor1 + w2 * tensor2.
+
+    Args:
+    - main_lora_path: Path of the main LoRA .safetensors file.
+    - merge_lora_path: Path of the LoRA .safetensors file to merge with.
+    - output_paths: Paths of the merged .safetensors files to write.
+    - weight_pairs: (w1, w2) coefficients of the two LoRAs for each output, e.g. (w, 1 - w) for a
+      weighted merge or (1, w) for an additive merge.
+    - fold: Fold identical rank blocks (defaults to MERGE_CONCAT_FOLD in config.py).
+    - workers: Number of merge worker threads (defaults to MERGE_WORKERS in config.py).
+    - precision: Output precision ('auto', 'fp16', 'bf16', 'fp32'; defaults to MERGE_PRECISION in config.py).
+    - output_metadata: Optional list of string metadata dicts, one per output path.
+    """
+    fold = MERGE_CONCAT_FOLD if fold is None else fold
+    output_dtype = resolve_precision(precision)
+    main_specs = header_specs(read_header(main_lora_path)[0])
+    merge_specs = header_specs(read_header(merge_lora_path)[0])
+    main_modules, main_other = parse_lora_modules(main_specs)
+    merge_modules, merge_other = parse_lora_modules(merge_specs)
+    module_names = sorted(set(main_modules).union(merge_modules))
+    other_keys = sorted(set(main_other).union(merge_other))
+
+    with ExitStack() as stack:
+        main_file = stack.enter_context(safe_open(main_lora_path, framework="pt", device="cpu"))
+        merge_file = stack.enter_context(safe_open(merge_lora_path, framework="pt", device="cpu"))
+
+        sources = ((main_file, main_specs, main_modules), (merge_file, merge_specs, merge_modules))
+        load_module = lambda name: load_module_sides(name, sources)
+
+        # The folded layers decide the output ranks, so they are found before the output is laid out
+        def plan_chunk(names):
+            return [(name, concat_fold_mode(load_module(name), fold)) for name in names]
+
+        fold_modes = dict(pair for chunk in run_parallel(chunk_keys(module_names, resolve_workers(workers)), plan_chunk, workers) for pair in chunk)
+        output_specs = {}
+        for name in module_names:
+            output_specs.update(concat_module_specs(main_modules.get(name), merge_modules.get(name), main_specs, merge_specs, fold_modes[name]))
+        for key in other_keys:
+            output_specs[key] = merged_spec(main_specs.get(key), merge_specs.get(key))
+        output_specs = with_output_dtype(output_specs, output_dtype)
+
+        writers = [stack.enter_context(SafetensorsWriter(path, output_specs, metadata))
+                   for path, metadata in zip(output_paths, output_metadata or [None] * len(output_paths))]
+        stack.enter_context(MERGE_BUFFERS.session())
+        folded = sum(1 for mode in fold_modes.values() if mode is not None)
+        if folded:
+            print(f"Folded {folded} layers with identical rank blocks")
+
+        def merge_task(task):
+            names, is_module = task
+            for name in names:
+                if is_module:
+                    sides = load_module(name)
+                    for writer, (weight1, weight2) in zip(writers, weight_pairs):
+                        for key, tensor in concat_module(sides, weight1, weight2, fold_modes[name]).items():
+                            writer.write(key, tensor)
+                            MERGE_BUFFERS.release(tensor)
+                    del sides
+                else:
+                    tensors = [handle.get_tensor(name) for handle, specs in ((main_file, main_specs), (merge_file, merge_specs)) if name in specs]
+                    weights = [weight for weight, specs in zip((0, 1), (main_specs, merge_specs)) if name in specs]
+                    for writer, weight_pair in zip(writers, weight_pairs):
+                        merged_tensor = weighted_sum(tensors, [weight_pair[index] for index in weights])
+                        writer.write(name, merged_tensor)
+                        MERGE_BUFFERS.release(merged_tensor)
+            pbar.update(len(names))
+
+        tasks = [(chunk, True) for chunk in chunk_keys(module_names, resolve_workers(workers))]
+        tasks += [(chunk, False) for chunk in chunk_keys(other_keys, resolve_workers(workers))]
+        with tqdm(total=len(module_names) + len(other_keys), desc=desc, unit="layer") as pbar:
+            run_parallel(tasks, merge_task, workers)
+
+
+def load_module_sides(name, sources):
+    """
+    Loads one LoRA layer from each of two LoRA files as fp32 factors.
+
+    Args:
+    - name: kohya module name of the layer (see lora_key_map.parse_lora_modules).
+    - sources: (safe_open handle, specs, modules) of each LoRA file.
+
+    Returns:
+    - One (down, up, alpha / rank, module keys, specs) tuple per file, or None where the layer is missing.
+    """
+    sides = []
+    for handle, specs, modules in sources:
+        parts = modules.get(name)
+        if parts is None:
+            sides.append(None)
+            continue
+        down = handle.get_tensor(parts['down']).float()
+        up = handle.get_tensor(parts['up']).float()
+        alpha = handle.get_tensor(parts['alpha']).item() if 'alpha' in parts else down.shape[0]
+        sides.append((down, up, alpha / down.shape[0], parts, specs))
+    return sides
+
+
+def concat_fold_mode(sides, fold):
+    """Returns 'down' or 'up' when both LoRAs of a layer share that factor exactly (and fold is enabled), otherwise None."""
+    if not fold or sides[0] is None or sides[1] is None:
+        return None
+    (down1, up1, _, _, _), (down2, up2, _, _, _) = sides
+    if down1.shape == down2.shape and up1.shape == up2.shape:
+        if torch.equal(down1, down2):
+            return 'down'
+        if torch.equal(up1, up2):
+            return 'up'
+    return None
+
+
+def concat_module_specs(parts1, parts2, specs1, specs2, fold_mode):
+    """Returns the output (dtype, shape) of the factors (and alpha) of one rank-concatenated layer, named after the main LoRA's keys when present."""
+    present = [(parts, specs) for parts, specs in ((parts1, specs1), (parts2, specs2)) if parts is not None]
+    parts, specs = present[0]
+    down_dtype, down_shape = specs[parts['down']]
+    up_dtype, up_shape = specs[parts['up']]
+    rank = down_shape[0]
+    for other_parts, other_specs in present[1:]:
+        other_down_dtype, other_down_shape = other_specs[other_parts['down']]
+        other_up_dtype, other_up_shape = other_specs[other_parts['up']]
+        if other_down_shape[1:] != down_shape[1:] or other_up_shape[:1] + other_up_shape[2:] != up_shape[:1] + up_shape[2:]:
+            raise ValueError(f"LoRA layers {parts['down']} and {other_parts['down']} have incompatible shapes and cannot be concatenated")
+        down_dtype = torch.promote_types(down_dtype, other_down_dtype)
+        up_dtype = torch.promote_types(up_dtype, other_up_dtype)
+        if fold_mode is None:
+            rank += other_down_shape[0]
+
+    output_specs = {
+        parts['down']: (down_dtype, (rank,) + tuple(down_shape[1:])),
+        parts['up']: (up_dtype, tuple(up_shape[:1]) + (rank,) + tuple(up_shape[2:])),
+    }
+    if 'alpha' in parts:
+        output_specs[parts['alpha']] = specs[parts['alpha']]
+    return output_specs
+
+
+def concat_module(sides, weight1, weight2, fold_mode):
+    """
+    Builds the rank-concatenated factors of one layer for the coefficients (weight1, weight2).
+
+    Returns:
+    - A dict mapping the output keys (named after the main LoRA when present) to fp32 tensors.
+    """
+    blocks = []
+    for side, weight in zip(sides, (weight1, weight2)):
+        if side is not None:
+            down, up, scale, parts, specs = side
+            blocks.append((down, up, weight * scale))
+    parts, specs = next(side for side in sides if side is not None)[3:]
+
+    if fold_mode == 'down':
+        (down, up1, coefficient1), (_, up2, coefficient2) = blocks
+        merged_down = torch.mul(down, 1.0, out=MERGE_BUFFERS.acquire(down.shape, torch.float32))
+        merged_up = weighted_sum([up1, up2], [coefficient1, coefficient2])
+    elif fold_mode == 'up':
+        (down1, up, coefficient1), (down2, _, coefficient2) = blocks
+        merged_down = weighted_sum([down1, down2], [coefficient1, coefficient2])
+        merged_up = torch.mul(up, 1.0, out=MERGE_BUFFERS.acquire(up.shape, torch.float32))
+    else:
+        # Split each coefficient between both factors so neither grows much larger than the other
+        rank = sum(down.shape[0] for down, _, _ in blocks)
+        merged_down = MERGE_BUFFERS.acquire((rank,) + tuple(blocks[0][0].shape[1:]), torch.float32)
+        merged_up = MERGE_BUFFERS.acquire((blocks[0][1].shape[0], rank) + tuple(blocks[0][1].shape[2:]), torch.float32)
+        offset = 0
+        for down, up, coefficient in blocks:
+            root = abs(coefficient) ** 0.5
+            block_rank = down.shape[0]
+            torch.mul(down, root, out=merged_down[offset:offset + block_rank])
+            torch.mul(up, root if coefficient >= 0 else -root, out=merged_up[:, offset:offset + block_rank])
+            offset += block_rank
+
+    merged = {parts['down']: merged_down, parts['up']: merged_up}
+    if 'alpha' in parts:
+        # alpha = rank makes the output's scale alpha / rank exactly 1
+        alpha_dtype, alpha_shape = specs[parts['alpha']]
+        merged[parts['alpha']] = torch.full(alpha_shape, float(merged_down.shape[0]), dtype=alpha_dtype)
+    return merged
+
+
+def svd_merge_variants(main_lora_path, merge_lora_path, output_paths, weight_pairs, rank=None, energy=None, desc="SVD merging LoRA models", workers=None, precision=None, output_metadata=None):
+    """
+    Merges two LoRAs exactly, then re-factorizes every merged layer to a lower rank with a truncated SVD.
+
+    Each layer's merged delta w1 * delta1 + w2 * delta2 is kept in factored form (the rank-concatenated
+    factors of concat_merge_variants), so its SVD is computed from two thin QR decompositions and the
+    SVD of a small rank x rank core instead of the dense delta. Layers with the same factor shapes are
+    decomposed together in batched calls, and batches run in parallel. Each layer keeps at most rank
+    singular values, and with an energy threshold only as many as needed to retain that fraction of
+    its squared singular values (its Frobenius energy).
+
+    Args:
+    - main_lora_path: Path of the main LoRA .safetensors file.
+    - merge_lora_path: Path of the LoRA .safetensors file to merge with.
+    - output_paths: Paths of the merged .safetensors files to write.
+    - weight_pairs: (w1, w2) coefficients of the two LoRAs for each output.
+    - rank: Maximum rank of the output layers (defaults to MERGE_SVD_RANK in config.py; 0 keeps the full merged rank).
+    - energy: Fraction of energy to retain per layer, e.g. 0.99 (defaults to MERGE_SVD_ENERGY in config.py; 0 disables).
+    - workers: Number of merge worker threads (defaults to MERGE_WORKERS in config.py).
+    - precision: Output precision ('auto', 'fp16', 'bf16', 'fp32'; defaults to MERGE_PRECISION in config.py).
+    - output_metadata: Optional list of string metadata dicts, one per output path.
 
-    return main_weight * tensor1 + (1 - main_weight) * tensor2
+    Returns:
+    - One report per output: a dict mapping each layer's down key to its rank and retained energy.
+    """
+    rank = MERGE_SVD_RANK if rank is None else rank
+    energy = MERGE_SVD_ENERGY if energy is None else energy
+    output_dtype = resolve_precision(precision)
+    main_specs = header_specs(read_header(main_lora_path)[0])
+    merge_specs = header_specs(read_header(merge_lora_path)[0])
+    main_modules, main_other = parse_lora_modules(main_specs)
+    merge_modules, merge_other = parse_lora_modules(merge_specs)
+    module_names = sorted(set(main_modules).union(merge_modules))
+    other_keys = sorted(set(main_other).union(merge_other))
+
+    # Layers whose concatenated factors have the same shapes are decomposed in one batch
+    module_specs = {}
+    groups = {}
+    for name in module_names:
+        parts = main_modules.get(name) or merge_modules[name]
+        specs = concat_module_specs(main_modules.get(name), merge_modules.get(name), main_specs, merge_specs, None)
+        module_specs[name] = specs
+        groups.setdefault((specs[parts['down']][1], specs[parts['up']][1]), []).append(name)
+    batches = []
+    for (down_shape, up_shape), names in groups.items():
+        layer_bytes = 4 * (num_elements(down_shape) + num_elements(up_shape))
+        batch_size = max(1, worker_batch_bytes(workers) // max(1, layer_bytes))
+        batches.extend(names[i:i + batch_size] for i in range(0, len(names), batch_size))
+
+    merged_models = [{} for _ in output_paths]
+    reports = [{} for _ in output_paths]
+    with ExitStack() as stack:
+        main_file = stack.enter_context(safe_open(main_lora_path, framework="pt", device="cpu"))
+        merge_file = stack.enter_context(safe_open(merge_lora_path, framework="pt", device="cpu"))
+        stack.enter_context(MERGE_BUFFERS.session())
+        sources = ((main_file, main_specs, main_modules), (merge_file, merge_specs, merge_modules))
+
+        def refactor_task(names):
+            layer_sides = [load_module_sides(name, sources) for name in names]
+            layer_parts = [next(side for side in sides if side is not None)[3] for sides in layer_sides]
+            for merged_model, report, (weight1, weight2) in zip(merged_models, reports, weight_pairs):
+                factors = [concat_module(sides, weight1, weight2, None) for sides in layer_sides]
+                ups = stack_tensors([merged[parts['up']].reshape(merged[parts['up']].shape[0], -1) for merged, parts in zip(factors, layer_parts)])
+                downs = stack_tensors([merged[parts['down']].reshape(merged[parts['down']].shape[0], -1) for merged, parts in zip(factors, layer_parts)])
+                for merged in factors:
+                    MERGE_BUFFERS.release(*merged.values())
+                left, singular_values, right = factored_svd(ups, downs)
+                MERGE_BUFFERS.release(ups, downs)
+
+                for index, (name, parts) in enumerate(zip(names, layer_parts)):
+                    specs = module_specs[name]
+                    layer_rank, retained = svd_rank(singular_values[index], rank, energy)
+                    root = singular_values[index, :layer_rank].sqrt()
+                    down_dtype, down_shape = specs[parts['down']]
+                    up_dtype, up_shape = specs[parts['up']]
+                    merged_model[parts['down']] = (right[index, :layer_rank] * root[:, None]).reshape((layer_rank,) + tuple(down_shape[1:])).to(output_dtype or down_dtype)
+                    merged_model[parts['up']] = (left[index, :, :layer_rank] * root).reshape(tuple(up_shape[:1]) + (layer_rank,) + tuple(up_shape[2:])).to(output_dtype or up_dtype)
+                    if 'alpha' in parts:
+                        alpha_dtype, alpha_shape = specs[parts['alpha']]
+                        merged_model[parts['alpha']] = torch.full(alpha_shape, float(layer_rank), dtype=output_dtype or alpha_dtype)
+                    report[parts['down']] = {'rank': layer_rank, 'retained_energy': retained}
+            pbar.update(len(names))
+
+        def other_task(keys):
+            for key in keys:
+                tensors = [handle.get_tensor(key) for handle, specs in ((main_file, main_specs), (merge_file, merge_specs)) if key in specs]
+                sides = [index for index, specs in enumerate((main_specs, merge_specs)) if key in specs]
+                for merged_model, weight_pair in zip(merged_models, weight_pairs):
+                    merged_tensor = weighted_sum(tensors, [weight_pair[index] for index in sides])
+                    merged_model[key] = merged_tensor.to(output_dtype) if output_dtype is not None and merged_tensor.is_floating_point() else merged_tensor.clone()
+                    MERGE_BUFFERS.release(merged_tensor)
+            pbar.update(len(keys))
+
+        with tqdm(total=len(module_names) + len(other_keys), desc=desc, unit="layer") as pbar:
+            run_parallel(batches, refactor_task, workers)
+            run_parallel(chunk_keys(other_keys, resolve_workers(workers)), other_task, workers)
+
+    for output_path, merged_model, report, metadata in zip(output_paths, merged_models, reports, output_metadata or [None] * len(output_paths)):
+        save_tensors(dict(sorted(merged_model.items())), output_path, metadata)
+        write_svd_report(output_path, dict(sorted(report.items())))
+    return reports
+
+
+def factored_svd(ups, downs):
+    """
+    Batched SVD of the products ups @ downs without forming them.
 
+    With ups = Qu Ru and downs^T = Qd Rd (thin QR), ups @ downs = Qu (Ru Rd^T) Qd^T, so only the
+    small core Ru Rd^T needs a full SVD.
 
-def save_merged_lora(merged_model, lora_folder, main_lora_file, merge_lora_file, weight, merge_type):
-    """Saves the merged LoRA model with an appropriate name."""
+    Returns:
+    - left singular vectors (batch, out, k), singular values (batch, k) and right singular vectors (batch, k, in).
+    """
+    q_up, r_up = torch.linalg.qr(ups)
+    q_down, r_down = torch.linalg.qr(downs.transpose(1, 2))
+    core_left, singular_values, core_right = torch.linalg.svd(r_up @ r_down.transpose(1, 2), full_matrices=False)
+    return q_up @ core_left, singular_values, core_right @ q_down.transpose(1, 2)
+
+
+def svd_rank(singular_values, rank, energy):
+    """Returns the number of singular values kept (at most rank, and only enough to reach the energy fraction) and the energy they retain."""
+    squared = singular_values.double().square()
+    total = squared.sum().item()
+    kept = singular_values.numel() if rank <= 0 else min(rank, singular_values.numel())
+    if energy > 0 and total > 0:
+        cumulative = squared.cumsum(0) / total
+        kept = min(kept, int(torch.searchsorted(cumulative, torch.tensor([energy], dtype=cumulative.dtype)).item()) + 1)
+    kept = max(1, kept)
+    retained = squared[:kept].sum().item() / total if total > 0 else 1.0
+    return kept, retained
+
+
+def write_svd_report(output_path, report):
+    """Saves the per-layer ranks and retained energies of an SVD merge next to its output and prints a summary."""
+    report_path = os.path.splitext(output_path)[0] + ".svd_report.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    if report:
+        worst = sorted(report.items(), key=lambda item: item[1]['retained_energy'])[:5]
+        mean_energy = sum(layer['retained_energy'] for layer in report.values()) / len(report)
+        mean_rank = sum(layer['rank'] for layer in report.values()) / len(report)
+        print(f"Re-factorized {len(report)} layers to a mean rank of {mean_rank:.1f}, retaining {mean_energy:.2%} of the energy on average")
+        for key, layer in worst:
+            print(f"  {key}: rank {layer['rank']}, {layer['retained_energy']:.2%} retained")
+        print(f"Per-layer energy report saved as: {os.path.basename(report_path)}")
+
+
+def merged_lora_filename(main_lora_file, merge_lora_file, weight, merge_type):
+    """Returns the file name of a merged LoRA following the mrg_ naming convention."""
     main_name = os.path.splitext(main_lora_file)[0]
     merge_name = os.path.splitext(merge_lora_file)[0]
 
     if merge_type == 'adaptive':
-        strategy_code = f"A{int(weight * 100)}"
+        strategy_code = f"A{round(weight * 100)}"
     elif merge_type == 'additive':
-        strategy_code = f"ADDI{int(weight * 100)}"
+        strategy_code = f"ADDI{round(weight * 100)}"
+    elif merge_type == 'concat':
+        strategy_code = f"C{round(weight * 100)}"
+    elif merge_type == 'concat_additive':
+        strategy_code = f"CADD{round(weight * 100)}"
+    elif merge_type == 'svd':
+        strategy_code = f"S{round(weight * 100)}"
     else:  # manual
-        strategy_code = f"M{int(weight * 100)}"
+        strategy_code = f"M{round(weight * 100)}"
 
-    merged_lora_name = f"mrg_{main_name}_{strategy_code}_{merge_name}.safetensors"
+    return f"mrg_{main_name}_{strategy_code}_{merge_name}.safetensors"
+
+
+def save_merged_lora(merged_model, lora_folder, main_lora_file, merge_lora_file, weight, merge_type, quantize=None):
+    """Saves the merged LoRA model with an appropriate name, plus its quantized variant if quantize ('int8', 'fp8') is set (defaults to MERGE_QUANTIZE in config.py)."""
+    merged_lora_name = merged_lora_filename(main_lora_file, merge_lora_file, weight, merge_type)
     merged_lora_path = os.path.join(lora_folder, merged_lora_name)
 
-    save_file(merged_model, merged_lora_path)
+    save_tensors(merged_model, merged_lora_path)
     print(f"Merged LoRA saved as: {merged_lora_name}")
 
+    quantize = MERGE_QUANTIZE if quantize is None else quantize
+    if quantize:
+        write_quantized_variant(merged_lora_path, quantize)
+    if MERGE_SPARSE:
+        write_sparse_variant(merged_lora_path)
+
 
 def completed(settings):
     """Prompt user to decide whether to merge another LoRA or finish."""
@@ -157,57 +954,117 @@ def completed(settings):
 from tqdm import tqdm
 import torch
 
-def pad_tensors(tensor1, tensor2):
-    """Pads tensors to the same size if they differ."""
-    max_size = [max(s1, s2) for s1, s2 in zip(tensor1.size(), tensor2.size())]
-    padded1 = torch.zeros(max_size, device=tensor1.device, dtype=tensor1.dtype)
-    padded2 = torch.zeros(max_size, device=tensor2.device, dtype=tensor2.dtype)
-    padded1[tuple(slice(0, s) for s in tensor1.size())] = tensor1
-    padded2[tuple(slice(0, s) for s in tensor2.size())] = tensor2
-    return padded1, padded2
-
-def pad_all_tensors(tensors):
-    """Pads all tensors in the list to match the maximum size across all tensors."""
-    if not tensors:
-        return []
-
-    # Determine the max size across all tensors
-    max_size = [max(t.size(dim) for t in tensors) for dim in range(len(tensors[0].size()))]
-
-    # Pad each tensor to the max size
-    padded_tensors = []
-    for tensor in tensors:
-        padded_tensor = torch.zeros(max_size, device=tensor.device, dtype=tensor.dtype)
-        slices = tuple(slice(0, s) for s in tensor.size())
-        padded_tensor[slices] = tensor
-        padded_tensors.append(padded_tensor)
+def padded_size(tensors):
+    """Returns the maximum size across all tensors in each dimension."""
+    return [max(t.size(dim) for t in tensors) for dim in range(len(tensors[0].size()))]
 
-    return padded_tensors
+def weighted_sum(tensors, weights):
+    """
+    Fused weighted sum of tensors into a single pooled output buffer.
 
+    Each scaled tensor is accumulated in place (add with alpha) instead of building a chain of
+    temporaries. Tensors of different shapes are summed as if zero-padded to the maximum size,
+    each one accumulated into its own corner of the output without padded copies.
+    """
+    dtype = tensors[0].dtype
+    for tensor in tensors[1:]:
+        dtype = torch.promote_types(dtype, tensor.dtype)
+    weights = [float(weight) for weight in weights]
+    if not dtype.is_floating_point:
+        return sum(weight * tensor for weight, tensor in zip(weights, tensors))
+
+    merged_tensor = MERGE_BUFFERS.acquire(padded_size(tensors), dtype)
+    if any(tensor.size() != merged_tensor.size() for tensor in tensors):
+        merged_tensor.zero_()
+        for tensor, weight in zip(tensors, weights):
+            merged_tensor[tuple(slice(0, s) for s in tensor.size())].add_(tensor, alpha=weight)
+        return merged_tensor
 
-def god_mode(lora_folder, merge_strategy='adaptive'):
+    if weights[0] == 1.0 and len(tensors) > 1:
+        torch.add(tensors[0], tensors[1], alpha=weights[1], out=merged_tensor)
+        remaining = zip(tensors[2:], weights[2:])
+    else:
+        torch.mul(tensors[0], weights[0], out=merged_tensor)
+        remaining = zip(tensors[1:], weights[1:])
+    for tensor, weight in remaining:
+        merged_tensor.add_(tensor, alpha=weight)
+    return merged_tensor
+
+def blend(tensor1, tensor2, weight1):
+    """Fused weight1 * tensor1 + (1 - weight1) * tensor2 into a pooled output buffer, as a single lerp when the tensors match."""
+    weight1 = float(weight1)
+    if tensor1.size() == tensor2.size() and tensor1.dtype == tensor2.dtype and tensor1.dtype.is_floating_point:
+        return torch.lerp(tensor2, tensor1, weight1, out=MERGE_BUFFERS.acquire(tensor1.shape, tensor1.dtype))
+    return weighted_sum([tensor1, tensor2], [weight1, 1 - weight1])
+
+def stack_tensors(tensors):
+    """Stacks same-shape, same-dtype tensors into a pooled buffer."""
+    return torch.stack(tensors, out=MERGE_BUFFERS.acquire((len(tensors),) + tuple(tensors[0].shape), tensors[0].dtype))
+
+
+def god_mode(lora_folder, merge_strategy='adaptive', ram_budget=None, processes=None, precision=None, quantize=None):
     """
     Merges multiple LoRA models simultaneously using the specified strategy, constrained by available memory.
 
+    All files are opened lazily and only their headers are read up front. Keys are then merged in
+    batches planned from the header shapes so that the tensors of one batch fit in the RAM budget,
+    looping until all layers have been merged. With several processes, the key space is sharded and
+    each worker writes its merged layers straight into its own region of the final file.
+
+    The running sums behind the merge are saved next to the output (see god_mode_state.py). When the
+    folder only gained new models since the last run, just those models are read and added to the
+    saved sums; see god_mode_remove for taking a model back out of the merge.
+
     Args:
     - lora_folder: The folder containing LoRA models to merge.
-    - merge_strategy: The merging strategy to use ('adaptive', 'additive').
+    - merge_strategy: The merging strategy to use ('adaptive', 'additive', 'ties', 'dare').
+    - ram_budget: Maximum bytes of tensors in memory at once (defaults to GOD_MODE_RAM_BUDGET in config.py).
+    - processes: Number of worker processes sharing the key space (defaults to GOD_MODE_PROCESSES in config.py).
+    - precision: Output precision ('auto', 'fp16', 'bf16', 'fp32'; defaults to MERGE_PRECISION in config.py). Except
+      for 'auto', which keeps the input dtypes, each tensor is upcast to fp32 for the merge math as it is loaded.
+    - quantize: Also write a quantized variant of the output ('int8', 'fp8'; defaults to MERGE_QUANTIZE in config.py).
 
     Returns:
     - Path to the final merged model saved to disk.
     """
-    # Load all LoRA models from the folder with progress bar
-    lora_files = [f for f in os.listdir(lora_folder) if f.endswith('.safetensors')]
+    # Read the header of every LoRA model in the folder with progress bar, never merging previous God Mode outputs back in
+    lora_files = sorted(f for f in os.listdir(lora_folder)
+                        if f.endswith('.safetensors') and not is_god_mode_file(f)
+                        and not is_quantized_file(f) and not is_sparse_file(f))
     if not lora_files:
         print("No LoRA models found to merge.")
         return None
 
-    print(f"Loading {len(lora_files)} LoRA models...")
-    lora_models = []
+    merged_file_path = god_mode_file_path(lora_folder, merge_strategy)
+    merged_filename = os.path.basename(merged_file_path)
+
+    # Only read the new models when the folder has just gained some since the last merge
+    save_state = GOD_MODE_SAVE_STATE and merge_strategy in RUNNING_SUM_STRATEGIES
+    state = read_state(state_file_path(merged_file_path)) if save_state and os.path.exists(merged_file_path) else None
+    if state is not None and state['merge_strategy'] == merge_strategy:
+        contributors = state['contributors']
+        new_files = [f for f in lora_files if f not in contributors]
+        changed_files = [f for f in lora_files if f in contributors and file_signature(os.path.join(lora_folder, f)) != contributors[f]]
+        missing_files = [f for f in contributors if f not in lora_files]
+        if state['precision'] != (precision or MERGE_PRECISION):
+            print(f"{merged_filename} was merged with precision {state['precision']}; merging the whole folder again in {precision or MERGE_PRECISION}.")
+        elif changed_files or missing_files:
+            print(f"{len(changed_files)} LoRA model(s) changed and {len(missing_files)} removed since the last God Mode merge; merging the whole folder again.")
+        elif not new_files:
+            print(f"{merged_filename} is already up to date with the {len(lora_files)} LoRA models in the folder.")
+            write_missing_variants(merged_file_path, quantize)
+            return merged_file_path
+        else:
+            print(f"Adding {len(new_files)} new LoRA model(s) to the existing God Mode merge of {len(contributors)} models.")
+            return update_god_mode(merged_file_path, [os.path.join(lora_folder, f) for f in new_files], merge_strategy, state,
+                                   precision=precision, quantize=quantize)
+
+    print(f"Opening {len(lora_files)} LoRA models...")
+    lora_sources = []  # (file path, {key: (dtype, shape)}) for each readable model
     largest_file_size = 0
     largest_file_name = ''
 
-    with tqdm(total=len(lora_files), desc="Loading LoRA Models", unit="file") as pbar:
+    with tqdm(total=len(lora_files), desc="Reading LoRA Headers", unit="file") as pbar:
         for file in lora_files:
             file_path = os.path.join(lora_folder, file)
             file_size = os.path.getsize(file_path)
@@ -215,108 +1072,929 @@ def god_mode(lora_folder, merge_strategy='adaptive'):
                 largest_file_size = file_size
                 largest_file_name = file
             try:
-                lora_model = load_file(file_path)
-                lora_models.append(lora_model)
+                header, _, _ = read_header(file_path)
+                lora_sources.append((file_path, header_specs(header)))
             except Exception as e:
                 print(f"Error loading model {file}: {e}")
             pbar.update(1)
 
-    if not lora_models:
+    if not lora_sources:
         print("No LoRA models successfully loaded.")
         return None
 
     print(f"Largest input file: {largest_file_name} ({largest_file_size} bytes)")
-    print(f"Starting merge with {len(lora_models)} LoRA models using {merge_strategy} strategy.")
+    print(f"Starting merge with {len(lora_sources)} LoRA models using {merge_strategy} strategy.")
+
+    # Determine the output dtype and shape of every key up front, so each merged tensor can be written as soon as it is computed
+    all_keys = sorted(set().union(*(specs.keys() for _, specs in lora_sources)))
+    output_specs = {}
+    for key in all_keys:
+        spec = None
+        for _, specs in lora_sources:
+            if key in specs:
+                spec = merged_spec(spec, specs[key])
+        output_specs[key] = spec
+    output_dtype = resolve_precision(precision)
+    output_specs = with_output_dtype(output_specs, output_dtype)
+    upcast_inputs = output_dtype is not None
+    layer_parts = god_mode_update_layers([specs for _, specs in lora_sources], output_specs) if merge_strategy in UPDATE_STRATEGIES else {}
+
+    ram_budget = resolve_ram_budget(ram_budget)
+    print(f"RAM budget: {ram_budget / (1024 ** 3):.2f} GB")
+
+    # Record which models went into the merge so later runs can tell what was added or changed
+    state_path = None
+    if save_state:
+        state_path = state_file_path(merged_file_path)
+        contributors = {os.path.basename(path): file_signature(path) for path, _ in lora_sources}
+        state_layout = (state_specs(output_specs), state_metadata(merge_strategy, contributors, output_specs, precision or MERGE_PRECISION))
+    elif os.path.exists(state_file_path(merged_file_path)):
+        # A stale state would no longer describe the new output
+        os.remove(state_file_path(merged_file_path))
+
+    # Layers whose source tensors are all unchanged since the previous merge are copied from it (see tensor_hashes.py)
+    source_hashes = [tensor_hashes(path) for path, _ in lora_sources]
+    parameters = {'strategy': merge_strategy, 'precision': precision or MERGE_PRECISION}
+    if merge_strategy == 'ties':
+        parameters['density'] = GOD_MODE_TIES_DENSITY
+    elif merge_strategy == 'dare':
+        parameters['drop_rate'] = GOD_MODE_DARE_DROP_RATE
+        # DARE before version 2 elected signs like TIES; its layers are not reused
+        parameters['dare_version'] = DARE_MERGE_VERSION
+    if layer_parts:
+        parameters['layer_rank'] = GOD_MODE_LAYER_RANK
+    # The factors of a layer merged as a weight update all depend on every factor of that layer
+    digest_keys = {key: sorted(layer_parts[key].values()) if key in layer_parts else [key] for key in all_keys}
+    key_inputs = {key: input_digest(parameters, [[os.path.basename(path), [hashes[part] for part in digest_keys[key] if part in specs]
+                                                  if key in layer_parts else hashes[key]]
+                                                 for (path, specs), hashes in zip(lora_sources, source_hashes)
+                                                 if any(part in specs for part in digest_keys[key])])
+                  for key in all_keys}
+    output_paths = [merged_file_path] + ([state_path] if state_path else [])
+    stored_keys = [lambda key: (key,), lambda key: (SUM_PREFIX + key, WEIGHT_PREFIX + key, COUNT_PREFIX + key)]
+    previous = PreviousOutputs(output_paths, [key_inputs] * len(output_paths), stored_keys[:len(output_paths)])
+    reused_keys = previous.reusable_keys([output_specs, state_layout[0] if state_path else None][:len(output_paths)])
+    merge_keys = [key for key in all_keys if key not in reused_keys]
+    if reused_keys:
+        print(f"Reusing {len(reused_keys)} layers whose source tensors are unchanged since the previous merge")
+
+    processes = resolve_god_mode_processes(processes, sum(os.path.getsize(path) for path, _ in lora_sources))
+    try:
+        if processes > 1:
+            print(f"Sharding the merge across {processes} processes")
+            if state_path:
+                prepare_safetensors(state_path, *state_layout)
+            if merge_keys:
+                key_results = merge_god_mode_sharded(merged_file_path, lora_sources, merge_keys, output_specs, merge_strategy, ram_budget, processes,
+                                                     state_path, upcast_inputs, layer_parts)
+            else:
+                prepare_safetensors(merged_file_path, output_specs)
+                key_results = []
+            try:
+                with ExitStack() as stack:
+                    writers = [stack.enter_context(SafetensorsWriter.attach(path)) for path in output_paths]
+                    run_parallel(chunk_keys(sorted(reused_keys), resolve_workers()), lambda keys: [previous.copy(writers, key) for key in keys])
+            except Exception:
+                with suppress(FileNotFoundError):
+                    os.remove(merged_file_path)
+                raise
+        else:
+            key_batches = plan_key_batches(merge_keys, [specs for _, specs in lora_sources], output_specs, ram_budget, upcast_inputs)
+            print(f"Merging {len(merge_keys)} layers in {len(key_batches)} batch(es)")
+            with ExitStack() as stack:
+                state_writer = stack.enter_context(SafetensorsWriter(state_path, *state_layout)) if state_path else None
+                key_results = merge_god_mode_threaded(merged_file_path, lora_sources, key_batches, output_specs, merge_strategy,
+                                                      state_writer, upcast_inputs, previous, reused_keys, layer_parts)
+    except Exception as e:
+        if state_path and os.path.exists(state_path):
+            os.remove(state_path)
+        previous.close(success=False)
+        print(f"Error saving merged model: {e}")
+        return None
+    previous.close()
+    for path in output_paths:
+        record_output_inputs(path, key_inputs)
+    key_results += [(sum(1 for _, specs in lora_sources if key in specs), True) for key in sorted(reused_keys)]
 
-    # Initialize the merged model with keys from all models
-    all_keys = set().union(*(model.keys() for model in lora_models))
-    merged_model = {key: torch.zeros_like(next(model[key] for model in lora_models if key in model))
-                    for key in all_keys}
+    total_input_tensors = sum(count for count, _ in key_results)
+    total_merged_tensors = sum(1 for _, merged in key_results if merged)
 
-    total_input_tensors = 0
-    total_merged_tensors = 0
+    print(f"Total input tensors: {total_input_tensors}")
+    print(f"Total merged tensors: {total_merged_tensors}")
 
-    for key in tqdm(all_keys, desc="Merging tensors", unit="tensor"):
-        tensors = [model[key] for model in lora_models if key in model]
-        total_input_tensors += len(tensors)
+    # Report on the saved model
+    try:
+        merged_file_size = os.path.getsize(merged_file_path)
+        print(f"Merged file saved as: {merged_filename}")
+        print(f"Merged file size: {merged_file_size} bytes")
 
-        if not tensors:
-            print(f"Warning: No tensors found for key: {key}")
-            continue
+        if merged_file_size < largest_file_size:
+            print("Warning: Merged file is smaller than the largest input file. Some data may have been lost in the process.")
+        else:
+            print("Merged file is larger than or equal to the largest input file, as expected.")
 
-        # print(f"Merging {len(tensors)} tensors for key: {key}")
-        # print(f"Input tensor sizes: {[t.size() for t in tensors]}")
+    except Exception as e:
+        print(f"Error saving merged model: {e}")
+        return None
 
-        try:
-            padded_tensors = pad_all_tensors(tensors)
-            if merge_strategy == 'adaptive':
-                merged_model[key] = adaptive_merge_multiple(padded_tensors)
-            elif merge_strategy == 'additive':
-                merged_model[key] = additive_merge_multiple(padded_tensors)
-            else:
-                raise ValueError(f"Unknown merge strategy: {merge_strategy}")
+    quantize = MERGE_QUANTIZE if quantize is None else quantize
+    if quantize:
+        write_quantized_variant(merged_file_path, quantize)
+    if MERGE_SPARSE:
+        write_sparse_variant(merged_file_path)
 
-            # print(f"Merged tensor size: {merged_model[key].size()}")
-            total_merged_tensors += 1
+    return merged_file_path
 
-        except Exception as e:
-            print(f"Error merging tensors for key {key}: {e}")
-            # Instead of skipping, use the tensor from the largest file if available
-            largest_model_tensor = next((model[key] for model in lora_models if key in model and model is lora_models[0]), None)
-            if largest_model_tensor is not None:
-                merged_model[key] = largest_model_tensor
-                print(f"Using tensor from largest file for key {key}")
-            else:
-                print(f"Warning: Skipping key {key} due to errors")
+def merge_god_mode_key(key, lora_handles, lora_sources, output_specs, merge_strategy, writer, state_writer=None, upcast_inputs=False, layer_parts=None):
+    """
+    Loads, merges and writes one key across all models; returns (input tensor count, merged successfully).
 
-    print(f"Total input tensors: {total_input_tensors}")
-    print(f"Total merged tensors: {total_merged_tensors}")
+    Keys in layer_parts (the factors of LoRA layers merged as weight updates, see god_mode_update_layers)
+    are merged a whole layer at a time, when its down key is reached.
+    """
+    if layer_parts and key in layer_parts:
+        return merge_god_mode_layer(key, layer_parts[key], lora_handles, lora_sources, output_specs, merge_strategy, writer)
+    tensors = [handle.get_tensor(key) for handle, (_, specs) in zip(lora_handles, lora_sources) if key in specs]
+    if upcast_inputs:
+        tensors = [upcast(tensor) for tensor in tensors]
+
+    if state_writer is not None:
+        state_sum = MERGE_BUFFERS.acquire(output_specs[key][1], torch.float32).zero_()
+        weight_sum = accumulate_god_mode_state(state_sum, tensors, merge_strategy)
+        write_god_mode_state(key, state_sum, weight_sum, len(tensors), state_writer)
+        MERGE_BUFFERS.release(state_sum)
+
+    # print(f"Merging {len(tensors)} tensors for key: {key}")
+    # print(f"Input tensor sizes: {[t.size() for t in tensors]}")
+
+    try:
+        if merge_strategy == 'adaptive':
+            merged_tensor = adaptive_merge_multiple(tensors)
+        elif merge_strategy == 'additive':
+            merged_tensor = additive_merge_multiple(tensors)
+        elif merge_strategy == 'ties':
+            merged_tensor = ties_merge_multiple(tensors)
+        elif merge_strategy == 'dare':
+            model_names = [os.path.basename(path) for path, specs in lora_sources if key in specs]
+            merged_tensor = dare_merge_multiple(tensors, key, model_names)
+        else:
+            raise ValueError(f"Unknown merge strategy: {merge_strategy}")
+
+        # print(f"Merged tensor size: {merged_tensor.size()}")
+        writer.write(key, merged_tensor)
+        MERGE_BUFFERS.release(merged_tensor, *tensors)
+        return len(tensors), True
+
+    except Exception as e:
+        print(f"Error merging tensors for key {key}: {e}")
+        # Instead of skipping, use the tensor from the largest file if available
+        dtype, shape = output_specs[key]
+        fallback_tensor = torch.zeros(shape, dtype=dtype)
+        if key in lora_sources[0][1]:
+            largest_model_tensor = lora_handles[0].get_tensor(key)
+            fallback_tensor[tuple(slice(0, s) for s in largest_model_tensor.size())] = largest_model_tensor
+            print(f"Using tensor from largest file for key {key}")
+        else:
+            print(f"Warning: Skipping key {key} due to errors")
+        writer.write(key, fallback_tensor)
+        return len(tensors), False
+
+
+def merge_god_mode_threaded(merged_file_path, lora_sources, key_batches, output_specs, merge_strategy, state_writer=None, upcast_inputs=False,
+                            previous=None, reused_keys=(), layer_parts=None):
+    """Merges God Mode key batches in this process, each batch split across the merge thread pool; reused keys are copied from the previous outputs."""
+    key_results = []
+    with ExitStack() as stack:
+        lora_handles = [stack.enter_context(safe_open(path, framework="pt", device="cpu")) for path, _ in lora_sources]
+        writer = stack.enter_context(SafetensorsWriter(merged_file_path, output_specs))
+        stack.enter_context(MERGE_BUFFERS.session())
+        if reused_keys:
+            writers = [writer] + ([state_writer] if state_writer is not None else [])
+            run_parallel(chunk_keys(sorted(reused_keys), resolve_workers()), lambda keys: [previous.copy(writers, key) for key in keys])
+
+        def merge_chunk(keys):
+            results = [merge_god_mode_key(key, lora_handles, lora_sources, output_specs, merge_strategy, writer, state_writer, upcast_inputs, layer_parts)
+                       for key in keys]
+            pbar.update(len(keys))
+            return results
+
+        # Only the tensors of the current batch are loaded
+        with tqdm(total=sum(len(batch_keys) for batch_keys in key_batches), desc="Merging tensors", unit="tensor") as pbar:
+            for batch_keys in key_batches:
+                for results in run_parallel(chunk_keys(batch_keys, resolve_workers()), merge_chunk):
+                    key_results.extend(results)
+    return key_results
+
+
+def merge_god_mode_sharded(merged_file_path, lora_sources, all_keys, output_specs, merge_strategy, ram_budget, processes, state_path=None, upcast_inputs=False,
+                           layer_parts=None):
+    """
+    Shards the God Mode key space across worker processes.
 
+    The output file is laid out up front; each worker opens the sources lazily, merges its shard
+    within its share of the RAM budget and writes every layer straight into its region of the
+    final file, so no partial files or in-memory copies need to be assembled. The progress bar
+    aggregates the layers completed by all workers.
+    """
+    model_specs = [specs for _, specs in lora_sources]
+
+    # Balance the shards by estimated bytes: largest keys first, each to the least loaded shard
+    shards = [[] for _ in range(processes)]
+    shard_bytes = [0] * processes
+    key_costs = {key: god_mode_key_bytes(key, model_specs, output_specs[key], upcast_inputs) for key in all_keys}
+    for key in sorted(all_keys, key=lambda k: -key_costs[k]):
+        shard_index = shard_bytes.index(min(shard_bytes))
+        shards[shard_index].append(key)
+        shard_bytes[shard_index] += key_costs[key]
+    shards = [sorted(shard) for shard in shards if shard]
+
+    prepare_safetensors(merged_file_path, output_specs)
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    try:
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=context,
+                                 initializer=init_god_mode_worker, initargs=(progress_queue,)) as executor:
+            futures = [executor.submit(god_mode_shard, merged_file_path, lora_sources, shard, output_specs,
+                                       merge_strategy, ram_budget // len(shards), state_path, upcast_inputs, layer_parts) for shard in shards]
+            with tqdm(total=len(all_keys), desc=f"Merging tensors ({len(shards)} processes)", unit="tensor") as pbar:
+                while pbar.n < len(all_keys):
+                    try:
+                        pbar.update(progress_queue.get(timeout=0.5))
+                    except queue.Empty:
+                        if all(future.done() for future in futures):
+                            break
+            shard_results = [future.result() for future in futures]
+    except Exception:
+        with suppress(FileNotFoundError):
+            os.remove(merged_file_path)
+        raise
+
+    key_results = [result for results in shard_results for result in results]
+    if len(key_results) != len(all_keys):
+        raise ValueError(f"Only {len(key_results)} of {len(all_keys)} layers were merged")
+    return key_results
+
+
+_progress_queue = None
+
+
+def init_god_mode_worker(progress_queue):
+    """Initializes a God Mode worker process with the shared progress queue and one torch thread per process."""
+    global _progress_queue
+    _progress_queue = progress_queue
+    torch.set_num_threads(MERGE_INTRA_OP_THREADS or 1)
+
+
+def god_mode_shard(merged_file_path, lora_sources, shard_keys, output_specs, merge_strategy, ram_budget, state_path=None, upcast_inputs=False, layer_parts=None):
+    """Worker process entry point: merges one shard of keys into the shared output file, one RAM-budgeted batch at a time."""
+    key_results = []
+    key_batches = plan_key_batches(shard_keys, [specs for _, specs in lora_sources], output_specs, ram_budget, upcast_inputs)
+    with ExitStack() as stack:
+        lora_handles = [stack.enter_context(safe_open(path, framework="pt", device="cpu")) for path, _ in lora_sources]
+        writer = stack.enter_context(SafetensorsWriter.attach(merged_file_path))
+        state_writer = stack.enter_context(SafetensorsWriter.attach(state_path)) if state_path else None
+        stack.enter_context(MERGE_BUFFERS.session())
+        for batch_keys in key_batches:
+            for key in batch_keys:
+                key_results.append(merge_god_mode_key(key, lora_handles, lora_sources, output_specs, merge_strategy, writer, state_writer, upcast_inputs,
+                                                      layer_parts))
+            _progress_queue.put(len(batch_keys))
+    return key_results
+
+
+def god_mode_file_path(lora_folder, merge_strategy):
+    """Returns the path of the God Mode output for a folder and merge strategy."""
     # Determine the strategy code for the filename
-    strategy_code = 'A' if merge_strategy == 'adaptive' else 'M'
+    strategy_code = {'adaptive': 'A', 'ties': 'T', 'dare': 'D'}.get(merge_strategy, 'M')
 
     # Create the filename using the correct naming convention
-    merged_filename = f"mrg_final_merged_{strategy_code}100_god_mode.safetensors"
-    merged_file_path = os.path.join(lora_folder, merged_filename)
+    return os.path.join(lora_folder, f"mrg_final_merged_{strategy_code}100_god_mode.safetensors")
 
-    # Save the final merged model
-    try:
-        save_file(merged_model, merged_file_path)
-        merged_file_size = os.path.getsize(merged_file_path)
-        print(f"Merged file saved as: {merged_filename}")
-        print(f"Merged file size: {merged_file_size} bytes")
 
-        if merged_file_size < largest_file_size:
-            print("Warning: Merged file is smaller than the largest input file. Some data may have been lost in the process.")
+def write_missing_variants(merged_file_path, quantize=None):
+    """Writes the quantized and sparse variants of an existing God Mode output that are enabled but missing."""
+    quantize = MERGE_QUANTIZE if quantize is None else quantize
+    if quantize and not os.path.exists(quantized_path(merged_file_path, quantize)):
+        write_quantized_variant(merged_file_path, quantize)
+    if MERGE_SPARSE and not os.path.exists(sparse_path(merged_file_path)):
+        write_sparse_variant(merged_file_path)
+
+
+def god_mode_remove(lora_folder, lora_paths, merge_strategy='adaptive', precision=None, quantize=None):
+    """
+    Takes LoRA models back out of an existing God Mode merge by subtracting their contributions.
+
+    Only the removed models are read; the other models in the merge are never touched. Remove the
+    files from the folder afterwards, otherwise the next God Mode run adds them again.
+
+    Args:
+    - lora_folder: The folder holding the God Mode output and its state.
+    - lora_paths: Paths of the models to remove, unchanged since they were merged.
+    - merge_strategy: The strategy of the God Mode merge to update ('adaptive', 'additive').
+    - precision: Output precision ('auto' keeps the output dtypes of the merge; defaults to MERGE_PRECISION in config.py).
+    - quantize: Also write a quantized variant of the output ('int8', 'fp8'; defaults to MERGE_QUANTIZE in config.py).
+
+    Returns:
+    - Path to the updated merged model, or None if there was nothing to remove.
+    """
+    merged_file_path = god_mode_file_path(lora_folder, merge_strategy)
+    state = read_state(state_file_path(merged_file_path)) if os.path.exists(merged_file_path) else None
+    if state is None or state['merge_strategy'] != merge_strategy:
+        print(f"No God Mode state found for {os.path.basename(merged_file_path)}; run God Mode on the folder first.")
+        return None
+
+    removable = []
+    for path in lora_paths:
+        name = os.path.basename(path)
+        if name not in state['contributors']:
+            print(f"Warning: {name} is not part of the God Mode merge, skipping it")
+        elif file_signature(path) != state['contributors'][name]:
+            print(f"Warning: {name} changed since it was merged and cannot be subtracted, skipping it")
         else:
-            print("Merged file is larger than or equal to the largest input file, as expected.")
+            removable.append(path)
+    if not removable:
+        print("No LoRA models to remove.")
+        return None
+
+    print(f"Removing {len(removable)} LoRA model(s) from the God Mode merge of {len(state['contributors'])} models.")
+    return update_god_mode(merged_file_path, removable, merge_strategy, state, sign=-1, precision=precision, quantize=quantize)
+
+
+def update_god_mode(merged_file_path, lora_paths, merge_strategy, state, sign=1, precision=None, quantize=None):
+    """
+    Adds (sign=1) or subtracts (sign=-1) models to or from the saved God Mode running sums.
+
+    Each key's sums are read from the state file, grown to the new output shape if needed, updated
+    with the given models only and written back alongside the recomputed merged tensor. Both files
+    are written under temporary names and swapped in once complete.
+
+    Returns:
+    - Path to the updated merged model saved to disk, or None on error.
+    """
+    state_path = state_file_path(merged_file_path)
+    lora_sources = []
+    for path in lora_paths:
+        try:
+            header, _, _ = read_header(path)
+            lora_sources.append((path, header_specs(header)))
+        except Exception as e:
+            print(f"Error loading model {os.path.basename(path)}: {e}")
+    if not lora_sources:
+        print("No LoRA models successfully loaded.")
+        return None
+
+    if resolve_precision(precision) is None and state['precision']:
+        # 'auto' keeps the output dtypes of the merge, so it keeps the precision it was recorded with too
+        precision = state['precision']
+    contributors = dict(state['contributors'])
+    output_specs = dict(state['output_specs'])
+    with safe_open(state_path, framework="pt", device="cpu") as f:
+        counts = {key: int(f.get_tensor(COUNT_PREFIX + key)) for key in output_specs}
+    for path, specs in lora_sources:
+        for key, spec in specs.items():
+            if sign > 0:
+                output_specs[key] = merged_spec(output_specs.get(key), spec)
+            counts[key] = counts.get(key, 0) + sign
+        if sign > 0:
+            contributors[os.path.basename(path)] = file_signature(path)
+        else:
+            del contributors[os.path.basename(path)]
+
+    # Keys no model contributes to anymore are dropped from the merge
+    output_specs = {key: spec for key, spec in sorted(output_specs.items()) if counts[key] > 0}
+    output_specs = with_output_dtype(output_specs, resolve_precision(precision))
 
+    tmp_merged_path = merged_file_path + ".tmp"
+    tmp_state_path = state_path + ".tmp"
+    try:
+        with ExitStack() as stack:
+            previous_state = stack.enter_context(safe_open(state_path, framework="pt", device="cpu"))
+            lora_handles = [stack.enter_context(safe_open(path, framework="pt", device="cpu")) for path, _ in lora_sources]
+            writer = stack.enter_context(SafetensorsWriter(tmp_merged_path, output_specs))
+            state_writer = stack.enter_context(SafetensorsWriter(tmp_state_path, state_specs(output_specs),
+                                                                 state_metadata(merge_strategy, contributors, output_specs, precision or MERGE_PRECISION)))
+            previous_keys = set(previous_state.keys())
+            stack.enter_context(MERGE_BUFFERS.session())
+
+            def update_chunk(keys):
+                for key in keys:
+                    update_god_mode_key(key, previous_state, previous_keys, lora_handles, lora_sources, output_specs,
+                                        merge_strategy, sign, writer, state_writer)
+                pbar.update(len(keys))
+
+            with tqdm(total=len(output_specs), desc="Updating tensors", unit="tensor") as pbar:
+                run_parallel(chunk_keys(list(output_specs), resolve_workers()), update_chunk)
+
+        os.replace(tmp_state_path, state_path)
+        os.replace(tmp_merged_path, merged_file_path)
     except Exception as e:
         print(f"Error saving merged model: {e}")
         return None
 
+    print(f"Merged file saved as: {os.path.basename(merged_file_path)} ({len(contributors)} LoRA models)")
+    print(f"Merged file size: {os.path.getsize(merged_file_path)} bytes")
+
+    quantize = MERGE_QUANTIZE if quantize is None else quantize
+    if quantize:
+        write_quantized_variant(merged_file_path, quantize)
+    if MERGE_SPARSE:
+        write_sparse_variant(merged_file_path)
     return merged_file_path
 
+
+def update_god_mode_key(key, previous_state, previous_keys, lora_handles, lora_sources, output_specs, merge_strategy, sign, writer, state_writer):
+    """Updates the running sums of one key with the given models and writes the key's state and merged tensor."""
+    dtype, shape = output_specs[key]
+    state_sum = MERGE_BUFFERS.acquire(shape, torch.float32).zero_()
+    weight_sum, count = 0.0, 0
+    if SUM_PREFIX + key in previous_keys:
+        previous_sum = previous_state.get_tensor(SUM_PREFIX + key)
+        state_sum[tuple(slice(0, s) for s in previous_sum.shape)] = previous_sum
+        weight_sum = previous_state.get_tensor(WEIGHT_PREFIX + key).item()
+        count = int(previous_state.get_tensor(COUNT_PREFIX + key))
+        del previous_sum
+
+    tensors = [handle.get_tensor(key) for handle, (_, specs) in zip(lora_handles, lora_sources) if key in specs]
+    weight_sum += accumulate_god_mode_state(state_sum, tensors, merge_strategy, sign)
+    count += sign * len(tensors)
+
+    merged_tensor = god_mode_state_output(state_sum, weight_sum, dtype)
+    writer.write(key, merged_tensor)
+    write_god_mode_state(key, state_sum, weight_sum, count, state_writer)
+    MERGE_BUFFERS.release(merged_tensor, state_sum)
+
+
+def accumulate_god_mode_state(state_sum, tensors, merge_strategy, sign=1):
+    """
+    Adds (or with sign=-1 subtracts) the weighted tensors into a key's running sum in place.
+
+    Each tensor is accumulated into the matching corner of the padded fp32 sum, and its weight is
+    taken from the unpadded tensor in fp32 so the same model always contributes the same weight.
+
+    Returns:
+    - The signed total weight of the tensors.
+    """
+    total_weight = 0.0
+    for tensor in tensors:
+        weight = 1.0
+        if merge_strategy == 'adaptive':
+            values = upcast(tensor)
+            norm = tensor_norm(values)
+            weight = norm.item()
+            MERGE_BUFFERS.release(values, norm)
+        state_sum[tuple(slice(0, s) for s in tensor.shape)].add_(tensor, alpha=sign * weight)
+        total_weight += weight
+    return sign * total_weight
+
+
+def god_mode_state_output(state_sum, weight_sum, dtype):
+    """Returns the merged tensor described by a key's running sums."""
+    merged_tensor = MERGE_BUFFERS.acquire(state_sum.shape, dtype)
+    if weight_sum == 0:
+        return merged_tensor.zero_()
+    return torch.div(state_sum, weight_sum, out=merged_tensor)
+
+
+def write_god_mode_state(key, state_sum, weight_sum, count, state_writer):
+    """Writes the running sums of one key to the state file."""
+    state_writer.write(SUM_PREFIX + key, state_sum)
+    state_writer.write(WEIGHT_PREFIX + key, torch.tensor(weight_sum, dtype=torch.float64))
+    state_writer.write(COUNT_PREFIX + key, torch.tensor(count, dtype=torch.int64))
+
+
+def resolve_god_mode_processes(processes=None, input_bytes=0):
+    """
+    Returns the number of God Mode worker processes, defaulting to GOD_MODE_PROCESSES.
+
+    0 means one per CPU core, but only as many as give each process at least GOD_MODE_SHARD_BYTES
+    of input, so small folders are not spread across processes that cost more to spawn than they save.
+    """
+    processes = GOD_MODE_PROCESSES if processes is None else processes
+    if processes:
+        return max(1, processes)
+    return max(1, min(os.cpu_count() or 1, input_bytes // GOD_MODE_SHARD_BYTES))
+
+
+def resolve_ram_budget(ram_budget=None):
+    """Returns the God Mode RAM budget in bytes: the configured budget, or a fraction of the currently available memory."""
+    ram_budget = GOD_MODE_RAM_BUDGET if ram_budget is None else ram_budget
+    if ram_budget:
+        return int(ram_budget)
+    return int(psutil.virtual_memory().available * GOD_MODE_RAM_FRACTION)
+
+
+def god_mode_key_bytes(key, model_specs, output_spec, upcast_inputs=False):
+    """Estimates the peak memory of merging one key: the inputs (and their fp32 copies when upcasting), the merged tensor and its fp32 running sum."""
+    out_dtype, out_shape = output_spec
+    out_numel = num_elements(out_shape)
+    compute_itemsize = DTYPE_SIZES[TORCH_TO_DTYPE[out_dtype]]
+    total = 0
+    for specs in model_specs:
+        if key in specs:
+            dtype, shape = specs[key]
+            itemsize = DTYPE_SIZES[TORCH_TO_DTYPE[dtype]]
+            total += num_elements(shape) * itemsize
+            if upcast_inputs and dtype.is_floating_point and itemsize < 4:
+                total += num_elements(shape) * 4
+                compute_itemsize = max(compute_itemsize, 4)
+    return total + out_numel * compute_itemsize + out_numel * 4
+
+
+def plan_key_batches(keys, model_specs, output_specs, ram_budget, upcast_inputs=False):
+    """
+    Splits keys into consecutive batches whose estimated merge memory fits in the RAM budget.
+
+    A key that alone exceeds the budget still gets its own batch, with a warning.
+    """
+    batches = []
+    current_batch = []
+    current_bytes = 0
+    oversized_keys = 0
+    for key in keys:
+        key_bytes = god_mode_key_bytes(key, model_specs, output_specs[key], upcast_inputs)
+        if key_bytes > ram_budget:
+            oversized_keys += 1
+        if current_batch and current_bytes + key_bytes > ram_budget:
+            batches.append(current_batch)
+            current_batch = []
+            current_bytes = 0
+        current_batch.append(key)
+        current_bytes += key_bytes
+    if current_batch:
+        batches.append(current_batch)
+    if oversized_keys:
+        print(f"Warning: {oversized_keys} layer(s) need more memory than the RAM budget and will be merged one at a time")
+    return batches
+
+
 def adaptive_merge_multiple(tensors):
-    """Merges multiple tensors using adaptive weights based on their L2 norms."""
+    """Merges multiple tensors using adaptive weights based on their L2 norms; tensors of different shapes are merged as if zero-padded."""
     try:
-        norms = [torch.norm(tensor) for tensor in tensors]
+        # Zero padding does not change the L2 norm, so the norms come from the unpadded tensors
+        norms = [tensor_norm(tensor) for tensor in tensors]
         total_norm = sum(norms)
         weights = [norm / total_norm for norm in norms]
+        MERGE_BUFFERS.release(*norms)
 
         # Calculate the final merged tensor
-        merged_tensor = sum(w * t for w, t in zip(weights, tensors))
-        return merged_tensor
+        return weighted_sum(tensors, weights)
     except Exception as e:
         print(f"Error in adaptive_merge_multiple: {e}")
-        return torch.zeros_like(tensors[0])
+        return torch.zeros(padded_size(tensors), dtype=tensors[0].dtype)
 
 def additive_merge_multiple(tensors):
-    """Merges multiple tensors using additive merging with equal weighting."""
+    """Merges multiple tensors using additive merging with equal weighting; tensors of different shapes are merged as if zero-padded."""
     try:
         weight = 1.0 / len(tensors)
-        merged_tensor = sum(weight * tensor for tensor in tensors)
-        return merged_tensor
+        return weighted_sum(tensors, [weight] * len(tensors))
     except Exception as e:
         print(f"Error in additive_merge_multiple: {e}")
-        return torch.zeros_like(tensors[0])
+        return torch.zeros(padded_size(tensors), dtype=tensors[0].dtype)
+
+def ties_merge_multiple(tensors, density=None):
+    """
+    TIES merge of multiple tensors: trim each to its largest-magnitude values, elect a sign per element, and average the agreeing values.
+
+    Each model keeps its density fraction of largest-magnitude values (defaults to GOD_MODE_TIES_DENSITY
+    in config.py). Each element then takes the sign of the sum of the trimmed values, and the mean of
+    only the non-zero values with that sign, so a concept carried by a few models is not diluted by
+    the others. Tensors of different shapes are merged as if zero-padded.
+    """
+    density = GOD_MODE_TIES_DENSITY if density is None else density
+    thresholds = magnitude_thresholds(tensors, density)
+    return stacked_merge(tensors, ties_transform(thresholds))
+
+
+def dare_merge_multiple(tensors, key, model_names, drop_rate=None):
+    """
+    DARE merge of multiple tensors: randomly drop values of each model, rescale the survivors, then average all models.
+
+    Each value is dropped with probability drop_rate (defaults to GOD_MODE_DARE_DROP_RATE in config.py)
+    and the kept ones are scaled by 1 / (1 - drop_rate), which keeps each model's expected values.
+    Scalars such as LoRA alphas are never dropped. Unlike TIES there is no sign election: the mean is
+    taken over every model. The random masks are seeded from the key, the model's file name and the
+    position, so a merge is reproducible whatever the worker or process count.
+    """
+    drop_rate = GOD_MODE_DARE_DROP_RATE if drop_rate is None else drop_rate
+    if drop_rate <= 0 or all(tensor.dim() == 0 for tensor in tensors):
+        return stacked_merge(tensors, lambda chunk, start: chunk, elect_sign=False)
+    return stacked_merge(tensors, dare_transform(key, model_names, drop_rate), elect_sign=False)
+
+
+def ties_transform(thresholds):
+    """Returns the chunk transform of TIES: zeroes each model's values below its magnitude threshold."""
+
+    def trim(chunk, start):
+        kept = torch.abs(chunk, out=MERGE_BUFFERS.acquire(chunk.shape, torch.float32)).ge_(thresholds[:, None])
+        chunk.mul_(kept)
+        MERGE_BUFFERS.release(kept)
+        return chunk
+
+    return trim
+
+
+def dare_transform(key, model_names, drop_rate):
+    """Returns the chunk transform of DARE: drops each model's values with probability drop_rate (seeded by key, model and position) and rescales the rest."""
+    scale = 1.0 / (1.0 - drop_rate)
+
+    def drop_and_rescale(chunk, start):
+        keep = MERGE_BUFFERS.acquire(chunk.shape[1:], torch.float32)
+        for row, model_name in zip(chunk, model_names):
+            torch.rand(row.shape, generator=torch.Generator().manual_seed(key_seed(key, model_name, start)), out=keep).ge_(drop_rate)
+            row.mul_(keep).mul_(scale)
+        MERGE_BUFFERS.release(keep)
+        return chunk
+
+    return drop_and_rescale
+
+
+def key_seed(*parts):
+    """Returns a random seed derived from the given names and positions, identical in every process."""
+    return int.from_bytes(hashlib.blake2b("|".join(str(part) for part in parts).encode("utf-8"), digest_size=8).digest(), "little") >> 1
+
+
+def magnitude_thresholds(tensors, density):
+    """
+    Returns, for each tensor, the smallest magnitude kept when trimming it to its density fraction of largest values.
+
+    Same-size tensors are stacked and their thresholds found with one unsorted topk call (a partial
+    selection, cheaper than sorting or kthvalue), a chunk of tensors at a time so the stacked
+    magnitudes stay within MERGE_BATCH_BYTES.
+    """
+    thresholds = torch.zeros(len(tensors))
+    sizes = {}
+    for index, tensor in enumerate(tensors):
+        sizes.setdefault(tensor.numel(), []).append(index)
+    for numel, indices in sizes.items():
+        if numel == 0:
+            continue
+        kept = min(numel, max(1, math.ceil(density * numel)))
+        rows = max(1, MERGE_BATCH_BYTES // (4 * numel))
+        for start in range(0, len(indices), rows):
+            chunk = indices[start:start + rows]
+            magnitudes = MERGE_BUFFERS.acquire((len(chunk), numel), torch.float32)
+            for row, index in zip(magnitudes, chunk):
+                row.copy_(tensors[index].reshape(-1)).abs_()
+            values = MERGE_BUFFERS.acquire((len(chunk), kept), torch.float32)
+            positions = MERGE_BUFFERS.acquire((len(chunk), kept), torch.int64)
+            torch.topk(magnitudes, kept, dim=1, sorted=False, out=(values, positions))
+            thresholds[chunk] = values.amin(dim=1)
+            MERGE_BUFFERS.release(magnitudes, values, positions)
+    return thresholds
+
+
+def stacked_merge(tensors, transform, elect_sign=True):
+    """
+    Merges the trimmed or dropped values of several tensors element-wise, in bounded chunks.
+
+    The models' values are stacked a column chunk at a time in fp32 (see stacked_merge_chunks).
+    Tensors of different shapes are merged as if zero-padded.
+    """
+    shape = padded_size(tensors)
+    dtype = tensors[0].dtype
+    for tensor in tensors[1:]:
+        dtype = torch.promote_types(dtype, tensor.dtype)
+    flats = []
+    for tensor in tensors:
+        if list(tensor.shape) != shape:
+            padded = torch.zeros(shape, dtype=tensor.dtype)
+            padded[tuple(slice(0, s) for s in tensor.shape)] = tensor
+            tensor = padded
+        flats.append(tensor.reshape(-1))
+
+    def load_chunk(start, end):
+        chunk = MERGE_BUFFERS.acquire((len(flats), end - start), torch.float32)
+        for row, flat in zip(chunk, flats):
+            row.copy_(flat[start:end])
+        return chunk
+
+    merged_tensor = MERGE_BUFFERS.acquire(shape, dtype)
+    stacked_merge_chunks(load_chunk, len(tensors), merged_tensor.view(-1), transform, elect_sign)
+    return merged_tensor
+
+
+def stacked_merge_chunks(load_chunk, count, merged_flat, transform, elect_sign=True):
+    """
+    Fills merged_flat with the merge of count models, a column chunk at a time within MERGE_BATCH_BYTES.
+
+    load_chunk(start, end) returns the fp32 (count, end - start) values of the models at those flat
+    positions as a pooled buffer, which transform(chunk, start) trims or drops in place. With
+    elect_sign (TIES), each element then takes the sign of the chunk's column sum and the mean of the
+    values with that sign; otherwise (DARE) the mean of all count models.
+    """
+    numel = merged_flat.numel()
+    chunk_size = max(1, MERGE_BATCH_BYTES // (8 * count))
+    for start in range(0, numel, chunk_size):
+        end = min(start + chunk_size, numel)
+        chunk = transform(load_chunk(start, end), start)
+        merged = sign_consensus_mean(chunk) if elect_sign else models_mean(chunk)
+        merged_flat[start:end] = merged
+        MERGE_BUFFERS.release(chunk, merged)
+
+
+def sign_consensus_mean(chunk):
+    """Elects the sign of each column of a (count, n) fp32 chunk and returns the pooled mean of the column values with that sign; the chunk is overwritten."""
+    column = MERGE_BUFFERS.acquire(chunk.shape[1:], torch.float32)
+    # Non-zero values with the elected sign are exactly those whose product with it is positive
+    agree = torch.mul(chunk, torch.sum(chunk, dim=0, out=column).sign_(), out=MERGE_BUFFERS.acquire(chunk.shape, torch.float32)).gt_(0)
+    counts = torch.sum(agree, dim=0, out=column).clamp_(min=1)
+    merged = torch.sum(chunk.mul_(agree), dim=0, out=MERGE_BUFFERS.acquire(chunk.shape[1:], torch.float32))
+    MERGE_BUFFERS.release(agree, column)
+    return merged.div_(counts)
+
+
+def models_mean(chunk):
+    """Returns the pooled mean of each column of a (count, n) fp32 chunk."""
+    return torch.sum(chunk, dim=0, out=MERGE_BUFFERS.acquire(chunk.shape[1:], torch.float32)).div_(chunk.shape[0])
+
+
+def god_mode_update_layers(model_specs, output_specs, rank=None):
+    """
+    Finds the LoRA layers TIES and DARE merge as weight updates, and sets the output specs of their factors.
+
+    Trimming or dropping the up and down factors separately would not trim (or drop) the update they apply:
+    their signs are arbitrary (up @ down == (-up) @ (-down)) and keeping a density d of both keeps about
+    d^2 of the update. So each layer's update is merged whole and re-factorized to the largest rank
+    its inputs have, capped by rank if set (defaults to GOD_MODE_LAYER_RANK in config.py), with alpha
+    equal to that rank.
+
+    Returns:
+    - A dict mapping each factor key (down, up and alpha) of those layers to the keys of its layer.
+    """
+    rank = GOD_MODE_LAYER_RANK if rank is None else rank
+    modules, _ = parse_lora_modules(output_specs)
+    layer_parts = {}
+    for parts in modules.values():
+        up_dtype, up_shape = output_specs[parts['up']]
+        down_dtype, down_shape = output_specs[parts['down']]
+        input_ranks = [specs[parts['down']][1][0] for specs in model_specs if parts['down'] in specs]
+        layer_rank = min(up_shape[0], num_elements(down_shape[1:]), max(input_ranks))
+        if rank > 0:
+            layer_rank = min(layer_rank, rank)
+        output_specs[parts['up']] = (up_dtype, (up_shape[0], layer_rank) + tuple(up_shape[2:]))
+        output_specs[parts['down']] = (down_dtype, (layer_rank,) + tuple(down_shape[1:]))
+        for key in parts.values():
+            layer_parts[key] = parts
+    return layer_parts
+
+
+def merge_god_mode_layer(key, parts, lora_handles, lora_sources, output_specs, merge_strategy, writer):
+    """
+    Merges the weight updates of one LoRA layer with TIES or DARE and writes its re-factorized factors.
+
+    The whole layer is merged when its down key is reached; its up and alpha keys are then already
+    written. Returns (input tensor count, merged successfully) for the key.
+    """
+    count = sum(1 for _, specs in lora_sources if key in specs)
+    if key != parts['down']:
+        return count, True
+    try:
+        up_dtype, up_shape = output_specs[parts['up']]
+        down_dtype, down_shape = output_specs[parts['down']]
+        shape = (up_shape[0], num_elements(down_shape[1:]))
+        models = [(handle, specs) for handle, (_, specs) in zip(lora_handles, lora_sources) if parts['up'] in specs and parts['down'] in specs]
+        max_rank = max(specs[parts['down']][1][0] for _, specs in models)
+        # The factors are zero-padded to the output shape and the largest rank, which leaves each update unchanged
+        ups = torch.zeros((len(models), shape[0], max_rank))
+        # Stored transposed so sampling columns of the updates (see sampled_update_thresholds) reads contiguous rows
+        downs = torch.zeros((len(models), shape[1], max_rank)).transpose(1, 2)
+        for index, (handle, specs) in enumerate(models):
+            down = handle.get_tensor(parts['down'])
+            up = handle.get_tensor(parts['up'])
+            rank = down.shape[0]
+            alpha = handle.get_tensor(parts['alpha']).item() if parts.get('alpha') in specs else rank
+            ups[index, :up.shape[0], :rank] = up.reshape(up.shape[0], -1)
+            ups[index, :up.shape[0], :rank] *= alpha / rank
+            downs[index, :rank, :num_elements(down.shape[1:])] = down.reshape(rank, -1)
+        del down, up
+
+        merged = merge_lora_updates(ups, downs, merge_strategy, key)
+        layer_rank = down_shape[0]
+        if layer_rank == min(shape):
+            # The output rank holds the whole merged update, so it needs no decomposition
+            if shape[1] <= shape[0]:
+                up_factor, down_factor = merged, torch.eye(shape[1])
+            else:
+                up_factor, down_factor = torch.eye(shape[0]), merged
+        else:
+            left, singular_values, right = low_rank_factors(merged, layer_rank, key_seed(key))
+            root = singular_values.sqrt()
+            up_factor, down_factor = left * root, right * root[:, None]
+        writer.write(parts['up'], up_factor.reshape(up_shape))
+        writer.write(parts['down'], down_factor.reshape(down_shape))
+        if 'alpha' in parts:
+            alpha_dtype, alpha_shape = output_specs[parts['alpha']]
+            writer.write(parts['alpha'], torch.full(alpha_shape, float(layer_rank), dtype=alpha_dtype))
+        return count, True
+
+    except Exception as e:
+        print(f"Error merging LoRA layer {key}: {e}")
+        for part_key in parts.values():
+            dtype, part_shape = output_specs[part_key]
+            writer.write(part_key, torch.zeros(part_shape, dtype=dtype))
+        print(f"Warning: Writing zeros for the layer of {key}")
+        return count, False
+
+
+def merge_lora_updates(ups, downs, merge_strategy, key, density=None, drop_rate=None):
+    """
+    TIES or DARE merge of the weight updates ups @ downs of several LoRA layers.
+
+    ups (count, out, rank) and downs (count, rank, in) are the models' factors, alpha / rank folded
+    into ups and zero-padded to one rank. The updates are built one tile at a time with a batched
+    matmul, each entry exactly once, and every tile is trimmed or dropped and merged while it is
+    still in the CPU cache (UPDATE_TILE_BYTES), so the models' dense updates are never held whole.
+
+    TIES trims each update to its density fraction of largest magnitudes (GOD_MODE_TIES_DENSITY),
+    with thresholds estimated from a sample of entries (see sampled_update_thresholds), then elects
+    a sign per entry and averages the values with that sign. DARE drops each entry with probability
+    drop_rate (GOD_MODE_DARE_DROP_RATE, rounded to a multiple of 1/256 as the drops are drawn from
+    random bytes seeded by key and tile), rescales the others and averages all models.
+
+    Returns:
+    - The merged fp32 update of shape (out, in).
+    """
+    count, out_features, _ = ups.shape
+    in_features = downs.shape[2]
+    tile_size = max(1, UPDATE_TILE_BYTES // (4 * count))
+    tile_columns = min(in_features, max(1, tile_size // UPDATE_TILE_ROWS))
+    tile_rows = max(1, tile_size // tile_columns)
+
+    if merge_strategy == 'ties':
+        density = GOD_MODE_TIES_DENSITY if density is None else density
+        thresholds = sampled_update_thresholds(ups, downs, density, key_seed(key)).view(count, 1, 1)
+    else:
+        drop_rate = GOD_MODE_DARE_DROP_RATE if drop_rate is None else drop_rate
+        drop_level = min(255, round(drop_rate * 256))
+        scale = 256 / (256 - drop_level) / count
+
+    merged = torch.empty((out_features, in_features))
+    for row in range(0, out_features, tile_rows):
+        for column in range(0, in_features, tile_columns):
+            up_rows = ups[:, row:row + tile_rows]
+            down_columns = downs[:, :, column:column + tile_columns]
+            tile = torch.bmm(up_rows, down_columns, out=MERGE_BUFFERS.acquire((count, up_rows.shape[1], down_columns.shape[2]), torch.float32))
+            if merge_strategy == 'ties':
+                kept = torch.abs(tile, out=MERGE_BUFFERS.acquire(tile.shape, torch.float32)).ge_(thresholds)
+                tile_merged = sign_consensus_mean(tile.mul_(kept))
+                MERGE_BUFFERS.release(kept)
+            elif drop_level > 0:
+                random_words = MERGE_BUFFERS.acquire((-(-tile.numel() // 8),), torch.int64)
+                random_words.random_(-2 ** 63, 2 ** 63 - 1, generator=torch.Generator().manual_seed(key_seed(key, row, column)))
+                kept = torch.ge(random_words.view(torch.uint8)[:tile.numel()].view(tile.shape), drop_level,
+                                out=MERGE_BUFFERS.acquire(tile.shape, torch.float32))
+                tile_merged = torch.sum(tile.mul_(kept), dim=0, out=MERGE_BUFFERS.acquire(tile.shape[1:], torch.float32)).mul_(scale)
+                MERGE_BUFFERS.release(random_words, kept)
+            else:
+                tile_merged = models_mean(tile)
+            merged[row:row + tile_rows, column:column + tile_columns] = tile_merged
+            MERGE_BUFFERS.release(tile, tile_merged)
+    return merged
+
+
+def sampled_update_thresholds(ups, downs, density, seed):
+    """
+    Returns, for each model's update ups @ downs, the smallest magnitude kept when trimming it to its density fraction of largest values.
+
+    Layers with at most TIES_SAMPLE_SIZE entries use all of them, which gives the exact thresholds.
+    Larger ones use TIES_SAMPLE_SIZE seeded random entries, the same for every model, each computed
+    from one row of up and one column of down without building the updates. The thresholds of all
+    models then come from one batched kthvalue over the (count, sample) magnitudes.
+    """
+    count, out_features, _ = ups.shape
+    in_features = downs.shape[2]
+    numel = out_features * in_features
+    if numel <= TIES_SAMPLE_SIZE:
+        magnitudes = torch.bmm(ups, downs).view(count, -1).abs_()
+    else:
+        positions = torch.randint(0, numel, (TIES_SAMPLE_SIZE,), generator=torch.Generator().manual_seed(seed))
+        # Gathering rows of the transposed downs reads contiguous memory when downs is a transposed view
+        sampled_ups = torch.index_select(ups, 1, positions // in_features)
+        sampled_downs = torch.index_select(downs.transpose(1, 2), 1, positions % in_features)
+        magnitudes = sampled_ups.mul_(sampled_downs).sum(dim=2).abs_()
+    kept = min(magnitudes.shape[1], max(1, math.ceil(density * magnitudes.shape[1])))
+    return torch.kthvalue(magnitudes, magnitudes.shape[1] - kept + 1, dim=1).values
+
+
+def low_rank_factors(matrix, rank, seed):
+    """
+    Truncated SVD of a dense matrix to exactly rank singular values.
+
+    Small ranks use a randomized SVD: a seeded Gaussian sketch of the range, refined by
+    RANDOMIZED_SVD_ITERATIONS power iterations, then the exact SVD of the small projected matrix,
+    so a large layer is never fully decomposed and the result is reproducible.
+
+    Returns:
+    - left singular vectors (out, rank), singular values (rank,) and right singular vectors (rank, in).
+    """
+    full_rank = min(matrix.shape)
+    sketch = min(full_rank, rank + 8)
+    if 2 * sketch >= full_rank:
+        left, singular_values, right = torch.linalg.svd(matrix, full_matrices=False)
+    else:
+        basis = torch.linalg.qr(matrix @ torch.randn((matrix.shape[1], sketch), generator=torch.Generator().manual_seed(seed)))[0]
+        for _ in range(RANDOMIZED_SVD_ITERATIONS):
+            basis = torch.linalg.qr(matrix @ (matrix.T @ basis))[0]
+        left, singular_values, right = torch.linalg.svd(basis.T @ matrix, full_matrices=False)
+        left = basis @ left
+    return left[:, :rank], singular_values[:rank], right[:rank]
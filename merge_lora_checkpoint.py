@@ -3,7 +3,15 @@ import os
 import sys
 import torch
 from tqdm import tqdm
-from safetensors.torch import load_file, save_file
+from contextlib import ExitStack
+from safetensors import safe_open
+from safetensors_io import read_header, header_specs, SafetensorsWriter, SafetensorsSource, save_tensors
+from merge_lora import resolve_precision, with_output_dtype, upcast
+from lora_key_map import plan_lora_bake
+from tensor_hashes import tensor_hashes, input_digest, record_output_inputs, PreviousOutputs
+from config import MERGE_PRECISION
+from buffer_pool import MERGE_BUFFERS
+from parallel_merge import run_parallel, resolve_workers, chunk_keys
 from input import option_6_merge_lora_checkpoint
 
 def start(settings):
@@ -20,20 +28,20 @@ def start(settings):
     # Ensure the output directory exists
     os.makedirs(output_folder, exist_ok=True)
 
-    lora_model = load_file(lora_path)
-    checkpoint_model = load_file(checkpoint_path)
-
-    # Merge strategy based on settings
+    # Merge strategy based on settings; both stream one tensor at a time straight to the output files
     if settings['merge_strategy'] == 'Mix':
-        merged_models = merge_lora_checkpoint_mix(lora_model, checkpoint_model, settings['weight_percentages'])
+        # All weighted variants are produced in a single pass over the inputs
+        weights = [weight / 100 for weight in settings['weight_percentages']]
+        desc = f"Merging LoRA into {len(weights)} Checkpoint variants"
     else:  # Full blend
-        merge_weight = settings['merge_weight'] / 100
-        merged_model = merge_lora_checkpoint_full(lora_model, checkpoint_model, merge_weight)
-        merged_models = [(merge_weight, merged_model)]
+        weights = [settings['merge_weight'] / 100]
+        desc = "Merging LoRA into Checkpoint"
 
-    # Save the merged checkpoint
-    for weight, merged_model in merged_models:
-        save_merged_checkpoint(merged_model, output_folder, settings['lora_model'], settings['checkpoint_model'], weight)
+    merged_names = [merged_checkpoint_filename(settings['lora_model'], settings['checkpoint_model'], weight) for weight in weights]
+    bake_lora_variants(checkpoint_path, lora_path, [os.path.join(output_folder, name) for name in merged_names], weights,
+                       desc=desc, precision=settings.get('precision'))
+    for merged_name in merged_names:
+        print(f"Merged checkpoint saved as: {merged_name}")
 
     print("Merging completed! ✅")
     print(" ")
@@ -42,55 +50,189 @@ def start(settings):
     completed(settings)
 
 
-def merge_lora_checkpoint_mix(lora_model, checkpoint_model, weight_percentages):
-    """Merges a LoRA into a main checkpoint using multiple weight percentages."""
-    merged_models = []
-    for weight in weight_percentages:
-        merged_model = merge_lora_checkpoint_full(lora_model, checkpoint_model, weight / 100)
-        merged_models.append((weight / 100, merged_model))
+def bake_lora_variants(checkpoint_path, lora_path, output_paths, merge_weights, desc="Merging LoRA into Checkpoint", workers=None, precision=None):
+    """
+    Bakes a LoRA into a checkpoint at several merge weights in a single pass over the checkpoint.
+
+    Each LoRA layer is mapped to the checkpoint weight it modifies (see lora_key_map.py), and its
+    delta up @ down * alpha / rank is computed when that weight is reached and added to it. Only
+    one layer's delta is held at a time, and the outputs have exactly the checkpoint's keys: LoRA
+    tensors never end up in the merged checkpoint.
+
+    Only the weights a LoRA modifies are loaded; every other tensor keeping its dtype is copied as
+    raw bytes from the checkpoint file into the outputs, so most of a multi-GB checkpoint is never
+    deserialized. When the outputs already exist from an earlier bake, modified weights whose
+    checkpoint and LoRA tensors are unchanged (see tensor_hashes.py) are copied from them as well.
+
+    Args:
+    - checkpoint_path: Path of the checkpoint .safetensors file.
+    - lora_path: Path of the LoRA .safetensors file.
+    - output_paths: Paths of the merged checkpoints to write, one per merge weight.
+    - merge_weights: Weight of the LoRA delta in each output.
+    - workers: Number of merge worker threads (defaults to MERGE_WORKERS in config.py).
+    - precision: Output precision ('auto', 'fp16', 'bf16', 'fp32'; defaults to MERGE_PRECISION in config.py).
+    """
+    checkpoint_header, _, _ = read_header(checkpoint_path)
+    lora_header, _, _ = read_header(lora_path)
+    checkpoint_specs = header_specs(checkpoint_header)
+    plan, unmatched = plan_lora_bake(lora_header.keys(), checkpoint_specs.keys())
+    report_bake_plan(plan, unmatched)
+
+    output_dtype = resolve_precision(precision)
+    output_specs = with_output_dtype(checkpoint_specs, output_dtype)
+
+    # Only the modified weights and the LoRA tensors they come from are hashed
+    checkpoint_hashes = tensor_hashes(checkpoint_path, plan.keys(), workers)
+    lora_hashes = tensor_hashes(lora_path, workers=workers)
+    key_inputs = [{key: input_digest({'weight': merge_weight, 'precision': precision or MERGE_PRECISION}, checkpoint_hashes[key],
+                                     [lora_hashes[entry_key] for entry in entries
+                                      for entry_key in sorted(value for part, value in entry.items() if part != 'rows')],
+                                     [entry['rows'] for entry in entries if 'rows' in entry])
+                   for key, entries in plan.items()} for merge_weight in merge_weights]
+
+    with ExitStack() as stack:
+        # The previous outputs are moved aside before the writers replace them
+        previous = stack.enter_context(PreviousOutputs(output_paths, key_inputs))
+        reused_keys = previous.reusable_keys([output_specs] * len(output_paths))
+        if reused_keys:
+            print(f"Reusing {len(reused_keys)} unchanged baked layers from the previous merge")
+        checkpoint_file = stack.enter_context(safe_open(checkpoint_path, framework="pt", device="cpu"))
+        checkpoint_source = stack.enter_context(SafetensorsSource(checkpoint_path))
+        lora_file = stack.enter_context(safe_open(lora_path, framework="pt", device="cpu"))
+        writers = [stack.enter_context(SafetensorsWriter(path, output_specs)) for path in output_paths]
+        stack.enter_context(MERGE_BUFFERS.session())
+
+        def bake_chunk(keys):
+            for key in keys:
+                if key in reused_keys:
+                    previous.copy(writers, key)
+                    continue
+                if key not in plan and output_specs[key] == checkpoint_specs[key]:
+                    for writer in writers:
+                        writer.copy_from(key, checkpoint_source)
+                    continue
+                tensor = checkpoint_file.get_tensor(key)
+                if output_dtype is not None:
+                    tensor = upcast(tensor)
+                delta = lora_delta(lora_file.get_tensor, plan[key], tensor.shape) if key in plan else None
+                variants = bake_checkpoint_variants(tensor, delta, merge_weights)
+                for writer, merged_tensor in zip(writers, variants):
+                    writer.write(key, merged_tensor)
+                MERGE_BUFFERS.release(*variants, delta, tensor)
+                del tensor, delta, variants
+            pbar.update(len(keys))
+
+        with tqdm(total=len(checkpoint_specs), desc=desc, unit="layer") as pbar:
+            # Keys are taken in file order so the untouched tensors are read sequentially
+            file_order = sorted(checkpoint_specs, key=lambda key: checkpoint_header[key]['data_offsets'][0])
+            run_parallel(chunk_keys(file_order, resolve_workers(workers)), bake_chunk, workers)
+
+    for output_path, inputs in zip(output_paths, key_inputs):
+        record_output_inputs(output_path, inputs)
+
+
+def report_bake_plan(plan, unmatched):
+    """Prints how many LoRA layers were mapped to checkpoint weights, and which LoRA keys were left out."""
+    layers = sum(len(entries) for entries in plan.values())
+    print(f"Baking {layers} LoRA layers into {len(plan)} checkpoint weights")
+    if unmatched:
+        print(f"Warning: {len(unmatched)} LoRA keys match no checkpoint weight and are not merged, e.g. {', '.join(unmatched[:3])}")
+
+
+def merge_lora_checkpoint_mix(lora_model, checkpoint_model, weight_percentages, workers=None):
+    """Bakes a LoRA into a main checkpoint using multiple weight percentages, in a single pass over the keys."""
+    weights = [weight / 100 for weight in weight_percentages]
+    merged_models = [(weight, {}) for weight in weights]
+    plan, unmatched = plan_lora_bake(lora_model.keys(), checkpoint_model.keys())
+    report_bake_plan(plan, unmatched)
+
+    def merge_chunk(keys):
+        for key in keys:
+            tensor = checkpoint_model[key]
+            delta = lora_delta(lora_model.__getitem__, plan[key], tensor.shape) if key in plan else None
+            for (_, merged_model), merged_tensor in zip(merged_models, bake_checkpoint_variants(tensor, delta, weights, in_place=False)):
+                merged_model[key] = merged_tensor
+            MERGE_BUFFERS.release(delta)
+        pbar.update(len(keys))
+
+    with tqdm(total=len(checkpoint_model), desc=f"Merging LoRA into {len(weights)} Checkpoint variants", unit="layer") as pbar, MERGE_BUFFERS.session():
+        run_parallel(chunk_keys(sorted(checkpoint_model), resolve_workers(workers)), merge_chunk, workers)
+
     return merged_models
 
 
-def merge_lora_checkpoint_full(lora_model, checkpoint_model, merge_weight):
-    """Merges a LoRA into a main checkpoint with a specified weight."""
-    merged_model = {}
-    all_keys = set(checkpoint_model.keys()).union(set(lora_model.keys()))
-
-    with tqdm(total=len(all_keys), desc="Merging LoRA into Checkpoint", unit="layer") as pbar:
-        for key in all_keys:
-            if key in checkpoint_model and key in lora_model:
-                tensor_checkpoint = checkpoint_model[key]
-                tensor_lora = lora_model[key]
-                if tensor_checkpoint.size() != tensor_lora.size():
-                    tensor_checkpoint, tensor_lora = pad_tensors(tensor_checkpoint, tensor_lora)
-                merged_model[key] = tensor_checkpoint + (merge_weight * tensor_lora)
-            elif key in checkpoint_model:
-                merged_model[key] = checkpoint_model[key]
+def merge_lora_checkpoint_full(lora_model, checkpoint_model, merge_weight, workers=None):
+    """Bakes a LoRA into a main checkpoint with a specified weight."""
+    return merge_lora_checkpoint_mix(lora_model, checkpoint_model, [merge_weight * 100], workers)[0][1]
+
+
+def lora_delta(get_tensor, entries, shape):
+    """
+    Computes the fp32 weight delta of the LoRA layers mapped to one checkpoint weight.
+
+    Each low-rank layer contributes up @ down * alpha / rank (alpha defaults to the rank), computed
+    with one matrix product into a pooled buffer; conv layers are flattened to matrices and the
+    result is reshaped to the checkpoint weight. Full tensors named like the weight are added as is.
+    A layer with a 'rows' block (such as the q, k or v projection of a stacked in_proj_weight) only
+    updates those rows; the rest of the delta is then zero.
+    """
+    delta = MERGE_BUFFERS.acquire(shape, torch.float32)
+    flat_delta = delta.view(shape[0] if shape else 1, -1)
+    zeroed = any('rows' in entry for entry in entries)
+    if zeroed:
+        flat_delta.zero_()
+    for index, entry in enumerate(entries):
+        first = index == 0 and not zeroed
+        if 'tensor' in entry:
+            update = get_tensor(entry['tensor']).float().reshape(flat_delta.shape)
+            if first:
+                flat_delta.copy_(update)
             else:
-                merged_model[key] = merge_weight * lora_model[key]
-            pbar.update(1)
+                flat_delta.add_(update)
+            continue
+        target = flat_delta
+        if 'rows' in entry:
+            block, blocks = entry['rows']
+            rows = flat_delta.shape[0] // blocks
+            target = flat_delta[block * rows:(block + 1) * rows]
+        down = get_tensor(entry['down']).float()
+        up = get_tensor(entry['up']).float()
+        rank = down.shape[0]
+        alpha = get_tensor(entry['alpha']).item() if 'alpha' in entry else rank
+        down = down.reshape(rank, -1)
+        up = up.reshape(up.shape[0], -1)
+        if up.shape[1] != rank or (up.shape[0], down.shape[1]) != tuple(target.shape):
+            raise ValueError(f"LoRA layer {entry['up']} does not fit a checkpoint weight of shape {tuple(shape)}")
+        if first:
+            torch.mm(up, down, out=target).mul_(alpha / rank)
+        else:
+            target.addmm_(up, down, alpha=alpha / rank)
+    return delta
+
 
-    return merged_model
+def bake_checkpoint_variants(tensor, delta, merge_weights, in_place=True):
+    """Adds a weight delta to a checkpoint tensor at several merge weights; with a single weight the tensor itself is updated in place."""
+    if delta is None:
+        return [tensor for _ in merge_weights]
+    if in_place and len(merge_weights) == 1 and tensor.is_floating_point():
+        return [tensor.add_(delta, alpha=merge_weights[0])]
+    dtype = torch.promote_types(tensor.dtype, delta.dtype)
+    return [torch.add(tensor, delta, alpha=merge_weight, out=MERGE_BUFFERS.acquire(tensor.shape, dtype)) for merge_weight in merge_weights]
 
 
-def pad_tensors(tensor1, tensor2):
-    """Pads tensors to the same size if they differ."""
-    max_size = [max(s1, s2) for s1, s2 in zip(tensor1.size(), tensor2.size())]
-    padded1 = torch.zeros(max_size, device=tensor1.device, dtype=tensor1.dtype)
-    padded2 = torch.zeros(max_size, device=tensor2.device, dtype=tensor2.dtype)
-    padded1[tuple(slice(0, s) for s in tensor1.size())] = tensor1
-    padded2[tuple(slice(0, s) for s in tensor2.size())] = tensor2
-    return padded1, padded2
+def merged_checkpoint_filename(lora_file, checkpoint_file, weight):
+    """Returns the file name of a merged checkpoint."""
+    lora_name = os.path.splitext(lora_file)[0]
+    checkpoint_name = os.path.splitext(checkpoint_file)[0]
+    return f"merged_{lora_name}_W{int(weight * 100)}_{checkpoint_name}.safetensors"
 
 
 def save_merged_checkpoint(merged_model, output_folder, lora_file, checkpoint_file, weight):
     """Saves the merged checkpoint with an appropriate name."""
-    lora_name = os.path.splitext(lora_file)[0]
-    checkpoint_name = os.path.splitext(checkpoint_file)[0]
-    merged_name = f"merged_{lora_name}_W{int(weight * 100)}_{checkpoint_name}.safetensors"
+    merged_name = merged_checkpoint_filename(lora_file, checkpoint_file, weight)
     merged_path = os.path.join(output_folder, merged_name)
 
-    save_file(merged_model, merged_path)
+    save_tensors(merged_model, merged_path)
     print(f"Merged checkpoint saved as: {merged_name}")
 
 
@@ -0,0 +1,173 @@
+# model_inventory.py
+import os
+import json
+from collections import Counter
+from tqdm import tqdm
+from safetensors_io import read_header, num_elements
+
+# Name of the per-folder index file caching the inventory of each model file
+INDEX_FILENAME = ".model_index.json"
+INDEX_VERSION = 1
+
+# Key suffixes holding the "down" (rank x in_features) factor of a LoRA layer
+LORA_DOWN_SUFFIXES = ("lora_down.weight", "lora_A.weight", "lora.down.weight")
+
+
+def scan_model(file_path):
+    """Builds an inventory of a model file from its header only (no tensor data is read)."""
+    if file_path.endswith('.safetensors'):
+        header, metadata, _ = read_header(file_path)
+        shapes = {key: info['shape'] for key, info in header.items()}
+        dtypes = {key: info['dtype'] for key, info in header.items()}
+    else:
+        # .pt files have no standalone header, so they still need a full load
+        import torch
+        model = torch.load(file_path, map_location="cpu")
+        shapes = {key: list(tensor.shape) for key, tensor in model.items()}
+        dtypes = {key: str(tensor.dtype).replace("torch.", "") for key, tensor in model.items()}
+        metadata = {}
+
+    return {
+        'num_layers': len(shapes),
+        'total_params': sum(num_elements(shape) for shape in shapes.values()),
+        'dtypes': dict(Counter(dtypes.values())),
+        'rank': detect_rank(shapes),
+        'format': detect_format(shapes.keys()),
+        'shapes': shapes,
+        'tensor_dtypes': dtypes,
+        'metadata': metadata,
+        'file_size': os.path.getsize(file_path),
+    }
+
+
+def detect_rank(shapes):
+    """Returns the LoRA rank as the largest first dimension of the down factors, or None for non-LoRA files."""
+    ranks = [shape[0] for key, shape in shapes.items() if key.endswith(LORA_DOWN_SUFFIXES) and shape]
+    return max(ranks) if ranks else None
+
+
+def detect_format(keys):
+    """Detects the LoRA key convention used by a model from its key names."""
+    keys = list(keys)
+    if any("lora_down" in key or "lora_up" in key for key in keys):
+        return "kohya"
+    if any("lora_A" in key or "lora_B" in key for key in keys):
+        return "peft"
+    if any(".lora.down." in key or ".lora.up." in key for key in keys):
+        return "diffusers"
+    if any("hada_" in key for key in keys):
+        return "loha"
+    if any("lokr_" in key for key in keys):
+        return "lokr"
+    return "checkpoint"
+
+
+def compute_tensor_stats(file_path):
+    """Computes per-tensor statistics, streaming one tensor at a time through safe_open."""
+    import torch
+    from safetensors import safe_open
+
+    stats = {}
+    with safe_open(file_path, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            tensor = f.get_tensor(key)
+            if tensor.numel() == 0 or tensor.dtype == torch.bool:
+                stats[key] = None
+                continue
+            values = tensor.float()
+            stats[key] = {
+                'norm': torch.linalg.vector_norm(values).item(),
+                'max_abs': values.abs().max().item(),
+                'mean': values.mean().item(),
+                'std': values.std().item() if values.numel() > 1 else 0.0,
+            }
+            del tensor, values
+    return stats
+
+
+def load_index(folder):
+    """Loads the cached inventory index of a folder, or an empty index if missing or unreadable."""
+    index_path = os.path.join(folder, INDEX_FILENAME)
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index['files']
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def save_index(folder, entries):
+    """Writes the inventory index of a folder atomically."""
+    index_path = os.path.join(folder, INDEX_FILENAME)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({'version': INDEX_VERSION, 'files': entries}, f)
+    os.replace(tmp_path, index_path)
+
+
+def scan_folder(folder, files, with_stats=False, desc="Scanning models"):
+    """
+    Returns the inventory of each file in a folder, served from the on-disk index when unchanged.
+
+    Entries are keyed by path and validated against the file size and mtime, so only new or
+    modified files are rescanned. Files that no longer exist are dropped from the index.
+
+    Args:
+    - folder: The folder containing the model files.
+    - files: The model file names to inventory.
+    - with_stats: Also compute per-tensor statistics (reads tensor data once per changed file).
+
+    Returns:
+    - A dict mapping each file name to its inventory entry.
+    """
+    cached = load_index(folder)
+    entries = {}
+    changed = False
+
+    with tqdm(total=len(files), desc=desc, unit="file", dynamic_ncols=True) as progress_bar:
+        for model_file in files:
+            model_path = os.path.join(folder, model_file)
+            stat = os.stat(model_path)
+            entry = cached.get(model_path)
+            needs_stats = with_stats and model_file.endswith('.safetensors')
+            if (entry is None
+                    or entry['size'] != stat.st_size
+                    or entry['mtime_ns'] != stat.st_mtime_ns
+                    or (needs_stats and entry.get('stats') is None)):
+                entry = scan_model(model_path)
+                entry['size'] = stat.st_size
+                entry['mtime_ns'] = stat.st_mtime_ns
+                entry['stats'] = compute_tensor_stats(model_path) if needs_stats else None
+                changed = True
+            entries[model_path] = entry
+            progress_bar.update(1)
+
+    # Keep entries of files from this folder that were not requested but still exist
+    for model_path, entry in cached.items():
+        if model_path not in entries and os.path.exists(model_path):
+            entries[model_path] = entry
+        elif model_path not in entries:
+            changed = True
+
+    if changed:
+        try:
+            save_index(folder, entries)
+        except OSError as e:
+            print(f"Warning: Could not write model index for {folder}: {e}")
+
+    return {model_file: entries[os.path.join(folder, model_file)] for model_file in files}
+
+
+def format_params(total_params):
+    """Formats a parameter count for display (e.g., 1.23M)."""
+    for unit, scale in (("B", 1e9), ("M", 1e6), ("K", 1e3)):
+        if total_params >= scale:
+            return f"{total_params / scale:.2f}{unit}"
+    return str(total_params)
+
+
+def format_dtypes(dtypes):
+    """Formats a dtype histogram for display, most common first (e.g., F16, F32)."""
+    return ", ".join(dtype for dtype, _ in sorted(dtypes.items(), key=lambda item: -item[1]))
@@ -0,0 +1,56 @@
+# parallel_merge.py
+import os
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from config import MERGE_WORKERS, MERGE_INTRA_OP_THREADS, MERGE_BATCH_BYTES
+
+
+def resolve_workers(workers=None):
+    """Returns the number of merge worker threads, defaulting to MERGE_WORKERS (0 means one per CPU core)."""
+    workers = MERGE_WORKERS if workers is None else workers
+    return max(1, workers or os.cpu_count() or 1)
+
+
+def worker_batch_bytes(workers=None):
+    """Returns the batch size of each merge worker: MERGE_BATCH_BYTES split across the workers, so the batches merged at once stay within it."""
+    return max(1, MERGE_BATCH_BYTES // resolve_workers(workers))
+
+
+@contextmanager
+def intra_op_threads(workers):
+    """Limits torch intra-op threads while merging so that workers x intra-op threads does not oversubscribe the CPU."""
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(MERGE_INTRA_OP_THREADS or max(1, (os.cpu_count() or 1) // workers))
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous_threads)
+
+
+def chunk_keys(keys, workers, chunks_per_worker=4):
+    """Splits a key list into contiguous chunks, a few per worker so that uneven chunks still balance out."""
+    keys = list(keys)
+    chunk_size = max(1, -(-len(keys) // (workers * chunks_per_worker)))
+    return [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+
+
+def run_parallel(tasks, task_fn, workers=None):
+    """
+    Runs task_fn on every task across a thread pool and returns the results in task order.
+
+    Torch releases the GIL inside its kernels, so independent keys merge concurrently. Each task
+    must only touch its own keys; results are identical to a serial run whatever the worker count.
+
+    Args:
+    - tasks: List of work items (typically key chunks).
+    - task_fn: Function applied to each task.
+    - workers: Number of worker threads (defaults to MERGE_WORKERS).
+    """
+    workers = min(resolve_workers(workers), max(1, len(tasks)))
+    with intra_op_threads(workers):
+        if workers == 1:
+            return [task_fn(task) for task in tasks]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(task_fn, task) for task in tasks]
+            return [future.result() for future in futures]
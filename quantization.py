@@ -0,0 +1,153 @@
+# quantization.py
+import os
+import json
+import torch
+from safetensors import safe_open
+from safetensors_io import read_header, header_specs, SafetensorsWriter, DTYPE_TO_TORCH, TORCH_TO_DTYPE
+from parallel_merge import run_parallel, resolve_workers, chunk_keys
+
+# Quantized storage dtype and largest representable magnitude of each format
+QUANT_FORMATS = {'int8': (torch.int8, 127.0)}
+if hasattr(torch, "float8_e4m3fn"):
+    QUANT_FORMATS['fp8'] = (torch.float8_e4m3fn, 448.0)
+
+# Each quantized tensor keeps its name and gets its per-output-channel fp32 scales under this suffix
+SCALE_SUFFIX = ".quant_scale"
+
+
+def quantized_path(file_path, qformat):
+    """Returns the path of the quantized variant of a model file (e.g. model.int8.safetensors)."""
+    return f"{os.path.splitext(file_path)[0]}.{qformat}.safetensors"
+
+
+def is_quantized_file(file_name):
+    """True for quantized variants written by save_quantized, which must not be merged as regular models."""
+    return any(file_name.endswith(f".{qformat}.safetensors") for qformat in QUANT_FORMATS)
+
+
+def is_quantizable(dtype, shape):
+    """Only floating point matrices (and conv kernels) are quantized; scalars such as alpha and vectors are kept as is."""
+    return dtype.is_floating_point and len(shape) >= 2 and all(dim > 0 for dim in shape)
+
+
+def quantize_tensor(tensor, qformat='int8'):
+    """
+    Symmetric quantization of a tensor with one scale per output channel (dimension 0).
+
+    Returns:
+    - The quantized tensor and its fp32 scales, one per output channel.
+    """
+    qdtype, qmax = QUANT_FORMATS[qformat]
+    values = tensor.to(torch.float32, copy=True)
+    max_abs = values.abs().amax(dim=tuple(range(1, values.dim())))
+    scale = torch.where(max_abs > 0, max_abs / qmax, torch.ones_like(max_abs))
+    scaled = values.div_(scale.view((-1,) + (1,) * (values.dim() - 1)))
+    if qdtype == torch.int8:
+        return scaled.round_().clamp_(-qmax, qmax).to(qdtype), scale
+    return scaled.clamp_(-qmax, qmax).to(qdtype), scale
+
+
+def dequantize_tensor(quantized, scale, dtype=torch.float32):
+    """Reconstructs a floating point tensor from its quantized values and per-output-channel scales."""
+    values = quantized.float().mul_(scale.view((-1,) + (1,) * (quantized.dim() - 1)))
+    return values.to(dtype)
+
+
+def save_quantized(source_path, output_path, qformat='int8', workers=None):
+    """
+    Writes a quantized copy of a .safetensors model, one tensor at a time.
+
+    Floating point matrices are stored in the quantized dtype with their per-output-channel scales
+    alongside; all other tensors are copied unchanged. The original dtypes are recorded in the
+    metadata so load_dequantized can restore them.
+
+    Returns:
+    - The reconstruction error report: a dict mapping each quantized key to its max and mean absolute error.
+    """
+    if qformat not in QUANT_FORMATS:
+        raise ValueError(f"Unknown quantization format: {qformat} (expected one of {', '.join(QUANT_FORMATS)})")
+    qdtype, _ = QUANT_FORMATS[qformat]
+    header, metadata, _ = read_header(source_path)
+    specs = header_specs(header)
+
+    quantized_specs = {}
+    original_dtypes = {}
+    for key, (dtype, shape) in specs.items():
+        if is_quantizable(dtype, shape):
+            quantized_specs[key] = (qdtype, shape)
+            quantized_specs[key + SCALE_SUFFIX] = (torch.float32, (shape[0],))
+            original_dtypes[key] = TORCH_TO_DTYPE[dtype]
+        else:
+            quantized_specs[key] = (dtype, shape)
+    metadata = dict(metadata, quantization=qformat, quantized_dtypes=json.dumps(original_dtypes))
+
+    report = {}
+    with safe_open(source_path, framework="pt", device="cpu") as source, \
+            SafetensorsWriter(output_path, quantized_specs, metadata) as writer:
+
+        def quantize_chunk(keys):
+            for key in keys:
+                tensor = source.get_tensor(key)
+                if key not in original_dtypes:
+                    writer.write(key, tensor)
+                    continue
+                quantized, scale = quantize_tensor(tensor, qformat)
+                writer.write(key, quantized)
+                writer.write(key + SCALE_SUFFIX, scale)
+                error = dequantize_tensor(quantized, scale).sub_(tensor.float()).abs_()
+                report[key] = {'max_error': error.max().item(), 'mean_error': error.mean().item()}
+
+        run_parallel(chunk_keys(sorted(specs), resolve_workers(workers)), quantize_chunk, workers)
+
+    return dict(sorted(report.items()))
+
+
+def load_dequantized(file_path, dtype=None):
+    """
+    Loads a model written by save_quantized back into floating point tensors.
+
+    Quantized tensors are restored to their original dtypes (or to dtype if given) and the scale
+    tensors are dropped, so the result has the keys and shapes of the model before quantization.
+    """
+    _, metadata, _ = read_header(file_path)
+    original_dtypes = json.loads(metadata.get('quantized_dtypes', '{}'))
+    tensors = {}
+    with safe_open(file_path, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            if key.endswith(SCALE_SUFFIX) and key[:-len(SCALE_SUFFIX)] in original_dtypes:
+                continue
+            tensor = f.get_tensor(key)
+            if key in original_dtypes:
+                tensor = dequantize_tensor(tensor, f.get_tensor(key + SCALE_SUFFIX), dtype or DTYPE_TO_TORCH[original_dtypes[key]])
+            tensors[key] = tensor
+    return tensors
+
+
+def write_quantized_variant(file_path, qformat):
+    """
+    Writes the quantized variant of a saved model next to it, with a JSON report of the per-layer
+    reconstruction error, and prints a summary of that report.
+
+    Returns:
+    - Path to the quantized variant, or None on error.
+    """
+    variant_path = quantized_path(file_path, qformat)
+    try:
+        report = save_quantized(file_path, variant_path, qformat)
+        report_path = os.path.splitext(variant_path)[0] + ".report.json"
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        print(f"Error saving quantized model: {e}")
+        return None
+
+    print(f"Quantized {qformat} variant saved as: {os.path.basename(variant_path)} ({os.path.getsize(variant_path)} bytes, "
+          f"{os.path.getsize(variant_path) / max(1, os.path.getsize(file_path)):.0%} of the original)")
+    if report:
+        worst = sorted(report.items(), key=lambda item: -item[1]['max_error'])[:5]
+        mean_error = sum(errors['mean_error'] for errors in report.values()) / len(report)
+        print(f"Reconstruction error over {len(report)} layers: max {worst[0][1]['max_error']:.3e}, mean {mean_error:.3e}")
+        for key, errors in worst:
+            print(f"  {key}: max {errors['max_error']:.3e}, mean {errors['mean_error']:.3e}")
+        print(f"Per-layer error report saved as: {os.path.basename(report_path)}")
+    return variant_path
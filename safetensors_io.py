@@ -0,0 +1,291 @@
+# safetensors_io.py
+import os
+import json
+import mmap
+import struct
+import torch
+
+# Size in bytes of one element for each safetensors dtype tag
+DTYPE_SIZES = {
+    "F64": 8, "F32": 4, "F16": 2, "BF16": 2,
+    "I64": 8, "I32": 4, "I16": 2, "I8": 1,
+    "U64": 8, "U32": 4, "U16": 2, "U8": 1,
+    "BOOL": 1, "F8_E4M3": 1, "F8_E5M2": 1,
+}
+
+# Mapping between safetensors dtype tags and torch dtypes
+DTYPE_TO_TORCH = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    DTYPE_TO_TORCH["F8_E4M3"] = torch.float8_e4m3fn
+    DTYPE_TO_TORCH["F8_E5M2"] = torch.float8_e5m2
+TORCH_TO_DTYPE = {value: key for key, value in DTYPE_TO_TORCH.items()}
+
+# Alignment in bytes of the start of the data section written by SafetensorsWriter
+DATA_ALIGNMENT = 64
+
+# Largest block copied at once when tensors are copied as raw bytes between files
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def read_header(file_path):
+    """Reads only the JSON header of a .safetensors file, without touching the tensor data.
+
+    Returns:
+    - header: dict mapping tensor names to {'dtype', 'shape', 'data_offsets'}
+    - metadata: the optional '__metadata__' dict (empty if absent)
+    - data_start: absolute file offset where the tensor data section begins
+    """
+    with open(file_path, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) != 8:
+            raise ValueError(f"File too small to be a safetensors file: {file_path}")
+        header_size = struct.unpack("<Q", prefix)[0]
+        raw_header = f.read(header_size)
+        if len(raw_header) != header_size:
+            raise ValueError(f"Truncated safetensors header in {file_path}")
+
+    header = json.loads(raw_header)
+    metadata = header.pop("__metadata__", None) or {}
+    return header, metadata, 8 + header_size
+
+
+def num_elements(shape):
+    """Returns the number of elements for a tensor shape."""
+    count = 1
+    for dim in shape:
+        count *= dim
+    return count
+
+
+def header_specs(header):
+    """Converts a safetensors header into a dict of key -> (torch dtype, shape)."""
+    return {key: (DTYPE_TO_TORCH[info['dtype']], tuple(info['shape'])) for key, info in header.items()}
+
+
+def tensor_layout(specs):
+    """
+    Orders tensors for writing and computes their data offsets.
+
+    Safetensors does not allow gaps between tensors, so tensors are sorted by element size
+    (largest first) and then by name: every tensor then starts at a multiple of its own element
+    size, which keeps it aligned for zero-copy mmap loading.
+
+    Returns:
+    - A dict mapping each key to its (start, end) offset relative to the data section, in file order.
+    """
+    order = sorted(specs, key=lambda key: (-DTYPE_SIZES[TORCH_TO_DTYPE[specs[key][0]]], key))
+    offsets = {}
+    offset = 0
+    for key in order:
+        dtype, shape = specs[key]
+        nbytes = num_elements(shape) * DTYPE_SIZES[TORCH_TO_DTYPE[dtype]]
+        offsets[key] = (offset, offset + nbytes)
+        offset += nbytes
+    return offsets
+
+
+class SafetensorsWriter:
+    """
+    Writes a .safetensors file tensor by tensor.
+
+    The header is computed up front from the known output dtypes and shapes, the file is pre-sized
+    and memory-mapped, and each tensor is copied straight into its final position as soon as it is
+    produced, in any order. The whole model never has to be held in memory, and the kernel flushes
+    written pages in the background while the next tensors are computed.
+    """
+
+    def __init__(self, file_path, specs, metadata=None):
+        """
+        Args:
+        - file_path: Destination path of the .safetensors file.
+        - specs: Dict mapping each tensor name to its (torch dtype, shape).
+        - metadata: Optional dict of string metadata stored under '__metadata__'.
+        """
+        self.file_path = file_path
+        self.specs = dict(specs)
+        self.offsets = tensor_layout(self.specs)
+        self.written = set()
+        self.require_complete = True
+        self.owns_file = True
+
+        header = {}
+        if metadata:
+            header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+        for key, (start, end) in self.offsets.items():
+            dtype, shape = self.specs[key]
+            header[key] = {"dtype": TORCH_TO_DTYPE[dtype], "shape": list(shape), "data_offsets": [start, end]}
+        data_size = max((end for _, end in self.offsets.values()), default=0)
+
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        # Pad the header with spaces so the data section starts on an aligned boundary
+        header_bytes += b" " * (-(8 + len(header_bytes)) % DATA_ALIGNMENT)
+        self.data_start = 8 + len(header_bytes)
+
+        self.file = open(file_path, "w+b")
+        self.file.write(struct.pack("<Q", len(header_bytes)))
+        self.file.write(header_bytes)
+        self.file.truncate(self.data_start + data_size)
+        self.file.flush()
+        self.mmap = mmap.mmap(self.file.fileno(), 0) if data_size > 0 else None
+
+    @classmethod
+    def attach(cls, file_path):
+        """
+        Opens a file already laid out by another SafetensorsWriter to fill in some of its tensors.
+
+        Used by worker processes that each write their own keys into a shared output file; the
+        attached writer does not require every tensor to be written when it closes, and on error it
+        only closes the file, leaving its removal to the writer's owner.
+        """
+        header, _, data_start = read_header(file_path)
+        writer = cls.__new__(cls)
+        writer.file_path = file_path
+        writer.specs = header_specs(header)
+        writer.offsets = {key: tuple(info['data_offsets']) for key, info in header.items()}
+        writer.written = set()
+        writer.data_start = data_start
+        writer.require_complete = False
+        writer.owns_file = False
+        writer.file = open(file_path, "r+b")
+        data_size = max((end for _, end in writer.offsets.values()), default=0)
+        writer.mmap = mmap.mmap(writer.file.fileno(), 0) if data_size > 0 else None
+        return writer
+
+    def write(self, key, tensor):
+        """
+        Copies one tensor into its reserved region of the file.
+
+        A floating point tensor of another floating dtype is converted while it is copied, so
+        outputs can be written in a lower precision without an intermediate converted copy.
+        """
+        dtype, shape = self.specs[key]
+        castable = tensor.dtype.is_floating_point and dtype.is_floating_point
+        if (tensor.dtype != dtype and not castable) or tuple(tensor.shape) != shape:
+            raise ValueError(f"Tensor {key} is {tensor.dtype} {tuple(tensor.shape)}, expected {dtype} {shape}")
+        start, end = self.offsets[key]
+        if end > start:
+            if tensor.dtype == dtype:
+                source = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+                target = torch.frombuffer(self.mmap, dtype=torch.uint8, count=end - start, offset=self.data_start + start)
+            else:
+                source = tensor.detach().cpu().reshape(-1)
+                target = torch.frombuffer(self.mmap, dtype=dtype, count=source.numel(), offset=self.data_start + start)
+            target.copy_(source)
+            del target
+        self.written.add(key)
+
+    def copy_from(self, key, source, source_key=None):
+        """
+        Copies one tensor as raw bytes from another .safetensors file, without deserializing it.
+
+        The bytes are copied by the kernel with copy_file_range where available (no trip through
+        user space), and otherwise in large chunks from the source's memory map.
+
+        Args:
+        - key: Name of the tensor in this file.
+        - source: SafetensorsSource the tensor is copied from.
+        - source_key: Name of the tensor in the source file (defaults to key).
+        """
+        source_key = key if source_key is None else source_key
+        if source.specs[source_key] != self.specs[key]:
+            raise ValueError(f"Tensor {source_key} is {source.specs[source_key]}, expected {self.specs[key]} for {key}")
+        source_start, source_end = source.offsets[source_key]
+        start, _ = self.offsets[key]
+        target = self.data_start + start
+        position = source_start
+        while position < source_end:
+            size = min(COPY_CHUNK_BYTES, source_end - position)
+            copied = 0
+            if hasattr(os, "copy_file_range"):
+                try:
+                    copied = os.copy_file_range(source.file.fileno(), self.file.fileno(), size, position, target)
+                except OSError:
+                    copied = 0  # Unsupported by this file system; fall back to the memory maps
+            if copied <= 0:
+                self.mmap[target:target + size] = source.mmap[position:position + size]
+                copied = size
+            position += copied
+            target += copied
+        self.written.add(key)
+
+    def close(self):
+        """Flushes and closes the file, checking that every declared tensor was written."""
+        if self.file.closed:
+            return
+        self._release()
+        missing = set(self.specs) - self.written
+        if missing and self.require_complete:
+            raise ValueError(f"{len(missing)} tensors were never written to {self.file_path}")
+
+    def abort(self):
+        """Closes and removes a partially written file; an attached writer only closes it, as other writers may still use it."""
+        if not self.file.closed:
+            self._release()
+        if self.owns_file and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def _release(self):
+        if self.mmap is not None:
+            self.mmap.flush()
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return False
+        self.close()
+        return False
+
+
+class SafetensorsSource:
+    """
+    Read-only access to the raw tensor bytes of a .safetensors file.
+
+    Used to copy tensors that a merge leaves unchanged straight into the output file with
+    SafetensorsWriter.copy_from, instead of loading and re-serializing them.
+    """
+
+    def __init__(self, file_path):
+        header, _, data_start = read_header(file_path)
+        self.file_path = file_path
+        self.specs = header_specs(header)
+        self.offsets = {key: (data_start + info['data_offsets'][0], data_start + info['data_offsets'][1]) for key, info in header.items()}
+        self.file = open(file_path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(file_path) > 0 else None
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def save_tensors(tensors, file_path, metadata=None):
+    """Saves a dict of tensors through SafetensorsWriter (drop-in replacement for save_file)."""
+    specs = {key: (tensor.dtype, tuple(tensor.shape)) for key, tensor in tensors.items()}
+    with SafetensorsWriter(file_path, specs, metadata) as writer:
+        for key, tensor in tensors.items():
+            writer.write(key, tensor)
+
+
+def prepare_safetensors(file_path, specs, metadata=None):
+    """Lays out a pre-sized .safetensors file whose tensors are then filled in by writers attached with SafetensorsWriter.attach."""
+    writer = SafetensorsWriter(file_path, specs, metadata)
+    writer.require_complete = False
+    writer.close()
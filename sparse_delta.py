@@ -0,0 +1,211 @@
+# sparse_delta.py
+import os
+import json
+from collections.abc import Mapping
+import torch
+from safetensors import safe_open
+from safetensors_io import read_header, header_specs, num_elements, SafetensorsWriter, DTYPE_TO_TORCH, TORCH_TO_DTYPE
+from parallel_merge import run_parallel, resolve_workers, chunk_keys
+from config import MERGE_SPARSE_DENSITY, MERGE_SPARSE_TOLERANCE
+
+# Each sparse tensor is replaced by the flat positions and values of its kept entries under these suffixes
+INDICES_SUFFIX = ".sparse_indices"
+VALUES_SUFFIX = ".sparse_values"
+
+# Value of the 'sparse_encoding' metadata of sparse variants
+SPARSE_ENCODING = "coo"
+
+
+def sparse_path(file_path):
+    """Returns the path of the sparse variant of a model file (e.g. model.sparse.safetensors)."""
+    return f"{os.path.splitext(file_path)[0]}.sparse.safetensors"
+
+
+def is_sparse_file(file_name):
+    """True for sparse variants written by save_sparse, which must not be merged as regular models."""
+    return file_name.endswith(".sparse.safetensors")
+
+
+def index_dtype(numel):
+    """Flat positions are stored as int32 unless the tensor has too many elements for it."""
+    return torch.int32 if numel <= torch.iinfo(torch.int32).max else torch.int64
+
+
+def kept_mask(tensor, tolerance=0.0):
+    """Entries kept by the sparse encoding: all non-zero ones, or those larger in magnitude than tolerance."""
+    flat = tensor.flatten()
+    return flat.abs() > tolerance if tolerance > 0 else flat != 0
+
+
+def storage_bytes(dtype, numel, kept):
+    """Returns the (dense, sparse) storage size in bytes of a tensor with numel elements, kept of which are stored sparse."""
+    value_size = torch.empty((), dtype=dtype).element_size()
+    index_size = torch.empty((), dtype=index_dtype(numel)).element_size()
+    return numel * value_size, kept * (value_size + index_size)
+
+
+def save_sparse(source_path, output_path, max_density=MERGE_SPARSE_DENSITY, tolerance=MERGE_SPARSE_TOLERANCE, workers=None):
+    """
+    Writes a copy of a .safetensors model in which the mostly-zero layers are stored sparse.
+
+    A floating point tensor whose share of kept entries (non-zero, or above tolerance in magnitude)
+    is below max_density, and which gets smaller that way, is replaced by two 1-D tensors: the flat
+    int32 (int64 for huge tensors) positions and the values of its kept entries. All other tensors
+    are copied unchanged. The original shapes are recorded in the metadata so SparseDeltaReader can
+    densify them. The file is written tensor by tensor in two passes, the first only counting the
+    kept entries of each tensor to lay out the output.
+
+    Returns:
+    - The size report: a dict mapping every key to its density, dense and sparse storage size in
+      bytes and the encoding it was stored with (plus, if tolerance is set, the largest value dropped).
+    """
+    header, metadata, _ = read_header(source_path)
+    if metadata.get('sparse_encoding'):
+        raise ValueError(f"{os.path.basename(source_path)} is already a sparse model")
+    specs = header_specs(header)
+    keys = sorted(specs)
+
+    with safe_open(source_path, framework="pt", device="cpu") as source:
+
+        def count_chunk(keys):
+            return {key: kept_mask(source.get_tensor(key), tolerance).sum().item() for key in keys
+                    if specs[key][0].is_floating_point and num_elements(specs[key][1]) > 0}
+
+        kept_counts = {}
+        for counts in run_parallel(chunk_keys(keys, resolve_workers(workers)), count_chunk, workers):
+            kept_counts.update(counts)
+
+        report = {}
+        sparse_specs = {}
+        sparse_shapes = {}
+        for key in keys:
+            dtype, shape = specs[key]
+            numel = num_elements(shape)
+            kept = kept_counts.get(key, numel)
+            dense_bytes, sparse_bytes = storage_bytes(dtype, numel, kept)
+            if key in kept_counts and kept < max_density * numel and sparse_bytes < dense_bytes:
+                sparse_specs[key + INDICES_SUFFIX] = (index_dtype(numel), (kept,))
+                sparse_specs[key + VALUES_SUFFIX] = (dtype, (kept,))
+                sparse_shapes[key] = [TORCH_TO_DTYPE[dtype], list(shape)]
+            else:
+                sparse_specs[key] = (dtype, shape)
+            report[key] = {'encoding': 'sparse' if key in sparse_shapes else 'dense', 'density': kept / max(1, numel),
+                           'dense_bytes': dense_bytes, 'sparse_bytes': sparse_bytes}
+        metadata = dict(metadata, sparse_encoding=SPARSE_ENCODING, sparse_shapes=json.dumps(sparse_shapes))
+
+        with SafetensorsWriter(output_path, sparse_specs, metadata) as writer:
+
+            def encode_chunk(keys):
+                for key in keys:
+                    tensor = source.get_tensor(key)
+                    if key not in sparse_shapes:
+                        writer.write(key, tensor)
+                        continue
+                    flat = tensor.flatten()
+                    mask = kept_mask(flat, tolerance)
+                    indices = mask.nonzero().squeeze(1)
+                    writer.write(key + INDICES_SUFFIX, indices.to(index_dtype(flat.numel())))
+                    writer.write(key + VALUES_SUFFIX, flat[indices])
+                    if tolerance > 0:
+                        dropped = flat[~mask]
+                        report[key]['max_error'] = dropped.abs().max().item() if dropped.numel() else 0.0
+
+            run_parallel(chunk_keys(keys, resolve_workers(workers)), encode_chunk, workers)
+
+    return report
+
+
+def densify_tensor(indices, values, shape, dtype=None):
+    """Scatters the values of a sparse tensor back to their flat positions in a zero tensor of the given shape."""
+    dense = torch.zeros(num_elements(shape), dtype=dtype or values.dtype)
+    dense[indices.long()] = values.to(dense.dtype)
+    return dense.reshape(shape)
+
+
+class SparseDeltaReader(Mapping):
+    """
+    Reads a model written by save_sparse, densifying its tensors lazily on access.
+
+    It maps the keys of the model before sparse encoding to their dense tensors: reader[key] (or
+    reader.get_tensor(key), as with safe_open) reads only that tensor, scattering its stored values
+    back into a zero tensor of the original shape if it was stored sparse. dict(reader) densifies
+    the whole model.
+    """
+
+    def __init__(self, file_path, dtype=None):
+        """
+        Args:
+        - file_path: Path of the sparse .safetensors variant.
+        - dtype: Optional dtype to return the tensors in; by default each tensor's original dtype.
+        """
+        _, metadata, _ = read_header(file_path)
+        self.file_path = file_path
+        self.dtype = dtype
+        self.sparse_shapes = json.loads(metadata.get('sparse_shapes', '{}'))
+        self.handle = safe_open(file_path, framework="pt", device="cpu")
+        stored = set(self.handle.keys())
+        self._keys = sorted((stored - {key + suffix for key in self.sparse_shapes
+                                       for suffix in (INDICES_SUFFIX, VALUES_SUFFIX)}) | set(self.sparse_shapes))
+
+    def get_tensor(self, key):
+        if key in self.sparse_shapes:
+            dtype, shape = self.sparse_shapes[key]
+            return densify_tensor(self.handle.get_tensor(key + INDICES_SUFFIX), self.handle.get_tensor(key + VALUES_SUFFIX),
+                                  shape, self.dtype or DTYPE_TO_TORCH[dtype])
+        if key not in self._keys:
+            raise KeyError(key)
+        tensor = self.handle.get_tensor(key)
+        return tensor.to(self.dtype) if self.dtype is not None and tensor.is_floating_point() else tensor
+
+    def __getitem__(self, key):
+        return self.get_tensor(key)
+
+    def keys(self):
+        return list(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def close(self):
+        self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def write_sparse_variant(file_path, max_density=MERGE_SPARSE_DENSITY, tolerance=MERGE_SPARSE_TOLERANCE):
+    """
+    Writes the sparse variant of a saved model next to it, with a JSON report comparing the dense
+    and sparse storage size of every layer, and prints a summary of that report.
+
+    Returns:
+    - Path to the sparse variant, or None on error.
+    """
+    variant_path = sparse_path(file_path)
+    try:
+        report = save_sparse(file_path, variant_path, max_density, tolerance)
+        report_path = os.path.splitext(variant_path)[0] + ".report.json"
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        print(f"Error saving sparse model: {e}")
+        return None
+
+    sparse_layers = [key for key, layer in report.items() if layer['encoding'] == 'sparse']
+    print(f"Sparse variant saved as: {os.path.basename(variant_path)} ({os.path.getsize(variant_path)} bytes, "
+          f"{os.path.getsize(variant_path) / max(1, os.path.getsize(file_path)):.0%} of the original)")
+    print(f"{len(sparse_layers)} of {len(report)} layers stored sparse (density below {max_density:.0%})")
+    if sparse_layers:
+        saved = sorted(sparse_layers, key=lambda key: report[key]['sparse_bytes'] - report[key]['dense_bytes'])[:5]
+        for key in saved:
+            layer = report[key]
+            print(f"  {key}: density {layer['density']:.1%}, {layer['dense_bytes']} -> {layer['sparse_bytes']} bytes")
+        print(f"Per-layer size report saved as: {os.path.basename(report_path)}")
+    return variant_path
@@ -0,0 +1,177 @@
+# tensor_hashes.py
+import os
+import json
+import hashlib
+from safetensors_io import SafetensorsSource, TORCH_TO_DTYPE, read_header
+from parallel_merge import run_parallel, resolve_workers, chunk_keys
+
+# Every model file can have a sidecar <name>.tensors.json holding, while the file is unchanged:
+#   'tensors': the content hash of each of its tensors
+#   'inputs':  for merged outputs, a digest of everything each output tensor was computed from
+# A re-run of a merge compares the digests of its inputs with those recorded for the previous output,
+# and copies the tensors whose inputs did not change instead of merging them again.
+SIDECAR_SUFFIX = ".tensors.json"
+SIDECAR_VERSION = 1
+
+
+def sidecar_path(file_path):
+    """Returns the path of the per-tensor hash sidecar of a model file."""
+    return os.path.splitext(file_path)[0] + SIDECAR_SUFFIX
+
+
+def load_sidecar(file_path):
+    """Returns the sidecar of a model file, or an empty one if it is missing, unreadable or the file changed since it was written."""
+    stat = os.stat(file_path)
+    try:
+        with open(sidecar_path(file_path), "r") as f:
+            sidecar = json.load(f)
+        if (sidecar.get('version') == SIDECAR_VERSION and sidecar['size'] == stat.st_size
+                and sidecar['mtime_ns'] == stat.st_mtime_ns):
+            return sidecar
+    except (OSError, ValueError, KeyError):
+        pass
+    return {'version': SIDECAR_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def save_sidecar(file_path, sidecar):
+    """Writes the sidecar of a model file atomically, stamped with the file's current size and mtime."""
+    stat = os.stat(file_path)
+    sidecar = dict(sidecar, version=SIDECAR_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    path = sidecar_path(file_path)
+    with open(path + ".tmp", "w") as f:
+        json.dump(sidecar, f)
+    os.replace(path + ".tmp", path)
+
+
+def tensor_hashes(file_path, keys=None, workers=None):
+    """
+    Returns the content hash of every tensor of a .safetensors file, or only of the given keys.
+
+    The hashes are read from the sidecar while the file is unchanged; missing ones are computed
+    from each tensor's raw bytes straight from the memory-mapped file (in parallel, as hashlib
+    releases the GIL) and added to the sidecar. Restricting the keys lets a checkpoint bake hash
+    only the weights it modifies instead of the whole checkpoint.
+    """
+    sidecar = load_sidecar(file_path)
+    known = sidecar.get('tensors') or {}
+    with SafetensorsSource(file_path) as source:
+        keys = sorted(source.specs if keys is None else set(keys) & set(source.specs))
+        missing = [key for key in keys if key not in known]
+        if missing:
+            known = dict(known, **hash_source_tensors(source, missing, workers))
+            sidecar['tensors'] = known
+    if missing:
+        save_sidecar(file_path, sidecar)
+    return {key: known[key] for key in keys}
+
+
+def content_hash(file_path, workers=None):
+    """
+    Returns a hash of the whole content of a .safetensors file, derived from its per-tensor hashes and metadata.
+
+    The tensor hashes come from the sidecar (computed on the first call), so fingerprinting a file
+    for the merge cache costs no read beyond the one the layer reuse needs anyway.
+    """
+    _, metadata, _ = read_header(file_path)
+    return input_digest({'tensors': tensor_hashes(file_path, workers=workers), 'metadata': metadata})
+
+
+def hash_source_tensors(source, keys, workers=None):
+    """Hashes the dtype, shape and raw bytes of the given tensors of a SafetensorsSource."""
+    data = memoryview(source.mmap) if source.mmap is not None else None
+
+    def hash_chunk(keys):
+        hashes = {}
+        for key in keys:
+            dtype, shape = source.specs[key]
+            start, end = source.offsets[key]
+            digest = hashlib.blake2b(f"{TORCH_TO_DTYPE[dtype]}{list(shape)}".encode("utf-8"), digest_size=16)
+            if end > start:
+                digest.update(data[start:end])
+            hashes[key] = digest.hexdigest()
+        return hashes
+
+    hashes = {}
+    for chunk_hashes in run_parallel(chunk_keys(keys, resolve_workers(workers)), hash_chunk, workers):
+        hashes.update(chunk_hashes)
+    del data
+    return hashes
+
+
+def input_digest(*parts):
+    """Digest of the JSON-serializable parts (parameters, source tensor hashes) an output tensor is computed from."""
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def record_output_inputs(file_path, key_inputs):
+    """Records in a merged output's sidecar the input digest of each of its tensors."""
+    save_sidecar(file_path, {'inputs': key_inputs})
+
+
+class PreviousOutputs:
+    """
+    Keeps the previous version of merged outputs around while they are rewritten, to copy their unchanged tensors.
+
+    A tensor can be reused when the previous output's sidecar recorded the same input digest for it
+    in every output and it keeps its dtype and shape. Previous files that have reusable tensors are
+    moved aside (to <name>.previous) before the new outputs are written, and deleted once they are
+    complete; if the merge fails they are moved back.
+    """
+
+    def __init__(self, output_paths, key_inputs, stored_keys=None):
+        """
+        Args:
+        - output_paths: Paths of the outputs about to be written.
+        - key_inputs: For each output, a dict mapping its keys to their current input digests.
+        - stored_keys: Optional function per output mapping a key to the tensor names it is stored under
+          in that file (such as the running sums of a God Mode state file); by default the key itself.
+        """
+        self.sources = []
+        self.moved = []
+        self.stored_keys = stored_keys or [lambda key: (key,)] * len(output_paths)
+        recorded = []
+        for output_path in output_paths:
+            inputs = load_sidecar(output_path).get('inputs') if os.path.exists(output_path) else None
+            recorded.append(inputs or {})
+        self.reusable = set.intersection(*(
+            {key for key, digest in current.items() if previous.get(key) == digest}
+            for current, previous in zip(key_inputs, recorded)
+        )) if output_paths else set()
+
+        if self.reusable:
+            for output_path in output_paths:
+                previous_path = output_path + ".previous"
+                os.replace(output_path, previous_path)
+                self.moved.append((output_path, previous_path))
+                self.sources.append(SafetensorsSource(previous_path))
+
+    def reusable_keys(self, output_specs_list):
+        """Returns the keys whose previous tensors can be copied, given the (dtype, shape) specs of each new output."""
+        return {key for key in self.reusable
+                if all(source.specs.get(name) == specs.get(name)
+                       for source, specs, stored_keys in zip(self.sources, output_specs_list, self.stored_keys)
+                       for name in stored_keys(key))}
+
+    def copy(self, writers, key):
+        """Copies the previous tensors of a key into each new output."""
+        for writer, source, stored_keys in zip(writers, self.sources, self.stored_keys):
+            for name in stored_keys(key):
+                writer.copy_from(name, source)
+
+    def close(self, success=True):
+        for source in self.sources:
+            source.close()
+        for output_path, previous_path in self.moved:
+            if success:
+                os.remove(previous_path)
+            elif not os.path.exists(output_path):
+                os.replace(previous_path, output_path)
+        self.sources = []
+        self.moved = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(success=exc_type is None)
+        return False
@@ -0,0 +1,51 @@
+import os
+import sys
+import torch
+from safetensors.torch import save_file
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import merge_lora
+from buffer_pool import MERGE_BUFFERS
+
+
+def write_lora(path, seed, keys=12, shape=(256, 256)):
+    generator = torch.Generator().manual_seed(seed)
+    save_file({f"layer_{index}.weight": torch.randn(shape, generator=generator).half() for index in range(keys)}, path)
+
+
+def test_stream_merge_allocations_stop_growing(tmp_path):
+    main_path = str(tmp_path / "main.safetensors")
+    merge_path = str(tmp_path / "merge.safetensors")
+    write_lora(main_path, 0)
+    write_lora(merge_path, 1)
+    allocations = [MERGE_BUFFERS.allocations]
+
+    def variants_fn(tensor1, tensor2):
+        merged = list(merge_lora.adaptive_merge_variants(tensor1, tensor2, [0.3, 0.7]))
+        allocations.append(MERGE_BUFFERS.allocations)
+        return merged
+
+    # fp32 upcasts the inputs, and 256 x 256 layers are normed in chunks, so both draw scratch buffers from the pool
+    merge_lora.stream_merge_variants(main_path, merge_path, [str(tmp_path / f"out_{index}.safetensors") for index in range(2)],
+                                     variants_fn, workers=1, precision='fp32')
+
+    assert len(allocations) == 13
+    # The first key draws two upcast inputs, two norms, one chunk norm scratch and two merged variants
+    assert allocations[1] - allocations[0] == 7
+    assert allocations[-1] == allocations[1]
+
+
+def test_stacked_merge_allocations_stop_growing():
+    generator = torch.Generator().manual_seed(0)
+    allocations = [MERGE_BUFFERS.allocations]
+    with MERGE_BUFFERS.session():
+        for _ in range(5):
+            tensors = [torch.randn(300, 257, generator=generator).half() for _ in range(4)]
+            MERGE_BUFFERS.release(merge_lora.ties_merge_multiple(tensors))
+            MERGE_BUFFERS.release(merge_lora.dare_merge_multiple(tensors, "layer.weight", ["a", "b", "c", "d"]))
+            allocations.append(MERGE_BUFFERS.allocations)
+
+    # Besides the merged output, the first merge draws its stacked chunk and masks from the pool
+    assert allocations[1] - allocations[0] > 1
+    assert allocations[-1] == allocations[1]